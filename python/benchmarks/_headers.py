@@ -0,0 +1,63 @@
+"""Builders of ismrmrd headers scaled up from the test header, for the header
+conversion benchmarks"""
+
+import copy
+from pathlib import Path
+from xml.etree import ElementTree
+
+HEADER_PATH = Path(__file__).parents[1] / "tests" / "data" / "ismrmrd_header.xml"
+ISMRMRD_NAMESPACE = "http://www.ismrm.org/ISMRMRD"
+
+
+def _tag(name: str) -> str:
+    return f"{{{ISMRMRD_NAMESPACE}}}{name}"
+
+
+def _find(element: ElementTree.Element, name: str) -> ElementTree.Element:
+    """The first child of element called name, which the test header must have"""
+    child = element.find(_tag(name))
+    if child is None:
+        raise ValueError(f"{HEADER_PATH} has no {name} in {element.tag}")
+    return child
+
+
+def scaled_header(n_coils: int, n_encodings: int, n_user_parameters: int) -> bytes:
+    """The test header with n_coils coil labels, n_encodings copies of its first
+    encoding and n_user_parameters user parameters (half long, half double)"""
+    ElementTree.register_namespace("", ISMRMRD_NAMESPACE)
+    root = ElementTree.fromstring(HEADER_PATH.read_bytes())
+
+    system = _find(root, "acquisitionSystemInformation")
+    coil_labels = system.findall(_tag("coilLabel"))
+    position = list(system).index(coil_labels[0])
+    for coil_label in coil_labels:
+        system.remove(coil_label)
+    for coil in range(n_coils):
+        coil_label = copy.deepcopy(coil_labels[0])
+        _find(coil_label, "coilNumber").text = str(coil + 1)
+        _find(coil_label, "coilName").text = f"Body_18:1:B{coil + 1}"
+        system.insert(position + coil, coil_label)
+    _find(system, "receiverChannels").text = str(n_coils)
+
+    encodings = root.findall(_tag("encoding"))
+    position = list(root).index(encodings[0])
+    for encoding in encodings:
+        root.remove(encoding)
+    for index in range(n_encodings):
+        root.insert(position + index, copy.deepcopy(encodings[0]))
+
+    user_parameters = _find(root, "userParameters")
+    for parameter in list(user_parameters):
+        user_parameters.remove(parameter)
+    for index in range(n_user_parameters):
+        # The schema requires all long parameters before the double ones
+        kind = (
+            "userParameterLong"
+            if index < n_user_parameters // 2
+            else "userParameterDouble"
+        )
+        parameter = ElementTree.SubElement(user_parameters, _tag(kind))
+        ElementTree.SubElement(parameter, _tag("name")).text = f"parameter_{index}"
+        ElementTree.SubElement(parameter, _tag("value")).text = str(index)
+
+    return ElementTree.tostring(root, xml_declaration=True, encoding="utf-8")
@@ -0,0 +1,58 @@
+from pathlib import Path
+
+import h5py
+import ismrmrd
+import numpy as np
+import pytest
+
+import xnat_mrd
+from xnat_mrd.fetch_datasets import get_multidata, get_singledata
+
+from benchmarks._headers import HEADER_PATH
+from tests.stand_in_server import StandInXnat
+
+
+@pytest.fixture(scope="session")
+def xml_schema_path():
+    """Provides the path of the ismrmrd header schema shipped with xnat_mrd"""
+
+    return Path(xnat_mrd.__file__).parent / "ismrmrd.xsd"
+
+
+@pytest.fixture(scope="session", params=["singledata", "multidata"])
+def zenodo_mrd_file_path(request):
+    """Provides the path of each of the Zenodo test files, skipping if they are not
+    cached and cannot be downloaded"""
+
+    fetch = {"singledata": get_singledata, "multidata": get_multidata}[request.param]
+    try:
+        return fetch()
+    except Exception as e:
+        pytest.skip(f"Zenodo {request.param} file unavailable: {e}")
+
+
+@pytest.fixture(scope="session")
+def large_mrd_file_path(tmp_path_factory):
+    """Provides an mrd file holding the test header and 16 MB of acquisition-sized
+    data, for upload benchmarks"""
+
+    mrd_file_path = tmp_path_factory.mktemp("benchmark") / "large.h5"
+    with ismrmrd.Dataset(mrd_file_path, "dataset", create_if_needed=True) as dset:
+        dset.write_xml_header(HEADER_PATH.read_bytes())
+    with h5py.File(mrd_file_path, "a") as f:
+        f["dataset"].create_dataset(
+            "samples", data=np.random.default_rng(0).standard_normal(2 * 1024 * 1024)
+        )
+
+    return mrd_file_path
+
+
+@pytest.fixture(scope="session", params=[False, True], ids=["whole-file", "resumable"])
+def stand_in_xnat(request):
+    """Provides a local stand-in XNAT server (see tests/stand_in_server.py), both
+    without and with support for resumable uploads"""
+
+    stand_in = StandInXnat(resumable=request.param)
+    stand_in.start()
+    yield stand_in
+    stand_in.stop()
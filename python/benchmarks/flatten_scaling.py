@@ -0,0 +1,91 @@
+"""Show that flatten_header scales linearly with header size, while the repeated
+root-to-leaf walk previously used by create_list_param_names is quadratic in depth.
+In wide, shallow headers both are linear; flatten_header also builds the XNAT keys and
+applies the header rules, so a ratio around 1 there is the expected result.
+
+Run with: python benchmarks/flatten_scaling.py
+"""
+
+import timeit
+from typing import Any
+
+from xnat_mrd.mrd_2_xnat import flatten_header
+
+
+def deep_header(depth: int) -> dict[str, Any]:
+    """A header with a single chain of depth nested groups, alternating dicts and lists
+    (e.g. userParameters nested inside repeated elements)"""
+    value: Any = {"value": 1.0}
+    for level in range(depth):
+        value = {f"group{level}": [value] if level % 2 else value}
+    return {"@xmlns": "http://www.ismrm.org/ISMRMRD", **value}
+
+
+def wide_header(width: int) -> dict[str, Any]:
+    """A header with width parameter groups, each with a handful of fields"""
+    return {
+        f"group{group}": {"x": group, "y": [group, group + 1], "z": {"w": "value"}}
+        for group in range(width)
+    }
+
+
+def repeated_root_walk(ismrmrd_dict: dict[str, Any]) -> list[list[Any]]:
+    """Reference implementation of the previous flattening (without its five pass cap):
+    each pass expands every path one level, re-walking it from the root"""
+    paths: list[list[Any]] = [[key] for key in ismrmrd_dict if "@" not in key]
+    while True:
+        finished = True
+        new_paths: list[list[Any]] = []
+        for path in paths:
+            value: Any = ismrmrd_dict
+            for key in path:
+                value = value[key]
+            if isinstance(value, dict):
+                finished = False
+                new_paths.extend(path + [key] for key in value)
+            elif isinstance(value, list):
+                for idx, item in enumerate(value):
+                    if isinstance(item, dict):
+                        finished = False
+                        new_paths.extend(path + [idx, key] for key in item)
+                    else:
+                        new_paths.append(path + [idx])
+            else:
+                new_paths.append(path)
+        if finished:
+            return new_paths
+        paths = new_paths
+
+
+def best_time(func, header: dict[str, Any], repeats: int = 5) -> float:
+    return min(timeit.repeat(lambda: func(header), number=1, repeat=repeats))
+
+
+def compare(label: str, make_header, sizes: list[int]) -> None:
+    print(f"\n{label}")
+    print(
+        f"{'size':>8} {'flatten_header (ms)':>20} {'root walk (ms)':>16} {'ratio':>6}"
+    )
+    previous = None
+    for size in sizes:
+        header = make_header(size)
+        flatten = best_time(flatten_header, header) * 1e3
+        root_walk = best_time(repeated_root_walk, header) * 1e3
+        growth = ""
+        if previous is not None:
+            growth = (
+                f"  x{flatten / previous[0]:.1f} / x{root_walk / previous[1]:.1f}"
+                " for x2 size"
+            )
+        ratio = flatten / root_walk
+        print(f"{size:>8} {flatten:>20.2f} {root_walk:>16.2f} {ratio:>6.2f}{growth}")
+        previous = (flatten, root_walk)
+
+
+def main() -> None:
+    compare("Deep headers (nesting depth)", deep_header, [250, 500, 1000, 2000])
+    compare("Wide headers (parameter groups)", wide_header, [500, 1000, 2000, 4000])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Compare creating a scan with the header as query parameters against sending it as
+an mrd:mrdScanData XML request body: request size, and latency against a local stub
+server that decodes the query string / parses the XML document like XNAT would.
+
+Run with: python benchmarks/scan_creation.py
+"""
+
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlsplit
+from xml.etree import ElementTree
+
+import requests
+
+import xnat_mrd
+from xnat_mrd.mrd_2_xnat import mrd_2_xnat, xnat_hdr_to_xml
+
+HEADER_PATH = Path(__file__).parents[1] / "tests" / "data" / "ismrmrd_header.xml"
+SCAN_PATH = "/data/experiments/Exp-1/scans/cart_cine_scan"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_PUT(self):
+        query = parse_qs(urlsplit(self.path).query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if query.get("inbody") == ["true"]:
+            n_fields = sum(
+                1
+                for element in ElementTree.fromstring(body).iter()
+                if len(element) == 0
+            )
+        else:
+            n_fields = len(query)
+        response = str(n_fields).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def time_requests(send, repeats: int) -> list[float]:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        send()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main(repeats: int = 500) -> None:
+    xnat_hdr = mrd_2_xnat(
+        HEADER_PATH.read_bytes(), Path(xnat_mrd.__file__).parent / "ismrmrd.xsd"
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    query_url = f"{base_url}{SCAN_PATH}?{urlencode(xnat_hdr)}"
+    body_url = f"{base_url}{SCAN_PATH}?inbody=true"
+
+    with requests.Session() as session:
+
+        def send_query():
+            session.put(query_url).raise_for_status()
+
+        def send_body():
+            # The XML document is built per request, as in create_scan
+            body = xnat_hdr_to_xml(xnat_hdr, "cart_cine_scan")
+            session.put(
+                body_url, data=body, headers={"Content-Type": "text/xml"}
+            ).raise_for_status()
+
+        # Warm up connections and caches
+        send_query()
+        send_body()
+        results = {
+            "query parameters": (
+                len(query_url) - len(base_url),
+                0,
+                time_requests(send_query, repeats),
+            ),
+            "XML body": (
+                len(body_url) - len(base_url),
+                len(xnat_hdr_to_xml(xnat_hdr, "cart_cine_scan")),
+                time_requests(send_body, repeats),
+            ),
+        }
+    server.shutdown()
+
+    print(f"{len(xnat_hdr)} header fields, {repeats} requests each")
+    print(
+        f"{'':>18} {'URL (bytes)':>12} {'body (bytes)':>13} "
+        f"{'median (ms)':>12} {'p95 (ms)':>9}"
+    )
+    for label, (url_bytes, body_bytes, times) in results.items():
+        p95 = statistics.quantiles(times, n=20)[-1]
+        print(
+            f"{label:>18} {url_bytes:>12} {body_bytes:>13} "
+            f"{statistics.median(times) * 1e3:>12.3f} {p95 * 1e3:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
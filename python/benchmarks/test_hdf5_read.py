@@ -0,0 +1,19 @@
+"""HDF5 benchmarks: opening an mrd file and reading the xml header of a dataset"""
+
+from xnat_mrd.mrd_file import MrdFile
+from xnat_mrd.populate_datatype_fields import select_dataset_name
+
+
+def read_header(mrd_file_path):
+    with MrdFile(mrd_file_path) as mrd_file:
+        return mrd_file.read_xml_header(
+            select_dataset_name(mrd_file.dataset_names, mrd_file.multidata)
+        )
+
+
+def test_read_header_zenodo(benchmark, zenodo_mrd_file_path):
+    assert benchmark(read_header, zenodo_mrd_file_path)
+
+
+def test_read_header_synthetic(benchmark, large_mrd_file_path):
+    assert benchmark(read_header, large_mrd_file_path)
@@ -0,0 +1,50 @@
+"""Header conversion benchmarks: mrd_2_xnat on the Zenodo test files, and on
+synthetic headers scaled in the number of coils, encodings and user parameters"""
+
+import pytest
+
+from xnat_mrd.mrd_2_xnat import get_xml_schema, mrd_2_xnat
+from xnat_mrd.mrd_file import MrdFile
+from xnat_mrd.populate_datatype_fields import select_dataset_name
+
+from benchmarks._headers import scaled_header
+
+
+def test_mrd_2_xnat_zenodo(benchmark, zenodo_mrd_file_path, xml_schema_path):
+    with MrdFile(zenodo_mrd_file_path) as mrd_file:
+        header = mrd_file.read_xml_header(
+            select_dataset_name(mrd_file.dataset_names, mrd_file.multidata)
+        )
+    get_xml_schema(xml_schema_path)
+
+    xnat_hdr = benchmark(mrd_2_xnat, header, xml_schema_path)
+
+    assert xnat_hdr
+
+
+@pytest.mark.parametrize("n_coils", [1, 32, 128])
+def test_mrd_2_xnat_coils(benchmark, xml_schema_path, n_coils):
+    header = scaled_header(n_coils=n_coils, n_encodings=1, n_user_parameters=2)
+    get_xml_schema(xml_schema_path)
+
+    xnat_hdr = benchmark(mrd_2_xnat, header, xml_schema_path)
+
+    assert xnat_hdr["mrd:mrdScanData/acquisitionSystemInformation/receiverChannels"]
+
+
+@pytest.mark.parametrize("n_encodings", [1, 4, 16])
+def test_mrd_2_xnat_encodings(benchmark, xml_schema_path, n_encodings):
+    header = scaled_header(n_coils=4, n_encodings=n_encodings, n_user_parameters=2)
+    get_xml_schema(xml_schema_path)
+
+    assert benchmark(mrd_2_xnat, header, xml_schema_path)
+
+
+@pytest.mark.parametrize("n_user_parameters", [2, 100, 1000])
+def test_mrd_2_xnat_user_parameters(benchmark, xml_schema_path, n_user_parameters):
+    header = scaled_header(
+        n_coils=4, n_encodings=1, n_user_parameters=n_user_parameters
+    )
+    get_xml_schema(xml_schema_path)
+
+    assert benchmark(mrd_2_xnat, header, xml_schema_path)
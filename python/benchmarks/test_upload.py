@@ -0,0 +1,25 @@
+"""Upload benchmarks: streaming the raw file to a local stand-in XNAT server, as a
+single request and in resumable chunks"""
+
+from xnat_mrd.upload import upload_raw_file
+
+RESOURCE_URI = "/data/experiments/Exp-1/resources/MR_RAW"
+
+
+def test_upload_raw_file(benchmark, stand_in_xnat, large_mrd_file_path):
+    session = stand_in_xnat.session()
+
+    def upload():
+        # Start from an empty resource, so resumable uploads send the whole file
+        stand_in_xnat.files.clear()
+        return upload_raw_file(
+            session,
+            RESOURCE_URI,
+            large_mrd_file_path,
+            resumable=stand_in_xnat.resumable,
+        )
+
+    assert benchmark(upload)
+    assert len(stand_in_xnat.files[f"{RESOURCE_URI}/files/large.h5"]) == (
+        large_mrd_file_path.stat().st_size
+    )
@@ -0,0 +1,158 @@
+import logging
+from pathlib import Path
+from typing import Any, Optional, Union
+from xml.etree import ElementTree
+
+import numpy as np
+
+from xnat_mrd.mrd_file import MrdFile, open_mrd_file
+from xnat_mrd.timing import span
+
+logger = logging.getLogger(__name__)
+
+# Number of acquisition headers read from the 'data' dataset at a time (about 340 bytes
+# each - the k-space samples themselves are never read)
+DEFAULT_ACQUISITIONS_PER_CHUNK = 65536
+
+# Duration of one tick of acquisition_time_stamp. This is vendor specific - 2.5 ms is
+# used by the Siemens and GE converters.
+DEFAULT_TIME_STAMP_TICK_SECONDS = 2.5e-3
+
+_ISMRMRD_NAMESPACE = "{http://www.ismrm.org/ISMRMRD}"
+_STATISTICS_PREFIX = "mrd:mrdScanData/acquisitionStatistics"
+
+
+def _flag_bit(flag: int) -> np.uint64:
+    """Bit of an ISMRMRD acquisition flag (flags are numbered from 1)"""
+    return np.uint64(1) << np.uint64(flag - 1)
+
+
+ACQ_IS_NOISE_MEASUREMENT = _flag_bit(19)
+ACQ_IS_PARALLEL_CALIBRATION = _flag_bit(20)
+ACQ_IS_PARALLEL_CALIBRATION_AND_IMAGING = _flag_bit(21)
+# Acquisitions that are not k-space lines of the image: noise, calibration only,
+# navigator, phase correction, feedback, dummy, surface coil correction and phase
+# stabilisation scans
+_NON_IMAGING_FLAGS = np.bitwise_or.reduce(
+    [_flag_bit(flag) for flag in (19, 20, 23, 24, 25, 26, 27, 28, 30, 31)]
+)
+
+
+def _encoded_lines(xml_header: bytes) -> list[Optional[int]]:
+    """Number of k-space lines (kspace_encoding_step_1 x kspace_encoding_step_2) of each
+    encoding of an ismrmrd header, from its encodingLimits - None where these are
+    missing"""
+    lines: list[Optional[int]] = []
+    for encoding in ElementTree.fromstring(xml_header).iter(
+        f"{_ISMRMRD_NAMESPACE}encoding"
+    ):
+        limits = [
+            encoding.find(
+                f"{_ISMRMRD_NAMESPACE}encodingLimits/{_ISMRMRD_NAMESPACE}{step}"
+            )
+            for step in ("kspace_encoding_step_1", "kspace_encoding_step_2")
+        ]
+        n_lines: Optional[int] = None
+        if limits[0] is not None:
+            n_lines = 1
+            for limit in limits:
+                if limit is None:
+                    # A 2D encoding has no limits for step 2
+                    continue
+                minimum = int(limit.findtext(f"{_ISMRMRD_NAMESPACE}minimum", "0"))
+                maximum = int(limit.findtext(f"{_ISMRMRD_NAMESPACE}maximum", "0"))
+                n_lines *= maximum - minimum + 1
+        lines.append(n_lines)
+    return lines
+
+
+@span("acquisition_statistics")
+def acquisition_statistics(
+    mrd_file: Union[Path, MrdFile],
+    dataset_name: str,
+    acquisitions_per_chunk: int = DEFAULT_ACQUISITIONS_PER_CHUNK,
+    time_stamp_tick_seconds: float = DEFAULT_TIME_STAMP_TICK_SECONDS,
+) -> dict[str, Any]:
+    """Statistics of the acquisitions of dataset_name, as mrd:mrdScanData/
+    acquisitionStatistics/... fields to add to the output of mrd_2_xnat: the number of
+    acquisitions, of noise and of parallel imaging calibration scans, the scan duration
+    (from the first to the last acquisition time stamp) and, for each encoding, the
+    fraction of its k-space lines (as given by the header's encodingLimits, else the
+    range of lines acquired) that were acquired.
+
+    Only the acquisition headers of the 'data' dataset are read, acquisitions_per_chunk
+    at a time, and the statistics are computed on whole chunks with NumPy. Datasets
+    without acquisitions give no fields."""
+    with open_mrd_file(mrd_file) as opened_file:
+        dataset = opened_file.h5[dataset_name]
+        if "data" not in dataset:
+            return {}
+        data = dataset["data"]
+        n_acquisitions = data.shape[0]
+        if n_acquisitions == 0:
+            return {}
+        encoded_lines = _encoded_lines(opened_file.read_xml_header(dataset_name))
+
+        n_noise = n_calibration = 0
+        first_time_stamp = int(np.iinfo(np.uint32).max)
+        last_time_stamp = 0
+        # Per chunk, unique (encoding, step 1, step 2) keys of the imaging lines
+        chunk_keys = []
+        head_fields = data.fields("head")
+        for start in range(0, n_acquisitions, acquisitions_per_chunk):
+            head = head_fields[start : start + acquisitions_per_chunk]
+            flags = head["flags"]
+            n_noise += int(np.count_nonzero(flags & ACQ_IS_NOISE_MEASUREMENT))
+            n_calibration += int(
+                np.count_nonzero(
+                    flags
+                    & (
+                        ACQ_IS_PARALLEL_CALIBRATION
+                        | ACQ_IS_PARALLEL_CALIBRATION_AND_IMAGING
+                    )
+                )
+            )
+
+            time_stamps = head["acquisition_time_stamp"]
+            first_time_stamp = min(first_time_stamp, int(time_stamps.min()))
+            last_time_stamp = max(last_time_stamp, int(time_stamps.max()))
+
+            imaging = (flags & _NON_IMAGING_FLAGS) == 0
+            idx = head["idx"][imaging]
+            chunk_keys.append(
+                np.unique(
+                    (head["encoding_space_ref"][imaging].astype(np.uint64) << 32)
+                    | (idx["kspace_encode_step_1"].astype(np.uint64) << 16)
+                    | idx["kspace_encode_step_2"].astype(np.uint64)
+                )
+            )
+
+    line_keys = np.unique(np.concatenate(chunk_keys))
+    encodings = line_keys >> 32
+    coverage = []
+    for encoding in range(max(len(encoded_lines), int(encodings.max(initial=0)) + 1)):
+        keys = line_keys[encodings == encoding]
+        n_lines = encoded_lines[encoding] if encoding < len(encoded_lines) else None
+        if n_lines is None:
+            if len(keys) == 0:
+                coverage.append(0.0)
+                continue
+            # No limits in the header - use the range of lines acquired
+            steps_1 = (keys >> 16) & 0xFFFF
+            steps_2 = keys & 0xFFFF
+            n_lines = int(steps_1.max() - steps_1.min() + 1) * int(
+                steps_2.max() - steps_2.min() + 1
+            )
+        coverage.append(len(keys) / n_lines)
+
+    return {
+        f"{_STATISTICS_PREFIX}/numberOfAcquisitions": n_acquisitions,
+        f"{_STATISTICS_PREFIX}/numberOfNoiseScans": n_noise,
+        f"{_STATISTICS_PREFIX}/numberOfCalibrationScans": n_calibration,
+        f"{_STATISTICS_PREFIX}/scanDuration_s": float(
+            (last_time_stamp - first_time_stamp) * time_stamp_tick_seconds
+        ),
+        f"{_STATISTICS_PREFIX}/kspaceLineCoverage": ", ".join(
+            f"{fraction:.4f}" for fraction in coverage
+        ),
+    }
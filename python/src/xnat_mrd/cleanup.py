@@ -0,0 +1,173 @@
+import datetime
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Optional, Union
+
+from xnat_mrd.session import (
+    XnatSessionManager,
+    connection_pool,
+    resolve_session,
+)
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+# Log progress every this many deleted subjects
+PROGRESS_INTERVAL = 100
+
+
+@dataclass
+class SubjectInfo:
+    """A subject as listed by XNAT"""
+
+    label: str
+    uri: str
+    insert_date: Optional[datetime.datetime] = None
+
+
+@dataclass
+class CleanupSummary:
+    """Deleted and failed subjects, and overall throughput of a cleanup run"""
+
+    deleted: list[str] = field(default_factory=list)
+    # Subject label -> error
+    failed: dict[str, str] = field(default_factory=dict)
+    wall_seconds: float = 0.0
+
+    @property
+    def n_deleted(self) -> int:
+        return len(self.deleted)
+
+    @property
+    def n_failed(self) -> int:
+        return len(self.failed)
+
+    @property
+    def subjects_per_second(self) -> float:
+        return self.n_deleted / self.wall_seconds if self.wall_seconds else 0.0
+
+    def log(self) -> None:
+        for label, error in self.failed.items():
+            logger.error(f"{label}: delete failed - {error}")
+        logger.info(
+            f"Deleted {self.n_deleted}/{self.n_deleted + self.n_failed} subjects in "
+            f"{self.wall_seconds:.1f} s ({self.subjects_per_second:.1f} subjects/s)"
+        )
+
+
+def _parse_insert_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        logger.warning(f"Could not parse subject insert date {value!r}")
+        return None
+
+
+def list_subjects(session: "xnat.XNATSession", project_name: str) -> list[SubjectInfo]:
+    """All subjects of project_name, with a single listing request"""
+    response = session.get_json(
+        f"/data/projects/{project_name}/subjects",
+        query={"columns": "label,insert_date,URI"},
+    )
+    return [
+        SubjectInfo(
+            label=row["label"],
+            uri=row.get("URI")
+            or f"/data/projects/{project_name}/subjects/{row['label']}",
+            insert_date=_parse_insert_date(row.get("insert_date")),
+        )
+        for row in response["ResultSet"]["Result"]
+    ]
+
+
+def select_subjects(
+    subjects: list[SubjectInfo],
+    label_prefix: Optional[str] = None,
+    inserted_after: Optional[datetime.datetime] = None,
+    inserted_before: Optional[datetime.datetime] = None,
+) -> list[SubjectInfo]:
+    """The subjects whose label starts with label_prefix and that were inserted in
+    [inserted_after, inserted_before) - filters that are None are not applied. With a
+    date filter, subjects without a known insert date are never selected."""
+    selected = []
+    for subject in subjects:
+        if label_prefix is not None and not subject.label.startswith(label_prefix):
+            continue
+        if inserted_after is not None or inserted_before is not None:
+            if subject.insert_date is None:
+                continue
+            if inserted_after is not None and subject.insert_date < inserted_after:
+                continue
+            if inserted_before is not None and subject.insert_date >= inserted_before:
+                continue
+        selected.append(subject)
+    return selected
+
+
+def delete_subjects(
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+    project_name: str,
+    label_prefix: Optional[str] = None,
+    inserted_after: Optional[datetime.datetime] = None,
+    inserted_before: Optional[datetime.datetime] = None,
+    max_workers: int = 8,
+    dry_run: bool = False,
+    progress: Optional[Callable[[int, int], Any]] = None,
+) -> CleanupSummary:
+    """Delete the subjects of project_name (with their experiments and files) that match
+    the filters of select_subjects, with up to max_workers concurrent DELETE requests.
+    progress is called with (number of subjects done, total) after each subject, and
+    progress and throughput are logged every PROGRESS_INTERVAL subjects. With dry_run,
+    the matching subjects are only listed - as summary.deleted - and not deleted."""
+    session = resolve_session(xnat_session)
+    summary = CleanupSummary()
+    start = time.perf_counter()
+    subjects = select_subjects(
+        list_subjects(session, project_name),
+        label_prefix=label_prefix,
+        inserted_after=inserted_after,
+        inserted_before=inserted_before,
+    )
+    logger.info(f"{len(subjects)} subjects of project {project_name} selected")
+    if dry_run:
+        summary.deleted = [subject.label for subject in subjects]
+        summary.wall_seconds = time.perf_counter() - start
+        return summary
+
+    def delete(subject: SubjectInfo) -> None:
+        resolve_session(xnat_session).delete(subject.uri, query={"removeFiles": "true"})
+
+    # A manager's session already has a large enough pool - otherwise the caller's
+    # session gets one while deleting
+    pool = (
+        nullcontext()
+        if isinstance(xnat_session, XnatSessionManager)
+        else connection_pool(session, max_workers)
+    )
+    with pool, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        deletions = {executor.submit(delete, subject): subject for subject in subjects}
+        for n_done, future in enumerate(as_completed(deletions), start=1):
+            subject = deletions[future]
+            try:
+                future.result()
+                summary.deleted.append(subject.label)
+            except Exception as e:
+                summary.failed[subject.label] = str(e)
+            if progress is not None:
+                progress(n_done, len(subjects))
+            if n_done % PROGRESS_INTERVAL == 0:
+                seconds = time.perf_counter() - start
+                logger.info(
+                    f"{n_done}/{len(subjects)} subjects done, {summary.n_failed} failed "
+                    f"({n_done / seconds:.1f} subjects/s)"
+                )
+
+    summary.wall_seconds = time.perf_counter() - start
+    return summary
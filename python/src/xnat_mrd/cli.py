@@ -0,0 +1,359 @@
+import argparse
+import datetime
+import logging
+import signal
+import sys
+import threading
+from pathlib import Path
+from typing import Optional
+
+from xnat_mrd.cleanup import delete_subjects
+from xnat_mrd.ingest import discover_mrd_files, ingest
+from xnat_mrd.manifest import UploadManifest
+from xnat_mrd.session import XnatSessionManager
+from xnat_mrd.spool import UploadSpool, drain_spool
+from xnat_mrd.timing import get_timing_registry
+from xnat_mrd.watch import watch_folder
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def configure_logging(
+    log_file: Optional[Path] = None, level: int = logging.INFO
+) -> None:
+    """Log to the console and, if log_file is given, also to that file. This is left to
+    entry points, so that importing xnat_mrd has no side effects."""
+    handlers: list[logging.Handler] = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    logging.basicConfig(level=level, format=LOG_FORMAT, handlers=handlers)
+
+
+def _add_connection_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--server", default="http://localhost", help="XNAT server address"
+    )
+    parser.add_argument(
+        "--user", default=None, help="XNAT user (defaults to the .netrc entry)"
+    )
+    parser.add_argument(
+        "--password", default=None, help="XNAT password (defaults to the .netrc entry)"
+    )
+    parser.add_argument("--project", default="mrd", help="XNAT project")
+
+
+def _ingest(args: argparse.Namespace) -> int:
+    mrd_file_paths = discover_mrd_files(args.paths)
+    if not mrd_file_paths:
+        logger.error(f"No mrd files found in {args.paths}")
+        return 1
+    logger.info(f"Found {len(mrd_file_paths)} mrd files")
+
+    manifest = None if args.manifest is None else UploadManifest(args.manifest)
+    # One session (and pool of upload_workers connections) for all files
+    with XnatSessionManager(
+        args.server, args.user, args.password, pool_size=args.upload_workers
+    ) as session_manager:
+        # Connect up front, so that login errors end the run straight away
+        session_manager.get_session()
+        summary = ingest(
+            session_manager,
+            mrd_file_paths,
+            args.project,
+            convert_workers=args.convert_workers,
+            upload_workers=args.upload_workers,
+            experiment_date=args.experiment_date,
+            all_datasets=args.all_datasets,
+            manifest=manifest,
+            profile_dir=args.profile_dir,
+            with_acquisition_statistics=args.acquisition_statistics,
+        )
+    if manifest is not None:
+        manifest.close()
+
+    summary.log()
+    registry = get_timing_registry()
+    if args.metrics_json is not None:
+        args.metrics_json.write_text(registry.to_json())
+    if args.metrics_prometheus is not None:
+        args.metrics_prometheus.write_text(registry.to_prometheus())
+    return 0 if summary.n_failed == 0 else 1
+
+
+def _cleanup(args: argparse.Namespace) -> int:
+    with XnatSessionManager(
+        args.server, args.user, args.password, pool_size=args.workers
+    ) as session_manager:
+        summary = delete_subjects(
+            session_manager,
+            args.project,
+            label_prefix=args.label_prefix,
+            inserted_after=args.inserted_after,
+            inserted_before=args.inserted_before,
+            max_workers=args.workers,
+            dry_run=args.dry_run,
+        )
+
+    if args.dry_run:
+        for label in summary.deleted:
+            print(label)
+        logger.info(f"{summary.n_deleted} subjects would be deleted")
+        return 0
+    summary.log()
+    return 0 if summary.n_failed == 0 else 1
+
+
+def _spool(args: argparse.Namespace) -> int:
+    with (
+        UploadSpool(args.spool) as spool,
+        XnatSessionManager(args.server, args.user, args.password) as session_manager,
+    ):
+        for path in discover_mrd_files(args.paths):
+            spool.enqueue(path, args.project, experiment_date=args.experiment_date)
+        summary = drain_spool(
+            spool,
+            session_manager,
+            max_jobs_per_second=args.max_jobs_per_second,
+            stop_when_idle=not args.follow,
+        )
+        pending = spool.next_attempt_at()
+
+    logger.info(
+        f"{len(summary.completed)} uploads completed, {len(summary.retried)} failed "
+        f"attempts to retry, {len(summary.failed)} uploads failed"
+    )
+    if pending is not None:
+        logger.info("Uploads are still waiting for a retry - run again to resume them")
+    return 0 if not summary.failed else 1
+
+
+def _watch(args: argparse.Namespace) -> int:
+    stop_event = threading.Event()
+
+    def stop(signum, frame) -> None:
+        logger.info(f"Received signal {signum} - finishing uploads in progress")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    manifest = None if args.manifest is None else UploadManifest(args.manifest)
+    with XnatSessionManager(
+        args.server, args.user, args.password, pool_size=args.upload_workers
+    ) as session_manager:
+        summary = watch_folder(
+            session_manager,
+            args.directory,
+            args.project,
+            experiment_date=args.experiment_date,
+            upload_workers=args.upload_workers,
+            stable_seconds=args.stable_seconds,
+            poll_seconds=args.poll_seconds,
+            use_inotify=False if args.no_inotify else None,
+            process_existing=not args.new_only,
+            manifest=manifest,
+            stop_event=stop_event,
+        )
+    if manifest is not None:
+        manifest.close()
+
+    summary.log()
+    return 0 if summary.n_failed == 0 else 1
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="xnat-mrd", description="Upload MRD raw data to XNAT"
+    )
+    parser.add_argument(
+        "--log-file", type=Path, default=None, help="Also write the log to this file"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="Convert and upload all mrd files in directories / glob patterns"
+    )
+    ingest_parser.add_argument(
+        "paths", nargs="+", help="Directories (searched recursively) or glob patterns"
+    )
+    _add_connection_arguments(ingest_parser)
+    ingest_parser.add_argument(
+        "--convert-workers",
+        type=int,
+        default=None,
+        help="Number of processes converting headers (default: number of CPUs)",
+    )
+    ingest_parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=4,
+        help="Number of concurrent uploads (default: 4)",
+    )
+    ingest_parser.add_argument(
+        "--experiment-date", default="2022-05-04", help="Date of created experiments"
+    )
+    ingest_parser.add_argument(
+        "--all-datasets",
+        action="store_true",
+        help="Upload every dataset of multi-dataset files as a separate scan",
+    )
+    ingest_parser.add_argument(
+        "--acquisition-statistics",
+        action="store_true",
+        help="Add statistics of the acquisitions (number of acquisitions, noise and "
+        "calibration scans, scan duration, k-space line coverage) to the scan fields",
+    )
+    ingest_parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="SQLite file recording uploaded files - files already recorded in it "
+        "are skipped",
+    )
+    ingest_parser.add_argument(
+        "--profile-dir",
+        type=Path,
+        default=None,
+        help="Write cProfile stats of the conversion and upload of each file here",
+    )
+    ingest_parser.add_argument(
+        "--metrics-json",
+        type=Path,
+        default=None,
+        help="Write per-stage timing histograms as JSON to this file",
+    )
+    ingest_parser.add_argument(
+        "--metrics-prometheus",
+        type=Path,
+        default=None,
+        help="Write per-stage timing histograms in the Prometheus text format to "
+        "this file (e.g. for the node exporter's textfile collector)",
+    )
+    ingest_parser.set_defaults(func=_ingest)
+
+    spool_parser = subparsers.add_parser(
+        "spool",
+        help="Add mrd files to a durable upload spool and upload its due jobs, "
+        "resuming interrupted uploads from their last completed step",
+    )
+    spool_parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Directories (searched recursively) or glob patterns to add to the spool",
+    )
+    _add_connection_arguments(spool_parser)
+    spool_parser.add_argument(
+        "--spool",
+        type=Path,
+        required=True,
+        help="SQLite file journaling the state of each upload",
+    )
+    spool_parser.add_argument(
+        "--experiment-date", default="2022-05-04", help="Date of created experiments"
+    )
+    spool_parser.add_argument(
+        "--max-jobs-per-second",
+        type=float,
+        default=None,
+        help="Start at most this many uploads per second (default: no limit)",
+    )
+    spool_parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Keep running, uploading jobs as their retries become due",
+    )
+    spool_parser.set_defaults(func=_spool)
+
+    watch_parser = subparsers.add_parser(
+        "watch",
+        help="Upload mrd files as soon as they are written to a directory, until "
+        "interrupted",
+    )
+    watch_parser.add_argument(
+        "directory", type=Path, help="Directory to watch (with its subdirectories)"
+    )
+    _add_connection_arguments(watch_parser)
+    watch_parser.add_argument(
+        "--experiment-date", default="2022-05-04", help="Date of created experiments"
+    )
+    watch_parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=2,
+        help="Number of concurrent uploads (default: 2)",
+    )
+    watch_parser.add_argument(
+        "--stable-seconds",
+        type=float,
+        default=0.5,
+        help="Upload a file once its size has not changed for this long (default: 0.5)",
+    )
+    watch_parser.add_argument(
+        "--poll-seconds",
+        type=float,
+        default=1.0,
+        help="Rescan interval when inotify is not used (default: 1)",
+    )
+    watch_parser.add_argument(
+        "--no-inotify",
+        action="store_true",
+        help="Poll the directory instead of using inotify events",
+    )
+    watch_parser.add_argument(
+        "--new-only",
+        action="store_true",
+        help="Ignore files already in the directory when starting",
+    )
+    watch_parser.add_argument(
+        "--manifest",
+        type=Path,
+        default=None,
+        help="SQLite file recording uploaded files - files already recorded in it "
+        "are skipped",
+    )
+    watch_parser.set_defaults(func=_watch)
+
+    cleanup_parser = subparsers.add_parser(
+        "cleanup",
+        help="Delete subjects (with their experiments and files) from a project",
+    )
+    _add_connection_arguments(cleanup_parser)
+    cleanup_parser.add_argument(
+        "--label-prefix",
+        default=None,
+        help="Only delete subjects whose label starts with this, e.g. Subj-",
+    )
+    cleanup_parser.add_argument(
+        "--inserted-after",
+        type=datetime.datetime.fromisoformat,
+        default=None,
+        help="Only delete subjects inserted at or after this ISO date / time",
+    )
+    cleanup_parser.add_argument(
+        "--inserted-before",
+        type=datetime.datetime.fromisoformat,
+        default=None,
+        help="Only delete subjects inserted before this ISO date / time",
+    )
+    cleanup_parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Number of concurrent deletions (default: 8)",
+    )
+    cleanup_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only list the subjects that would be deleted",
+    )
+    cleanup_parser.set_defaults(func=_cleanup)
+
+    args = parser.parse_args(argv)
+    configure_logging(args.log_file)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
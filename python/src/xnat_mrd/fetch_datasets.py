@@ -1,62 +1,160 @@
-from typing import Optional
-import pooch
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import pooch
+
+logger = logging.getLogger(__name__)
+
+TEST_DATA_DIR = Path(__file__).parents[3] / "test-data"
+
+# File listings of Zenodo records, cached so that fetching is offline once the files
+# themselves are cached
+REGISTRY_CACHE_DIR = TEST_DATA_DIR / "registries"
+
+# Set to 1 to fail straight away, rather than going to Zenodo, for files not cached
+OFFLINE_ENV_VAR = "XNAT_MRD_OFFLINE"
+
+
+@dataclass(frozen=True)
+class ZenodoFile:
+    """A file of a Zenodo record - or, if zip_member is given, a member of the zip file
+    file_name"""
+
+    doi: str
+    file_name: str
+    zip_member: Optional[str] = None
+
+    @property
+    def local_path(self) -> Path:
+        """Where the file is cached"""
+        if self.zip_member is None:
+            return TEST_DATA_DIR / self.file_name
+        return TEST_DATA_DIR / f"{self.file_name}.unzip" / self.zip_member
+
 
+SINGLEDATA = ZenodoFile(
+    "doi:10.5281/zenodo.2633785",
+    "PTB_ACRPhantom_GRAPPA.zip",
+    zip_member="PTB_ACRPhantom_GRAPPA/ptb_resolutionphantom_fully_ismrmrd.h5",
+)
+MULTIDATA = ZenodoFile("doi:10.5281/zenodo.15223816", "cart_t1_msense_integrated.mrd")
+ALL_DATASETS = (SINGLEDATA, MULTIDATA)
 
-def _set_up_zenodo_doi(base_url: str):
-    ZENODO = pooch.create(
-        path=Path(__file__).parents[3] / "test-data",
-        base_url=base_url,
-        registry=None,
-        retry_if_failed=5,
-    )
-    ZENODO.load_registry_from_doi()
-    return ZENODO
+_zenodo_pooches: dict[str, pooch.Pooch] = {}
+_zenodo_lock = threading.Lock()
 
 
-def _fetch_from_zenodo(
-    base_url: str, image_name: str, zip_file: Optional[str] = None
-) -> Path:
-    """Fetch mrd file from zenodo (if not already cached), and return the file path where
-    data is downloaded"""
+def _offline() -> bool:
+    return os.environ.get(OFFLINE_ENV_VAR, "") not in ("", "0")
 
-    ZENODO = _set_up_zenodo_doi(base_url)
 
-    if zip_file:
-        unpack = pooch.Unzip(members=[image_name])
-        image_path = Path(ZENODO.fetch(f"{zip_file}.zip", processor=unpack)[0])
-    else:
-        image_path = Path(ZENODO.fetch(image_name))
+def _registry_path(doi: str) -> Path:
+    return REGISTRY_CACHE_DIR / (doi.replace(":", "_").replace("/", "_") + ".json")
 
-    return image_path
+
+def get_zenodo(doi: str) -> pooch.Pooch:
+    """The pooch of the Zenodo record doi, created once per process. Its registry is
+    read from REGISTRY_CACHE_DIR, and only loaded from Zenodo (and then cached) the
+    first time."""
+    with _zenodo_lock:
+        zenodo = _zenodo_pooches.get(doi)
+        if zenodo is not None:
+            return zenodo
+
+        zenodo = pooch.create(
+            path=TEST_DATA_DIR, base_url=doi, registry=None, retry_if_failed=5
+        )
+        registry_path = _registry_path(doi)
+        try:
+            cached = json.loads(registry_path.read_text())
+            zenodo.registry.update(cached["registry"])
+            zenodo.urls.update(cached["urls"])
+        except (OSError, ValueError, KeyError):
+            if _offline():
+                raise FileNotFoundError(
+                    f"No cached registry for {doi} and {OFFLINE_ENV_VAR} is set"
+                )
+            zenodo.load_registry_from_doi()
+            registry_path.parent.mkdir(parents=True, exist_ok=True)
+            registry_path.write_text(
+                json.dumps({"registry": zenodo.registry, "urls": zenodo.urls})
+            )
+        _zenodo_pooches[doi] = zenodo
+        return zenodo
+
+
+def fetch(zenodo_file: ZenodoFile) -> Path:
+    """Path of zenodo_file, downloaded (and unzipped) first unless already cached. No
+    request is made for cached files."""
+    if zenodo_file.local_path.exists():
+        return zenodo_file.local_path
+    if _offline():
+        raise FileNotFoundError(
+            f"{zenodo_file.local_path} is not cached and {OFFLINE_ENV_VAR} is set"
+        )
+
+    zenodo = get_zenodo(zenodo_file.doi)
+    if zenodo_file.zip_member is None:
+        return Path(zenodo.fetch(zenodo_file.file_name))
+    unpack = pooch.Unzip(members=[zenodo_file.zip_member])
+    return Path(zenodo.fetch(zenodo_file.file_name, processor=unpack)[0])
+
+
+def prefetch(
+    zenodo_files: Iterable[ZenodoFile] = ALL_DATASETS,
+    max_workers: int = 4,
+    progress: Optional[Callable[[int, int, ZenodoFile], Any]] = None,
+) -> dict[ZenodoFile, Path]:
+    """Fetch zenodo_files in parallel, returning the path of each. progress is called
+    with (number of files done, total, file) as each file is done, and progress is
+    logged. Raises the first error after all other files are fetched."""
+    zenodo_files = list(zenodo_files)
+    paths = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        fetches = {
+            pool.submit(fetch, zenodo_file): zenodo_file for zenodo_file in zenodo_files
+        }
+        for n_done, future in enumerate(as_completed(fetches), start=1):
+            zenodo_file = fetches[future]
+            try:
+                paths[zenodo_file] = future.result()
+                logger.info(
+                    f"{n_done}/{len(zenodo_files)} fetched: {paths[zenodo_file]}"
+                )
+            except Exception as e:
+                errors.append(e)
+                logger.error(f"Fetching {zenodo_file.file_name} failed: {e}")
+            if progress is not None:
+                progress(n_done, len(zenodo_files), zenodo_file)
+
+    if errors:
+        raise errors[0]
+    return paths
 
 
 def get_multidata() -> Path:
     """Fetch mrd file with multiple datasets, or return cached path if already present."""
-    test_data_dir = Path(__file__).parents[3] / "test-data"
-    image_path = test_data_dir / "cart_t1_msense_integrated.mrd"
-    if image_path.exists():
-        return image_path
-    return _fetch_from_zenodo(
-        "doi:10.5281/zenodo.15223816",
-        "cart_t1_msense_integrated.mrd",
-    )
+    return fetch(MULTIDATA)
 
 
 def get_singledata() -> Path:
     """Fetch mrd file with a single dataset, or return cached path if already present."""
+    return fetch(SINGLEDATA)
+
+
+def main():
+    from xnat_mrd.cli import configure_logging
+
+    configure_logging()
+    prefetch()
+
 
-    test_data_dir = (
-        Path(__file__).parents[3]
-        / "test-data"
-        / "PTB_ACRPhantom_GRAPPA.zip.unzip"
-        / "PTB_ACRPhantom_GRAPPA"
-    )
-    image_path = test_data_dir / "ptb_resolutionphantom_fully_ismrmrd.h5"
-    if image_path.exists():
-        return image_path
-    return _fetch_from_zenodo(
-        "doi:10.5281/zenodo.2633785",
-        "PTB_ACRPhantom_GRAPPA/ptb_resolutionphantom_fully_ismrmrd.h5",
-        zip_file="PTB_ACRPhantom_GRAPPA",
-    )
+if __name__ == "__main__":
+    main()
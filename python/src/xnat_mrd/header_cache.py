@@ -0,0 +1,208 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional
+
+from xnat_mrd.mrd_2_xnat import HEADER_RULES, mrd_2_xnat
+from xnat_mrd.timing import span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY_ENTRIES = 1024
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_version(schema_path: str, mtime_ns: int, size: int) -> str:
+    """Digest identifying the conversion: the schema contents and the header rules"""
+    hasher = hashlib.sha256(Path(schema_path).read_bytes())
+    hasher.update(repr(HEADER_RULES).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def header_cache_key(ismrmrd_header: bytes, xml_schema_filepath: Path) -> str:
+    """Content address of a converted header: SHA-256 of the header bytes and of the
+    schema version it is converted with"""
+    schema_path = Path(xml_schema_filepath).resolve()
+    stat = schema_path.stat()
+    hasher = hashlib.sha256(ismrmrd_header)
+    hasher.update(
+        _schema_version(str(schema_path), stat.st_mtime_ns, stat.st_size).encode()
+    )
+    return hasher.hexdigest()
+
+
+class HeaderCache:
+    """Cache of converted (XNAT format) headers, keyed by header_cache_key. A
+    least-recently-used in-memory tier of memory_entries headers sits in front of an
+    optional on-disk tier in cache_dir (shared between processes), which is kept below
+    max_disk_bytes by evicting the least recently used files."""
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        memory_entries: int = DEFAULT_MEMORY_ENTRIES,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+    ):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        self._disk_bytes: Optional[int] = None
+        self._stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        assert self.cache_dir is not None
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, xnat_hdr: dict[str, Any]) -> None:
+        self._memory[key] = xnat_hdr
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        """Return a copy of the cached header for key, or None if it isn't cached"""
+        with self._lock:
+            xnat_hdr = self._memory.get(key)
+            if xnat_hdr is not None:
+                self._memory.move_to_end(key)
+                self._stats["hits"] += 1
+                return dict(xnat_hdr)
+
+            if self.cache_dir is not None:
+                path = self._path(key)
+                try:
+                    xnat_hdr = json.loads(path.read_text())
+                    # The modification time records the last use, for eviction
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable header cache file {path}: {e}")
+
+            if xnat_hdr is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._stats["disk_hits"] += 1
+            self._remember(key, xnat_hdr)
+            return dict(xnat_hdr)
+
+    def put(self, key: str, xnat_hdr: dict[str, Any]) -> None:
+        """Store a copy of xnat_hdr under key"""
+        with self._lock:
+            self._remember(key, dict(xnat_hdr))
+            if self.cache_dir is None:
+                return
+
+            path = self._path(key)
+            data = json.dumps(xnat_hdr).encode("utf-8")
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(
+                    f".{os.getpid()}-{threading.get_ident()}.tmp"
+                )
+                tmp_path.write_bytes(data)
+                tmp_path.replace(path)
+            except Exception as e:
+                logger.warning(f"Could not write header cache file {path}: {e}")
+                return
+
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(
+                    cached.stat().st_size for cached in self._iter_disk_files()
+                )
+            else:
+                self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+    def _iter_disk_files(self):
+        assert self.cache_dir is not None
+        return self.cache_dir.glob("*/*.json")
+
+    def _evict(self) -> None:
+        """Delete least recently used files until the disk tier is at most 90% of
+        max_disk_bytes (so that eviction doesn't run on every put)"""
+        files = []
+        for path in self._iter_disk_files():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        target = self.max_disk_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            self._stats["evictions"] += 1
+        self._disk_bytes = total
+
+    def info(self) -> dict[str, int]:
+        """Return hit / miss / eviction counters and the current size of both tiers.
+        Hits served from disk are also counted in disk_hits."""
+        with self._lock:
+            return {
+                **self._stats,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes or 0,
+            }
+
+    def clear(self) -> None:
+        """Drop all cached headers, in memory and on disk"""
+        with self._lock:
+            self._memory.clear()
+            if self.cache_dir is not None:
+                for path in self._iter_disk_files():
+                    path.unlink(missing_ok=True)
+            self._disk_bytes = 0
+            for counter in self._stats:
+                self._stats[counter] = 0
+
+
+_default_cache: Optional[HeaderCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_header_cache() -> HeaderCache:
+    """The header cache of this process. It keeps converted headers on disk in the
+    directory given by the XNAT_MRD_HEADER_CACHE_DIR environment variable, if set -
+    otherwise only in memory."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            cache_dir = os.environ.get("XNAT_MRD_HEADER_CACHE_DIR")
+            _default_cache = HeaderCache(Path(cache_dir) if cache_dir else None)
+        return _default_cache
+
+
+@span("header_convert")
+def cached_mrd_2_xnat(
+    ismrmrd_header: bytes,
+    xml_schema_filepath: Path,
+    cache: Optional[HeaderCache] = None,
+) -> dict[str, Any]:
+    """mrd_2_xnat, returning the cached result for byte-identical headers converted
+    with the same schema before. Only headers that passed validation are cached, so
+    repeats skip both validation and flattening. cache defaults to get_header_cache()."""
+    if cache is None:
+        cache = get_header_cache()
+
+    key = header_cache_key(ismrmrd_header, xml_schema_filepath)
+    xnat_hdr = cache.get(key)
+    if xnat_hdr is None:
+        xnat_hdr = mrd_2_xnat(ismrmrd_header, xml_schema_filepath)
+        cache.put(key, xnat_hdr)
+    return xnat_hdr
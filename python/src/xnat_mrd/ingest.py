@@ -0,0 +1,406 @@
+import glob
+import logging
+import multiprocessing
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Optional, Union
+
+from xnat_mrd.manifest import ManifestEntry, UploadManifest, header_digest
+from xnat_mrd.mrd_file import MrdFile, open_mrd_file
+from xnat_mrd.populate_datatype_fields import (
+    convert_all_datasets,
+    convert_mrd_file,
+    upload_mrd_data,
+)
+from xnat_mrd.session import XnatSessionManager, resolve_session
+from xnat_mrd.timing import get_timing_registry, profile_to, span
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+MRD_FILE_SUFFIXES = (".mrd", ".h5", ".hdf5")
+
+
+@dataclass
+class IngestResult:
+    """Outcome of ingesting a single mrd file"""
+
+    path: Path
+    size_bytes: int
+    ok: bool = False
+    skipped: bool = False
+    convert_seconds: float = 0.0
+    upload_seconds: float = 0.0
+    error: Optional[str] = None
+    # For skipped files, where the same contents were uploaded before
+    uploaded_to: Optional[str] = None
+
+
+@dataclass
+class IngestSummary:
+    """Per-file results and overall throughput of an ingest run"""
+
+    results: list[IngestResult] = field(default_factory=list)
+    wall_seconds: float = 0.0
+
+    @property
+    def n_succeeded(self) -> int:
+        return sum(result.ok and not result.skipped for result in self.results)
+
+    @property
+    def n_skipped(self) -> int:
+        return sum(result.skipped for result in self.results)
+
+    @property
+    def n_failed(self) -> int:
+        return len(self.results) - self.n_succeeded - self.n_skipped
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(
+            result.size_bytes
+            for result in self.results
+            if result.ok and not result.skipped
+        )
+
+    @property
+    def files_per_second(self) -> float:
+        return self.n_succeeded / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        if not self.wall_seconds:
+            return 0.0
+        return self.total_bytes / 1e6 / self.wall_seconds
+
+    def log(self) -> None:
+        for result in self.results:
+            if result.skipped:
+                logger.info(f"{result.path}: skipped - same as {result.uploaded_to}")
+            elif result.ok:
+                logger.info(
+                    f"{result.path}: uploaded {result.size_bytes / 1e6:.1f} MB "
+                    f"(convert {result.convert_seconds:.2f} s, upload {result.upload_seconds:.2f} s)"
+                )
+            else:
+                logger.error(f"{result.path}: failed - {result.error}")
+        logger.info(
+            f"Ingested {self.n_succeeded}/{len(self.results)} files "
+            f"({self.n_skipped} already uploaded) in {self.wall_seconds:.1f} s "
+            f"({self.files_per_second:.2f} files/s, {self.mb_per_second:.1f} MB/s)"
+        )
+
+
+def discover_mrd_files(patterns: Iterable[str]) -> list[Path]:
+    """Find mrd files from a list of directories (searched recursively) and / or glob
+    patterns. Only files that are HDF5 files are returned, each path at most once."""
+    import h5py
+
+    candidates: list[Path] = []
+    for pattern in patterns:
+        pattern_path = Path(pattern)
+        if pattern_path.is_dir():
+            candidates.extend(
+                sorted(
+                    path
+                    for path in pattern_path.rglob("*")
+                    if path.suffix.lower() in MRD_FILE_SUFFIXES
+                )
+            )
+        else:
+            candidates.extend(
+                sorted(Path(path) for path in glob.glob(pattern, recursive=True))
+            )
+
+    mrd_files = []
+    seen = set()
+    for path in candidates:
+        resolved = path.resolve()
+        if resolved in seen or not path.is_file():
+            continue
+        seen.add(resolved)
+        if h5py.is_hdf5(path):
+            mrd_files.append(path)
+        else:
+            logger.warning(f"Skipping {path} - not an HDF5 file")
+
+    return mrd_files
+
+
+def conversion_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """A pool of processes for converting headers while other threads upload files.
+    Its workers are not forked from this (multi-threaded) process, where a lock held
+    by another thread - e.g. in h5py - would stay locked forever in the child."""
+    start_method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    return ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context(start_method)
+    )
+
+
+def _timed_convert(
+    mrd_file_path: Path,
+    all_datasets: bool,
+    profile_path: Optional[Path] = None,
+    with_acquisition_statistics: bool = False,
+) -> tuple[dict[str, Any], float, dict[str, dict[str, Any]]]:
+    """Convert the header of mrd_file_path (or with all_datasets, the headers of all its
+    datasets), returning it with the time taken and the stage timings recorded while
+    converting. Runs in a worker process."""
+    # The worker's registry only holds this conversion, to be merged by the parent
+    registry = get_timing_registry()
+    registry.reset()
+    start = time.perf_counter()
+    with profile_to(profile_path), span("convert"):
+        if all_datasets:
+            # Files are already converted in parallel, so don't start a nested pool
+            xnat_hdr = convert_all_datasets(
+                mrd_file_path,
+                max_workers=1,
+                with_acquisition_statistics=with_acquisition_statistics,
+            )
+        else:
+            xnat_hdr = convert_mrd_file(
+                mrd_file_path, with_acquisition_statistics=with_acquisition_statistics
+            )
+    return xnat_hdr, time.perf_counter() - start, registry.snapshot()
+
+
+def timed_upload(
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+    result: IngestResult,
+    xnat_hdr: dict[str, Any],
+    project_name: str,
+    experiment_date: str,
+    all_datasets: bool,
+    manifest: Optional[UploadManifest] = None,
+    content_sha256: str = "",
+    profile_path: Optional[Path] = None,
+    mrd_file: Optional[MrdFile] = None,
+) -> IngestResult:
+    """Upload result.path with its converted xnat_hdr (see upload_mrd_data), recording
+    the outcome and time taken in result and, if it succeeds, the upload in manifest.
+    mrd_file can be the file already open.
+
+    The upload is recorded under the SHA-256 of the bytes actually uploaded, computed
+    while they are sent (see MrdFile.checksum) - a warning is logged if it differs
+    from content_sha256, the hash the file was looked up with before uploading."""
+    start = time.perf_counter()
+    try:
+        # A manager refreshes its session here if it is about to expire
+        xnat_session = resolve_session(xnat_session)
+        with (
+            profile_to(profile_path),
+            span("upload"),
+            open_mrd_file(mrd_file or result.path) as opened_file,
+        ):
+            if all_datasets:
+                experiment = upload_mrd_data(
+                    xnat_session,
+                    opened_file,
+                    project_name,
+                    experiment_date=experiment_date,
+                    all_datasets=True,
+                    xnat_hdrs=xnat_hdr,
+                )
+            else:
+                experiment = upload_mrd_data(
+                    xnat_session,
+                    opened_file,
+                    project_name,
+                    experiment_date=experiment_date,
+                    xnat_hdr=xnat_hdr,
+                )
+            if manifest is not None:
+                uploaded_sha256 = opened_file.checksum("sha256")
+        result.ok = True
+        if manifest is not None:
+            if content_sha256 and uploaded_sha256 != content_sha256:
+                logger.warning(f"{result.path} changed while it was uploaded")
+            manifest.record(
+                ManifestEntry(
+                    server=xnat_session.server,
+                    project=project_name,
+                    content_sha256=uploaded_sha256,
+                    header_sha256=header_digest(xnat_hdr),
+                    path=str(result.path),
+                    size_bytes=result.size_bytes,
+                    experiment=experiment.label,
+                    experiment_uri=experiment.uri,
+                )
+            )
+    except Exception as e:
+        result.error = f"upload failed: {e}"
+    result.upload_seconds = time.perf_counter() - start
+    return result
+
+
+def ingest(
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+    mrd_file_paths: list[Path],
+    project_name: str,
+    convert_workers: Optional[int] = None,
+    upload_workers: int = 4,
+    experiment_date: str = "2022-05-04",
+    all_datasets: bool = False,
+    manifest: Optional[UploadManifest] = None,
+    profile_dir: Optional[Path] = None,
+    with_acquisition_statistics: bool = False,
+) -> IngestSummary:
+    """Convert and upload many mrd files. Headers are converted in a pool of
+    convert_workers processes (header conversion is CPU bound) and each converted file is
+    uploaded through a pool of upload_workers threads sharing xnat_session, so uploads
+    overlap with the conversion of later files. xnat_session can also be a
+    XnatSessionManager, whose session is then checked out (and refreshed if needed) for
+    every upload. With all_datasets, every dataset of a
+    file is uploaded as a separate scan (see upload_mrd_data).
+
+    If a manifest is given, files whose contents were already uploaded to the same
+    server and project are skipped, and new uploads are recorded in it.
+
+    Stage timings, including those recorded in the conversion processes, are collected
+    in the timing registry (see xnat_mrd.timing). If profile_dir is given, the
+    conversion and upload of each file are profiled with cProfile, writing
+    {index}-{file name}.convert.prof / .upload.prof files there.
+
+    With with_acquisition_statistics, statistics of the acquisitions of each file
+    (see xnat_mrd.acquisition_stats) are added to its scan fields."""
+    registry = get_timing_registry()
+    summary = IngestSummary()
+    start = time.perf_counter()
+    server = resolve_session(xnat_session).server if manifest is not None else ""
+
+    with (
+        conversion_pool(convert_workers) as convert_pool,
+        ThreadPoolExecutor(max_workers=upload_workers) as upload_pool,
+    ):
+        # The file each hashing, conversion and upload future is for
+        hashings: dict[Future, IngestResult] = {}
+        conversions: dict[Future, IngestResult] = {}
+        uploads: dict[Future, IngestResult] = {}
+        content_hashes: dict[Path, str] = {}
+        # Per content hash of a file being uploaded, the copies of it found later in
+        # this run - skipped once it is uploaded
+        copies: dict[str, list[IngestResult]] = {}
+        profile_paths: dict[Path, tuple[Path, Path]] = {}
+
+        def submit_conversion(result: IngestResult) -> Future:
+            future = convert_pool.submit(
+                _timed_convert,
+                result.path,
+                all_datasets,
+                profile_paths.get(result.path, (None, None))[0],
+                with_acquisition_statistics,
+            )
+            conversions[future] = result
+            return future
+
+        def original_done(result: IngestResult) -> Optional[Future]:
+            """Skip the copies of a file once it is uploaded. If its upload failed, the
+            next copy is uploaded instead - returning its conversion."""
+            content_sha256 = content_hashes.get(result.path)
+            if content_sha256 is None:
+                return None
+            waiting = copies.pop(content_sha256, [])
+            if result.ok:
+                for copy in waiting:
+                    copy.uploaded_to = str(result.path)
+                    copy.ok = copy.skipped = True
+                return None
+            if not waiting:
+                return None
+            if result.error is not None and result.error.startswith(
+                "header conversion"
+            ):
+                # Copies have the same header, so their conversion would fail too
+                for copy in waiting:
+                    copy.error = result.error
+                return None
+            copies[content_sha256] = waiting[1:]
+            return submit_conversion(waiting[0])
+
+        for index, path in enumerate(mrd_file_paths):
+            if profile_dir is not None:
+                profile_stem = Path(profile_dir) / f"{index:05d}-{path.name}"
+                profile_paths[path] = (
+                    profile_stem.with_name(f"{profile_stem.name}.convert.prof"),
+                    profile_stem.with_name(f"{profile_stem.name}.upload.prof"),
+                )
+            result = IngestResult(path=path, size_bytes=path.stat().st_size)
+            summary.results.append(result)
+            if manifest is None:
+                submit_conversion(result)
+            else:
+                # Files are hashed in the upload threads, in parallel with each other
+                # and with conversions
+                hashings[upload_pool.submit(manifest.content_hash, path)] = result
+
+        pending = set(hashings) | set(conversions)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in hashings:
+                    result = hashings.pop(future)
+                    try:
+                        content_sha256 = future.result()
+                    except Exception as e:
+                        result.error = f"hashing failed: {e}"
+                        continue
+                    content_hashes[result.path] = content_sha256
+                    assert manifest is not None
+                    uploaded = manifest.find(server, project_name, content_sha256)
+                    if uploaded is not None:
+                        result.uploaded_to = uploaded.experiment_uri
+                        result.ok = result.skipped = True
+                    elif content_sha256 in copies:
+                        # A copy of a file being uploaded in this run
+                        copies[content_sha256].append(result)
+                    else:
+                        copies[content_sha256] = []
+                        pending.add(submit_conversion(result))
+                    continue
+
+                if future in uploads:
+                    next_conversion = original_done(uploads.pop(future))
+                    if next_conversion is not None:
+                        pending.add(next_conversion)
+                    continue
+
+                result = conversions.pop(future)
+                try:
+                    xnat_hdr, result.convert_seconds, timings = future.result()
+                    registry.merge(timings)
+                except Exception as e:
+                    result.error = f"header conversion failed: {e}"
+                    original_done(result)
+                    continue
+                upload = upload_pool.submit(
+                    timed_upload,
+                    xnat_session,
+                    result,
+                    xnat_hdr,
+                    project_name,
+                    experiment_date,
+                    all_datasets,
+                    manifest,
+                    content_hashes.get(result.path, ""),
+                    profile_paths.get(result.path, (None, None))[1],
+                )
+                uploads[upload] = result
+                pending.add(upload)
+
+    summary.wall_seconds = time.perf_counter() - start
+    return summary
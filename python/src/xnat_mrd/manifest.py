@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from dataclasses import astuple, dataclass, fields
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    server TEXT NOT NULL,
+    project TEXT NOT NULL,
+    content_sha256 TEXT NOT NULL,
+    header_sha256 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    experiment TEXT NOT NULL,
+    experiment_uri TEXT NOT NULL,
+    uploaded_at TEXT NOT NULL,
+    PRIMARY KEY (server, project, content_sha256)
+);
+CREATE INDEX IF NOT EXISTS uploads_by_header ON uploads (server, project, header_sha256);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    size_bytes INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_sha256 TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class ManifestEntry:
+    """Where a previously uploaded mrd file was archived"""
+
+    server: str
+    project: str
+    content_sha256: str
+    header_sha256: str
+    path: str
+    size_bytes: int
+    experiment: str
+    experiment_uri: str
+    uploaded_at: str = ""
+
+
+def header_digest(xnat_hdr: dict[str, Any]) -> str:
+    """SHA-256 of a converted header (independent of key order)"""
+    return hashlib.sha256(
+        json.dumps(xnat_hdr, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class UploadManifest:
+    """Local SQLite index of uploaded mrd files, keyed by server, project and SHA-256 of
+    the file contents, so that re-running an ingest skips files that are already
+    archived. Content hashes are remembered per path, size and modification time, so
+    unchanged files are not read again to look them up. Safe to share between threads."""
+
+    def __init__(self, manifest_path: Path):
+        self.path = Path(manifest_path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+
+    def content_hash(self, mrd_file_path: Path) -> str:
+        """SHA-256 of the contents of mrd_file_path, only re-read when the file changed"""
+        content_sha256 = self.cached_content_hash(mrd_file_path)
+        if content_sha256 is None:
+            with open(mrd_file_path, "rb") as f:
+                content_sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+            self.remember_content_hash(mrd_file_path, content_sha256)
+        return content_sha256
+
+    def cached_content_hash(self, mrd_file_path: Path) -> Optional[str]:
+        """SHA-256 of the contents of mrd_file_path, if known for its current size and
+        modification time"""
+        stat = Path(mrd_file_path).stat()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_sha256 FROM file_hashes "
+                "WHERE path = ? AND size_bytes = ? AND mtime_ns = ?",
+                (
+                    str(Path(mrd_file_path).resolve()),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                ),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def remember_content_hash(self, mrd_file_path: Path, content_sha256: str) -> None:
+        """Remember content_sha256 (computed elsewhere) as the hash of mrd_file_path at
+        its current size and modification time"""
+        stat = Path(mrd_file_path).stat()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                (
+                    str(Path(mrd_file_path).resolve()),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    content_sha256,
+                ),
+            )
+
+    def find(
+        self, server: str, project: str, content_sha256: str
+    ) -> Optional[ManifestEntry]:
+        """The upload of a file with content_sha256 to project on server, if any"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM uploads "
+                "WHERE server = ? AND project = ? AND content_sha256 = ?",
+                (server, project, content_sha256),
+            ).fetchone()
+        return None if row is None else ManifestEntry(*row)
+
+    def find_by_header(
+        self, server: str, project: str, header_sha256: str
+    ) -> list[ManifestEntry]:
+        """All uploads to project on server whose converted header had header_sha256"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM uploads "
+                "WHERE server = ? AND project = ? AND header_sha256 = ?",
+                (server, project, header_sha256),
+            ).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def record(self, entry: ManifestEntry) -> None:
+        """Record a completed upload"""
+        if not entry.uploaded_at:
+            entry.uploaded_at = datetime.now().isoformat(timespec="seconds")
+        placeholders = ", ".join("?" for _ in fields(entry))
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO uploads VALUES ({placeholders})",
+                astuple(entry),
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "UploadManifest":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
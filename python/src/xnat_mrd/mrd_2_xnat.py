@@ -1,290 +1,703 @@
+import functools
+import hashlib
+import importlib.resources
+import io
+import logging
+import os
+import pickle
+import threading
+import warnings
+from enum import Enum
 from pathlib import Path
-from typing import Any, Tuple
-
-import xmlschema
-
-
-def get_dict_values(dict: dict, key_list: list[Any]) -> Any:
-    """Given a dictionary and a list of keys, a new filtered
-    dictionary is returned"""
-    if key_list:
-        result = dict
-        for key in key_list:
-            result = result[key]
-        return result
-    else:
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    cast,
+)
+from xml.etree import ElementTree
+
+from xnat_mrd.timing import span
+
+if TYPE_CHECKING:
+    # xmlschema is slow to import, and only needed once a header is decoded rather
+    # than served from a cache - so it is imported where it is used
+    import xmlschema
+
+logger = logging.getLogger(__name__)
+
+# Compiled schemas, keyed by (resolved path, mtime in ns, size in bytes) of the .xsd file
+_schema_cache: dict[tuple[str, int, int], "xmlschema.XMLSchema"] = {}
+_schema_cache_stats = {"hits": 0, "misses": 0, "disk_hits": 0}
+_schema_cache_lock = threading.Lock()
+
+# (schema url, SHA-256 of header) for headers that passed validation in this process
+_validated_headers: set[tuple[str, str]] = set()
+_MAX_VALIDATED_HEADERS = 100_000
+
+
+def _load_pickled_schema(pickle_path: Path) -> Optional["xmlschema.XMLSchema"]:
+    """Load a previously pickled schema, returning None if it is missing or unreadable"""
+    import xmlschema
+
+    try:
+        with open(pickle_path, "rb") as f:
+            xml_schema = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable schema cache file {pickle_path}: {e}")
         return None
 
+    if not isinstance(xml_schema, xmlschema.XMLSchema):
+        logger.warning(f"Ignoring schema cache file {pickle_path} of wrong type")
+        return None
+    return xml_schema
+
+
+def _save_pickled_schema(xml_schema: "xmlschema.XMLSchema", pickle_path: Path) -> None:
+    """Pickle a compiled schema, writing to a temporary file first so concurrent
+    workers never read a partially written file"""
+    try:
+        pickle_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = pickle_path.with_suffix(
+            f".{os.getpid()}-{threading.get_ident()}.tmp"
+        )
+        with open(tmp_path, "wb") as f:
+            pickle.dump(xml_schema, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(pickle_path)
+    except Exception as e:
+        logger.warning(f"Could not write schema cache file {pickle_path}: {e}")
+
+
+def get_xml_schema(
+    xml_schema_filename: Path, cache_dir: Optional[Path] = None
+) -> "xmlschema.XMLSchema":
+    """Return the compiled xmlschema object for xml_schema_filename, compiling each schema
+    only once per process. Schemas are keyed by path, modification time and size, so an
+    edited .xsd file is recompiled. If cache_dir is given, compiled schemas are also pickled
+    there so that new processes can skip compilation - this defaults to the
+    XNAT_MRD_SCHEMA_CACHE_DIR environment variable, if set."""
+    import xmlschema
+
+    if cache_dir is None and os.environ.get("XNAT_MRD_SCHEMA_CACHE_DIR"):
+        cache_dir = Path(os.environ["XNAT_MRD_SCHEMA_CACHE_DIR"])
+
+    schema_path = Path(xml_schema_filename).resolve()
+    stat = schema_path.stat()
+    key = (str(schema_path), stat.st_mtime_ns, stat.st_size)
+
+    with _schema_cache_lock:
+        xml_schema = _schema_cache.get(key)
+        if xml_schema is not None:
+            _schema_cache_stats["hits"] += 1
+            return xml_schema
+        _schema_cache_stats["misses"] += 1
+
+        pickle_path = None
+        if cache_dir is not None:
+            digest = hashlib.sha256(
+                f"{key}-{xmlschema.__version__}".encode("utf-8")
+            ).hexdigest()
+            pickle_path = Path(cache_dir) / f"{schema_path.stem}-{digest[:16]}.pickle"
+            xml_schema = _load_pickled_schema(pickle_path)
+
+        if xml_schema is not None:
+            _schema_cache_stats["disk_hits"] += 1
+        else:
+            logger.info(f"Compiling xml schema {schema_path}")
+            with span("schema_compile"):
+                xml_schema = xmlschema.XMLSchema(schema_path)
+            if pickle_path is not None:
+                _save_pickled_schema(xml_schema, pickle_path)
+
+        _schema_cache[key] = xml_schema
+        return xml_schema
+
+
+def schema_cache_info() -> dict[str, int]:
+    """Return hit / miss counters and current size of the compiled schema cache. Misses
+    that were served from the on-disk cache are also counted in disk_hits."""
+    with _schema_cache_lock:
+        return {**_schema_cache_stats, "currsize": len(_schema_cache)}
+
+
+def clear_schema_cache() -> None:
+    """Drop all compiled schemas held in memory and reset the cache counters"""
+    with _schema_cache_lock:
+        _schema_cache.clear()
+        for counter in _schema_cache_stats:
+            _schema_cache_stats[counter] = 0
+
+
+class RuleAction(Enum):
+    DROP = "drop"  # skip the element and everything below it
+    FIRST = "first"  # keep only the first occurrence of a repeated element
+    JOIN = "join"  # concatenate all values into the list field given as target
+    RENAME = "rename"  # use target as the element name in the XNAT field
+
+
+class HeaderRule(NamedTuple):
+    """A rule for the header element at path - a tuple of element names from the header
+    root, ignoring list indices"""
+
+    path: tuple[str, ...]
+    action: RuleAction
+    target: str = ""
+
+
+HEADER_RULES = (
+    # Coil labels and waveform types are summarised as single string fields
+    HeaderRule(
+        ("acquisitionSystemInformation", "coilLabel", "coilNumber"), RuleAction.DROP
+    ),
+    HeaderRule(
+        ("acquisitionSystemInformation", "coilLabel", "coilName"),
+        RuleAction.JOIN,
+        "acquisitionSystemInformation/coilLabelList",
+    ),
+    HeaderRule(("waveformInformation", "waveformName"), RuleAction.DROP),
+    HeaderRule(("waveformInformation", "userParameters"), RuleAction.DROP),
+    HeaderRule(
+        ("waveformInformation", "waveformType"),
+        RuleAction.JOIN,
+        "waveformInformationList",
+    ),
+    # Only the first encoding is stored in XNAT
+    HeaderRule(("encoding",), RuleAction.FIRST),
+    HeaderRule(("encoding", "trajectoryDescription"), RuleAction.DROP),
+    HeaderRule(("encoding", "multiband", "spacing"), RuleAction.DROP),
+    HeaderRule(
+        ("encoding", "parallelImaging", "multiband", "spacing"), RuleAction.DROP
+    ),
+    # These field names seem to be too long for xnat
+    HeaderRule(
+        ("encoding", "parallelImaging", "accelerationFactor", "kspace_encoding_step_1"),
+        RuleAction.RENAME,
+        "kspace_enc_step_1",
+    ),
+    HeaderRule(
+        ("encoding", "parallelImaging", "accelerationFactor", "kspace_encoding_step_2"),
+        RuleAction.RENAME,
+        "kspace_enc_step_2",
+    ),
+    HeaderRule(("sequenceParameters", "diffusion"), RuleAction.DROP),
+    HeaderRule(("sequenceParameters", "TR"), RuleAction.FIRST),
+    HeaderRule(("sequenceParameters", "TE"), RuleAction.FIRST),
+    HeaderRule(("sequenceParameters", "TI"), RuleAction.FIRST),
+    HeaderRule(("sequenceParameters", "flipAngle_deg"), RuleAction.FIRST),
+    HeaderRule(("sequenceParameters", "echo_spacing"), RuleAction.FIRST),
+    HeaderRule(("measurementInformation", "measurementDependency"), RuleAction.FIRST),
+    HeaderRule(
+        (
+            "measurementInformation",
+            "referencedImageSequence",
+            "referencedSOPInstanceUID",
+        ),
+        RuleAction.FIRST,
+    ),
+    HeaderRule(("userParameters",), RuleAction.DROP),
+)
 
-def get_main_parameter_groups(ismrmrd_dict: dict[str, Any]) -> list[list[Any]]:
-    """Given a dictionary, pull out the main parameter groups i.e. keys and
-    return in a list"""
-    xnat_mrd_list = []
-    for ckeys in ismrmrd_dict.keys():
-        if "@" not in ckeys and "userParameter" not in ckeys:
-            xnat_mrd_list.append([ckeys])
-    return xnat_mrd_list
-
-
-def create_list_param_names(
-    xnat_mrd_list: list[list[Any]], ismrmrd_dict: dict[str, Any]
-) -> list[list[Any]]:
-    """Given a dictionary with info from Mrd headers and a list of main parameter groups
-    return a list of parameter names nested within main parameter groups"""
-    for _ in range(5):
-        flag_finished = True
-        xnat_mrd_list_new = []
-        for ckey_list in xnat_mrd_list:
-            cvals = get_dict_values(ismrmrd_dict, ckey_list)
-            if isinstance(cvals, dict):
-                flag_finished = False
-                xnat_mrd_list_new.extend([ckey_list + [ckey] for ckey in cvals.keys()])
-            elif isinstance(cvals, list):
-                list_had_dicts = False
-                for idx, item in enumerate(cvals):
-                    if isinstance(item, dict):
-                        list_had_dicts = True
-                        xnat_mrd_list_new.extend(
-                            [ckey_list + [idx, ckey] for ckey in item.keys()]
-                        )
-                    else:
-                        xnat_mrd_list_new.append(ckey_list + [idx])
-                if list_had_dicts:
-                    flag_finished = False
-            else:
-                xnat_mrd_list_new.append(ckey_list)
-
-        if flag_finished:
-            break
-        xnat_mrd_list = xnat_mrd_list_new
-    return xnat_mrd_list
-
-
-def handle_coil_label(
-    xnat_mrd_list: list[list[Any]],
-    ismrmrd_dict: dict[str, Any],
-    xnat_mrd_dict: dict[str, str],
-) -> Tuple[list[list[Any]], dict[str, str]]:
-    """
-    Process and consolidate coil label information from ismrmrd_dict.
-
-    This function extracts coil names from the acquisitionSystemInformation header,
-    concatenates them into a single string, and stores it in xnat_mrd_dict.
-    It also removes the individual coil label entries from the parameter list to
-    avoid duplication.
-    """
-    coil_idx = [
-        idx
-        for idx, item in enumerate(xnat_mrd_list)
-        if (len(item)) > 3
-        and item[0] == "acquisitionSystemInformation"
-        and item[1] == "coilLabel"
-        and item[3] == "coilName"
-    ]
-
-    coil_label_strg = ""
-    for idx in coil_idx:
-        coil_value = get_dict_values(ismrmrd_dict, xnat_mrd_list[idx])
-        coil_label_strg += str(coil_value) + " "
-
-    if len(coil_label_strg) > 255:
-        coil_label_strg = coil_label_strg[:243] + " (truncated)"
+# Maximum length of string fields in XNAT
+_MAX_XNAT_STRING_LENGTH = 255
 
-    xnat_mrd_dict["mrd:mrdScanData/acquisitionSystemInformation/coilLabelList"] = (
-        coil_label_strg
-    )
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[0] != "acquisitionSystemInformation" and elem[1] != "coilLabel"
-    ]
 
-    return xnat_mrd_list, xnat_mrd_dict
+class RuleNode:
+    """Node of the prefix trie built from a rule table - one node per element name"""
 
+    __slots__ = ("children", "rule")
 
-def handle_waveform_info(
-    xnat_mrd_list: list[list[Any]],
-    ismrmrd_dict: dict[str, Any],
-    xnat_mrd_dict: dict[str, str],
-) -> Tuple[list[list[Any]], dict[str, str]]:
-    """
-    Process and consolidate waveform information from ismrmrd_dict.
+    def __init__(self) -> None:
+        self.children: dict[str, RuleNode] = {}
+        self.rule: Optional[HeaderRule] = None
 
-    This function extracts waveform types from the waveformInformation header,
-    concatenates them into a single string, and stores it in xnat_mrd_dict.
-    """
-    waveform_idx = [
-        idx
-        for idx, item in enumerate(xnat_mrd_list)
-        if item[0] == "waveformInformation" and item[2] == "waveformType"
-    ]
 
-    waveform_strg = ""
-    for idx in waveform_idx:
-        waveform_value = get_dict_values(ismrmrd_dict, xnat_mrd_list[idx])
-        waveform_strg += str(waveform_value) + " "
+def compile_header_rules(rules: Iterable[HeaderRule]) -> RuleNode:
+    """Compile a rule table into a prefix trie keyed by element name"""
+    root = RuleNode()
+    for rule in rules:
+        node = root
+        for name in rule.path:
+            node = node.children.setdefault(name, RuleNode())
+        if node.rule is not None:
+            raise ValueError(f"More than one rule given for {'/'.join(rule.path)}")
+        if rule.action in (RuleAction.JOIN, RuleAction.RENAME) and not rule.target:
+            raise ValueError(f"{rule.action.value} rule for {rule.path} needs a target")
+        node.rule = rule
+    return root
 
-    if len(waveform_strg) > 255:
-        waveform_strg = waveform_strg[:243] + " (truncated)"
 
-    xnat_mrd_dict["mrd:mrdScanData/waveformInformationList"] = waveform_strg
-    xnat_mrd_list = [elem for elem in xnat_mrd_list if elem[0] != "waveformInformation"]
-    return xnat_mrd_list, xnat_mrd_dict
+_HEADER_RULE_TRIE = compile_header_rules(HEADER_RULES)
 
 
-def handle_encoding(xnat_mrd_list: list[list[Any]]) -> list[list[Any]]:
-    """
-    Filter out unwanted encoding parameters from xnat_mrd_list.
+def _truncate_xnat_string(value: str) -> str:
+    if len(value) > _MAX_XNAT_STRING_LENGTH:
+        return value[: _MAX_XNAT_STRING_LENGTH - 12] + " (truncated)"
+    return value
 
-    This function removes specific encoding-related parameters that should not be
-    included in the final XNAT data.
-    """
-    xnat_mrd_list = [
-        elem for elem in xnat_mrd_list if elem[0] != "encoding" or elem[1] == 0
-    ]
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:3] != ["encoding", 0, "trajectoryDescription"]
-    ]
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:5] != ["encoding", 0, "multiband", "spacing", "dZ"]
-    ]
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:6] != ["encoding", 0, "parallelImaging", "multiband", "spacing", "dZ"]
-    ]
 
-    return xnat_mrd_list
+# A dict being walked by flatten_header: [items iterator, element name, parent frame,
+# rule node, joined key or None]. Keys are only joined for dicts with leaves, so
+# descending a level is O(1)
+_Frame = list[Any]
 
 
-def handle_sequence_params(xnat_mrd_list: list[list[Any]]) -> list[list[Any]]:
-    """
-    Filter out unwanted sequence parameters from xnat_mrd_list.
+def _frame_key(frame: _Frame) -> str:
+    """Join the key of frame, walking up to the nearest ancestor with a joined key"""
+    parent = frame[2]
+    if parent[4] is not None:
+        return f"{parent[4]}/{frame[1]}"
+    names = []
+    while frame[4] is None:
+        names.append(frame[1])
+        frame = frame[2]
+    names.append(frame[4])
+    return "/".join(reversed(names))
 
-    This function removes diffusion parameters entirely and keeps only the first
-    entry (index 0) for specific single-value sequence parameters.
-    """
-    # Remove diffusion parameters entirely
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:2] != ["sequenceParameters", "diffusion"]
-    ]
 
-    # Keep only first entry (index 0) for single-value parameters
-    single_entries = ["TR", "TE", "flipAngle_deg", "echo_spacing", "TI"]
-    for entry in single_entries:
-        xnat_mrd_list = [
-            elem
-            for elem in xnat_mrd_list
-            if elem[:2] != ["sequenceParameters", entry] or elem[2] == 0
-        ]
+def _iter_rules(rule_trie: RuleNode) -> Iterator[HeaderRule]:
+    nodes = [rule_trie]
+    while nodes:
+        node = nodes.pop()
+        if node.rule is not None:
+            yield node.rule
+        nodes.extend(reversed(node.children.values()))
 
-    return xnat_mrd_list
 
-
-def handle_meas_info(xnat_mrd_list: list[list[Any]]) -> list[list[Any]]:
-    """
-    Filter out unwanted measurement info from xnat_mrd_list.
-
-    This function removes redundant measurement information entries and keeps only the
-    first entry (index 0) for parameters that typically have multiple instances but
-    where only the first instance is needed.
-
-    """
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:2] != ["measurementInformation", "measurementDependency"]
-        or elem[2] == 0
-    ]
-    xnat_mrd_list = [
-        elem
-        for elem in xnat_mrd_list
-        if elem[:2]
-        != [
-            "measurementInformation",
-            "referencedImageSequence",
-            "referencedSOPInstanceUID",
-        ]
-        or elem[3] == 0
-    ]
-
-    return xnat_mrd_list
-
-
-def create_final_xnat_mrd_dict(
-    xnat_mrd_list: list[list[Any]],
-    ismrmrd_dict: dict[str, Any],
-    xnat_mrd_dict: dict[str, str],
+@span("flatten")
+def flatten_header(
+    ismrmrd_dict: dict[str, Any], rule_trie: RuleNode = _HEADER_RULE_TRIE
 ) -> dict[str, Any]:
-    """
-    Create final xnat_mrd_dict by building parameter paths and extracting values.
+    """Convert a header dictionary (as returned by xmlschema) into a flat dictionary of
+    XNAT mrd:mrdScanData fields, in a single pass over the header driven by rule_trie"""
+    xnat_mrd_dict: dict[str, Any] = {"scans": "mrd:mrdScanData"}
+
+    # List fields are always sent, even if the header has no values for them
+    joined_values: dict[str, list[str]] = {}
+    for join_rule in _iter_rules(rule_trie):
+        if join_rule.action is RuleAction.JOIN:
+            joined_values[join_rule.target] = []
+            xnat_mrd_dict[f"mrd:mrdScanData/{join_rule.target}"] = ""
+
+    # Depth-first traversal with an explicit stack of the dicts being walked, so headers
+    # of any depth are flattened in time linear in the number of elements
+    root_key = "mrd:mrdScanData"
+    root: _Frame = [iter(ismrmrd_dict.items()), root_key, None, rule_trie, root_key]
+    stack = [root]
+    while stack:
+        frame = stack[-1]
+        items, _, _, parent_node, parent_key = frame
+        descended = False
+        for name, value in items:
+            if name.startswith("@"):
+                continue
+            # Most of the header has no rules, so skip the lookups below the rule trie
+            if parent_node is None:
+                node = rule = None
+            else:
+                node = parent_node.children.get(name)
+                rule = node.rule if node is not None else None
+            if rule is None:
+                action = None
+                key_name = name
+            else:
+                action = rule.action
+                if action is RuleAction.DROP:
+                    continue
+                target = rule.target
+                key_name = target if action is RuleAction.RENAME else name
+
+            # Walk child dicts before the rest of this dict
+            if isinstance(value, dict):
+                stack.append([iter(value.items()), key_name, frame, node, None])
+                descended = True
+                break
+            if not isinstance(value, list):
+                if action is RuleAction.JOIN:
+                    joined_values[target].append(str(value))
+                else:
+                    if parent_key is None:
+                        parent_key = frame[4] = _frame_key(frame)
+                    xnat_mrd_dict[f"{parent_key}/{key_name}"] = value
+                continue
+            if action is RuleAction.FIRST:
+                value = value[:1]
+            children = []
+            for item in value:
+                if isinstance(item, dict):
+                    children.append(item)
+                elif action is RuleAction.JOIN:
+                    joined_values[target].append(str(item))
+                else:
+                    if parent_key is None:
+                        parent_key = frame[4] = _frame_key(frame)
+                    xnat_mrd_dict[f"{parent_key}/{key_name}"] = item
+            if not children:
+                continue
+            children.reverse()
+            stack.extend(
+                [iter(child.items()), key_name, frame, node, None] for child in children
+            )
+            descended = True
+            break
 
-    Converts parameter paths to XNAT-compatible key strings and retrieves corresponding
-    values from the ismrmrd_dict. Handles XNAT field length limitations.
-    """
-    for param_path in xnat_mrd_list:
-        # Build XNAT key path
-        key_parts = ["mrd:mrdScanData"]
-        key_parts.extend(str(part) for part in param_path if isinstance(part, str))
-        ckey = "/".join(key_parts)
+        if not descended:
+            stack.pop()
 
-        # This field seems to be too long for xnat
-        if "parallelImaging/accelerationFactor/kspace_encoding_step" in ckey:
-            ckey = ckey.replace("kspace_encoding_step", "kspace_enc_step")
-        xnat_mrd_dict[ckey] = get_dict_values(ismrmrd_dict, param_path)
+    for target, values in joined_values.items():
+        xnat_mrd_dict[f"mrd:mrdScanData/{target}"] = _truncate_xnat_string(
+            "".join(f"{value} " for value in values)
+        )
 
     return xnat_mrd_dict
 
 
 def check_header_valid_convert_to_dict(
-    xml_schema_filename: Path, ismrmrd_header: bytes
+    xml_schema_filename: Path, ismrmrd_header: bytes, trusted: bool = False
 ) -> dict[str, Any]:
-    """Use xmlschema package to read in xml_schema_filename as xmlschema object and check
-    mrd_header is valid before converting the header to a dictionary and returning"""
-    xml_schema = xmlschema.XMLSchema(xml_schema_filename)
+    """Use xmlschema package to read in xml_schema_filename as xmlschema object and convert
+    mrd_header to a dictionary, validating it in the same pass. Validation errors are
+    collected while decoding and reported together if the header is invalid.
+
+    If trusted is True, headers whose SHA-256 digest has already been validated against
+    the same schema in this process are decoded without validation."""
+    xml_schema = get_xml_schema(xml_schema_filename)
+    validated_key = (
+        xml_schema.url or str(xml_schema_filename),
+        hashlib.sha256(ismrmrd_header).hexdigest(),
+    )
 
-    if not xml_schema.is_valid(ismrmrd_header):
+    if trusted and validated_key in _validated_headers:
+        with span("header_decode"):
+            return cast(
+                dict[str, Any], xml_schema.to_dict(ismrmrd_header, validation="skip")
+            )
+
+    with span("header_decode"):
+        ismrmrd_dict, errors = cast(
+            tuple[dict[str, Any], list["xmlschema.XMLSchemaValidationError"]],
+            xml_schema.to_dict(ismrmrd_header, validation="lax"),
+        )
+    if errors:
+        for error in errors:
+            logger.error(f"Invalid ismrmrd header: {error.reason} (at {error.path})")
         raise Exception("Raw data file is not a valid ismrmrd file")
 
-    return xml_schema.to_dict(ismrmrd_header)
+    if len(_validated_headers) >= _MAX_VALIDATED_HEADERS:
+        _validated_headers.clear()
+    _validated_headers.add(validated_key)
+
+    return ismrmrd_dict
 
 
-def mrd_2_xnat(ismrmrd_header: bytes, xml_schema_filepath: Path) -> dict[str, Any]:
+def mrd_2_xnat(
+    ismrmrd_header: bytes, xml_schema_filepath: Path, trusted: bool = False
+) -> dict[str, Any]:
     """
     This takes the ismrmrd_header and converts it to a dictionary compatible with XNAT data types.
     The xml_schema_filename points to a local copy of the official MRD header xml schema (.xsd file):
     https://ismrmrd.readthedocs.io/en/latest/mrd_header.html
+    If trusted is True, validation is skipped for headers already validated in this process.
     """
     ismrmrd_dict = check_header_valid_convert_to_dict(
-        xml_schema_filepath, ismrmrd_header
-    )
-
-    xnat_mrd_list = get_main_parameter_groups(ismrmrd_dict)
-
-    xnat_mrd_list = create_list_param_names(xnat_mrd_list, ismrmrd_dict)
-
-    # Create dictionary with parameter names and their values
-    xnat_mrd_dict = {}
-    xnat_mrd_dict["scans"] = "mrd:mrdScanData"
-
-    # First deal with special cases
-    xnat_mrd_list, xnat_mrd_dict = handle_coil_label(
-        xnat_mrd_list, ismrmrd_dict, xnat_mrd_dict
+        xml_schema_filepath, ismrmrd_header, trusted=trusted
     )
 
-    xnat_mrd_list, xnat_mrd_dict = handle_waveform_info(
-        xnat_mrd_list, ismrmrd_dict, xnat_mrd_dict
+    return flatten_header(ismrmrd_dict)
+
+
+# The plugin's data type schema, shipped with the package as a copy of
+# src/main/resources/schemas/mrd/mrd.xsd
+MRD_PLUGIN_SCHEMA_PATH = Path(str(importlib.resources.files("xnat_mrd") / "mrd.xsd"))
+
+_XSD_NAMESPACE = "{http://www.w3.org/2001/XMLSchema}"
+_MRD_NAMESPACE = "{http://ptb.de/mrd}"
+ElementTree.register_namespace("mrd", _MRD_NAMESPACE[1:-1])
+_XSD_INTEGER_TYPES = {
+    "integer",
+    "long",
+    "int",
+    "short",
+    "byte",
+    "nonNegativeInteger",
+    "positiveInteger",
+    "nonPositiveInteger",
+    "negativeInteger",
+    "unsignedLong",
+    "unsignedInt",
+    "unsignedShort",
+    "unsignedByte",
+}
+_XSD_FLOAT_TYPES = {"float", "double"}
+
+
+class ElementPlan:
+    """Decoding plan for one header element: its child element plans and, for elements
+    with simple content, the function converting the element text to a python value"""
+
+    __slots__ = ("children", "convert")
+
+    def __init__(self) -> None:
+        self.children: dict[str, ElementPlan] = {}
+        self.convert: Optional[Callable[[str], Any]] = None
+
+
+def _value_converter(xsd_type: Any) -> Callable[[str], Any]:
+    """Return a function converting element text to the python type xmlschema would
+    decode xsd_type to"""
+    while not (xsd_type.name or "").startswith(_XSD_NAMESPACE):
+        xsd_type = xsd_type.base_type
+
+    type_name = xsd_type.name[len(_XSD_NAMESPACE) :]
+    if type_name in _XSD_INTEGER_TYPES:
+        return lambda text: int(text.strip())
+    if type_name in _XSD_FLOAT_TYPES:
+        return lambda text: float(text.strip())
+    if type_name == "boolean":
+        return lambda text: text.strip() in ("true", "1")
+    return str
+
+
+_element_plans: dict[str, ElementPlan] = {}
+_element_plans_lock = threading.Lock()
+
+
+def _get_element_plan(xml_schema: "xmlschema.XMLSchema") -> ElementPlan:
+    """Build (once per schema) the decoding plan for the ismrmrdHeader element"""
+    with _element_plans_lock:
+        plan = _element_plans.get(str(xml_schema.url))
+        if plan is not None:
+            return plan
+
+        plans_by_type: dict[int, ElementPlan] = {}
+        root_element = xml_schema.elements["ismrmrdHeader"]
+        root_plan = ElementPlan()
+        plans_by_type[id(root_element.type)] = root_plan
+        elements: list[tuple[Any, ElementPlan]] = [(root_element, root_plan)]
+        while elements:
+            xsd_element, plan = elements.pop()
+            if xsd_element.type.is_simple():
+                plan.convert = _value_converter(xsd_element.type)
+                continue
+            if xsd_element.type.has_simple_content():
+                plan.convert = _value_converter(xsd_element.type.content)
+                continue
+            for child in xsd_element.type.content.iter_elements():
+                child_plan = plans_by_type.get(id(child.type))
+                if child_plan is None:
+                    child_plan = ElementPlan()
+                    plans_by_type[id(child.type)] = child_plan
+                    elements.append((child, child_plan))
+                plan.children[child.local_name] = child_plan
+
+        _element_plans[str(xml_schema.url)] = root_plan
+        return root_plan
+
+
+@functools.lru_cache(maxsize=4)
+def _plugin_elements(mrd_schema_path: Path) -> tuple[tuple[str, bool], ...]:
+    """(mrd:mrdScanData/... key, whether it is a simple field) of every element defined
+    in the plugin's data type schema (mrd.xsd), in document order"""
+    import xmlschema
+
+    with warnings.catch_warnings():
+        # The xnat base schema imported by mrd.xsd is not available here
+        warnings.simplefilter("ignore")
+        mrd_schema = xmlschema.XMLSchema(mrd_schema_path, validation="skip")
+
+    elements = []
+    for component in mrd_schema.iter_components(
+        xsd_classes=(xmlschema.validators.elements.XsdElement,)
+    ):
+        if not isinstance(component, xmlschema.validators.elements.XsdElement):
+            continue
+        path = component.get_path()
+        if path is None:
+            continue
+        # Leaves have simple types, or anyType where their type can't be resolved
+        # without the xnat base schema
+        is_field = component.type.is_simple() or (component.type.name or "").endswith(
+            "anyType"
+        )
+        path = path.replace(_MRD_NAMESPACE, "")
+        elements.append((f"mrd:mrdScanData/{path}", is_field))
+    return tuple(elements)
+
+
+def plugin_field_names(mrd_schema_path: Path = MRD_PLUGIN_SCHEMA_PATH) -> set[str]:
+    """Return the mrd:mrdScanData/... keys of all simple fields defined in the plugin's
+    data type schema (mrd.xsd)"""
+    return {key for key, is_field in _plugin_elements(mrd_schema_path) if is_field}
+
+
+@functools.lru_cache(maxsize=16)
+def _field_prefixes(field_names: frozenset[str], rule_trie: RuleNode) -> frozenset[str]:
+    """Keys of all elements that are, or contain, one of field_names - including the
+    source elements of list fields built by join rules"""
+    keys = set(field_names)
+    for rule in _iter_rules(rule_trie):
+        if (
+            rule.action is RuleAction.JOIN
+            and f"mrd:mrdScanData/{rule.target}" in field_names
+        ):
+            keys.add("mrd:mrdScanData/" + "/".join(rule.path))
+
+    prefixes: set[str] = set()
+    for key in keys:
+        parts = key.split("/")
+        prefixes.update("/".join(parts[:n]) for n in range(2, len(parts) + 1))
+    return frozenset(prefixes)
+
+
+def iter_mrd_2_xnat(
+    ismrmrd_header: bytes,
+    xml_schema_filepath: Path,
+    field_names: Optional[Iterable[str]] = None,
+    rule_trie: RuleNode = _HEADER_RULE_TRIE,
+) -> Iterator[tuple[str, Any]]:
+    """
+    Streaming version of mrd_2_xnat: parse ismrmrd_header incrementally and yield
+    (key, value) pairs of XNAT mrd:mrdScanData fields without building the header
+    dictionary. Only elements that lead to one of field_names (e.g. from
+    plugin_field_names) are decoded - by default all fields kept by rule_trie are.
+    As with mrd_2_xnat, a key may be yielded more than once, and the last value wins.
+
+    Element values are decoded to the types given in xml_schema_filepath, but the
+    header structure is not validated against it, so this should only be used for
+    headers from trusted sources.
+    """
+    element_plan = _get_element_plan(get_xml_schema(xml_schema_filepath))
+    keep_keys = (
+        None
+        if field_names is None
+        else _field_prefixes(frozenset(field_names), rule_trie)
     )
 
-    xnat_mrd_list = handle_encoding(xnat_mrd_list)
-    xnat_mrd_list = handle_sequence_params(xnat_mrd_list)
-
-    xnat_mrd_list = handle_meas_info(xnat_mrd_list)
-
-    return create_final_xnat_mrd_dict(xnat_mrd_list, ismrmrd_dict, xnat_mrd_dict)
+    yield "scans", "mrd:mrdScanData"
+
+    joined_values: dict[str, list[str]] = {
+        rule.target: []
+        for rule in _iter_rules(rule_trie)
+        if rule.action is RuleAction.JOIN
+        and (keep_keys is None or f"mrd:mrdScanData/{rule.target}" in keep_keys)
+    }
+
+    # Stack of (key, rule node, element plan, names of children seen so far)
+    stack: list[tuple[str, Optional[RuleNode], ElementPlan, set[str]]] = []
+    skip_depth = 0
+    for event, element in ElementTree.iterparse(
+        io.BytesIO(ismrmrd_header), events=("start", "end")
+    ):
+        if event == "start":
+            if skip_depth:
+                skip_depth += 1
+                continue
+            if not stack:
+                stack.append(("mrd:mrdScanData", rule_trie, element_plan, set()))
+                continue
+
+            name = element.tag.rpartition("}")[2]
+            parent_key, parent_node, parent_plan, seen_children = stack[-1]
+            plan = parent_plan.children.get(name)
+            node = parent_node.children.get(name) if parent_node is not None else None
+            rule = node.rule if node is not None else None
+            action = rule.action if rule is not None else None
+            target = rule.target if rule is not None else ""
+            first_seen = name not in seen_children
+            seen_children.add(name)
+
+            key = f"{parent_key}/{target if action is RuleAction.RENAME else name}"
+            if (
+                plan is None
+                or action is RuleAction.DROP
+                or (action is RuleAction.FIRST and not first_seen)
+                or (keep_keys is not None and key not in keep_keys)
+            ):
+                skip_depth = 1
+                continue
+            stack.append((key, node, plan, set()))
+
+        else:
+            if skip_depth:
+                skip_depth -= 1
+            else:
+                key, node, plan, _ = stack.pop()
+                if plan.convert is not None and stack:
+                    try:
+                        value = plan.convert(element.text or "")
+                    except ValueError:
+                        raise Exception(
+                            f"Invalid value {element.text!r} for {key} in ismrmrd header"
+                        )
+                    if (
+                        node is not None
+                        and node.rule is not None
+                        and node.rule.action is RuleAction.JOIN
+                    ):
+                        joined_values[node.rule.target].append(str(value))
+                    else:
+                        yield key, value
+            element.clear()
+
+    for target, values in joined_values.items():
+        yield (
+            f"mrd:mrdScanData/{target}",
+            _truncate_xnat_string("".join(f"{value} " for value in values)),
+        )
+
+
+def _xml_text(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def xnat_hdr_to_xml(
+    xnat_hdr: dict[str, Any],
+    scan_id: Optional[str] = None,
+    mrd_schema_path: Path = MRD_PLUGIN_SCHEMA_PATH,
+) -> bytes:
+    """Build the mrd:mrdScanData XML document holding the fields of xnat_hdr (as
+    returned by mrd_2_xnat), to create a scan from a request body rather than from query
+    parameters. Elements are ordered as in the plugin's schema, and empty fields are
+    left out."""
+    fields = [
+        (key.removeprefix("mrd:mrdScanData/"), value)
+        for key, value in xnat_hdr.items()
+        if key.startswith("mrd:mrdScanData/") and value != ""
+    ]
+    order = {
+        key.removeprefix("mrd:mrdScanData/"): index
+        for index, (key, _) in enumerate(_plugin_elements(Path(mrd_schema_path)))
+    }
+    fields.sort(key=lambda field: order.get(field[0], len(order)))
+
+    root = ElementTree.Element(f"{_MRD_NAMESPACE}mrdScanData")
+    if scan_id is not None:
+        root.set("ID", scan_id)
+    elements = {"": root}
+    for path, value in fields:
+        parent_path, _, name = path.rpartition("/")
+        parent = elements.get(parent_path)
+        if parent is None:
+            parent = root
+            parts = parent_path.split("/")
+            for depth in range(len(parts)):
+                group_path = "/".join(parts[: depth + 1])
+                group = elements.get(group_path)
+                if group is None:
+                    group = ElementTree.SubElement(
+                        parent, f"{_MRD_NAMESPACE}{parts[depth]}"
+                    )
+                    elements[group_path] = group
+                parent = group
+        ElementTree.SubElement(parent, f"{_MRD_NAMESPACE}{name}").text = _xml_text(
+            value
+        )
+
+    return ElementTree.tostring(root, encoding="UTF-8", xml_declaration=True)
@@ -0,0 +1,200 @@
+import hashlib
+import io
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, Callable, Iterator, Optional, Union
+
+from xnat_mrd.timing import span
+
+if TYPE_CHECKING:
+    # h5py (and numpy) are slow to import, and only needed once a file is opened
+    import h5py
+
+# Size of reads when hashing or uploading the raw file
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Checksums computed from the raw bytes as they are read - MD5 to compare with the
+# digest XNAT reports, SHA-256 to record uploads in the manifest (see
+# ingest.timed_upload)
+STREAMED_CHECKSUMS = ("md5", "sha256")
+
+
+class _PositionalReader(io.RawIOBase):
+    """Read-only stream with its own position over a function reading size bytes at an
+    offset, so that several readers can share one open file"""
+
+    def __init__(self, read_at: Callable[[int, int], bytes], size: int):
+        self._read_at = read_at
+        self._size = size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        data = self._read_at(len(buffer), self._position)
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+class _StreamedChecksums:
+    """Hashes of the bytes of a file, updated from reads of any part of it. Bytes are
+    hashed the first time they are read in order from the start, so overlapping reads
+    (e.g. of a retried upload) are not hashed twice and reads beyond the hashed part
+    are ignored."""
+
+    def __init__(self, size: int, algorithms: tuple[str, ...]):
+        self.size = size
+        self.position = 0
+        self._hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self._lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes) -> None:
+        with self._lock:
+            end = offset + len(data)
+            if offset <= self.position < end:
+                unhashed = memoryview(data)[self.position - offset :]
+                for hasher in self._hashers.values():
+                    hasher.update(unhashed)
+                self.position = end
+
+    def digests(self) -> Optional[dict[str, str]]:
+        """Hex digests per algorithm, once the whole file was hashed"""
+        with self._lock:
+            if self.position < self.size:
+                return None
+            return {
+                algorithm: hasher.hexdigest()
+                for algorithm, hasher in self._hashers.items()
+            }
+
+
+class MrdFile:
+    """An mrd file that is opened only once. The HDF5 structure (dataset groups and
+    their xml headers) is read with h5py, and positional reads of the file descriptor
+    of h5py's sec2 driver are used for computing checksums and streaming the raw file
+    for upload. Raw reads are hashed as they happen (see STREAMED_CHECKSUMS), so
+    streaming the whole file for upload also computes its checksums without another
+    pass over the file."""
+
+    def __init__(self, mrd_file_path: Path):
+        import h5py
+
+        self.path = Path(mrd_file_path)
+        with span("hdf5_open"):
+            # h5py reads through its own (native) file driver - much faster than
+            # through a python file object
+            self._h5 = h5py.File(self.path, "r", driver="sec2")
+            self.dataset_names: list[str] = list(self._h5.keys())
+        self._fd: int = self._h5.id.get_vfd_handle()
+        self.size = os.fstat(self._fd).st_size
+        # Only opened on platforms without positional reads (see read_at)
+        self._raw: Optional[BinaryIO] = None
+        self._checksums: dict[str, str] = {}
+        self._streamed_checksums = _StreamedChecksums(self.size, STREAMED_CHECKSUMS)
+        self._read_lock = threading.Lock()
+
+    @property
+    def multidata(self) -> bool:
+        return len(self.dataset_names) > 1
+
+    @property
+    def h5(self) -> "h5py.File":
+        return self._h5
+
+    def read_xml_header(self, dataset_name: str) -> bytes:
+        """Read the xml header of dataset_name directly from its 'xml' dataset"""
+        with span("header_read"):
+            header = self._h5[dataset_name]["xml"][0]
+        if isinstance(header, str):
+            header = header.encode("utf-8")
+        return header
+
+    def read_at(self, size: int, offset: int) -> bytes:
+        """Read up to size raw bytes starting at offset, independent of any other
+        read"""
+        if hasattr(os, "pread"):
+            # Doesn't move the file position h5py may rely on
+            data = os.pread(self._fd, size, offset)
+        else:
+            # No positional reads on this platform - seek a separate handle instead
+            with self._read_lock:
+                if self._raw is None:
+                    self._raw = open(self.path, "rb")
+                self._raw.seek(offset)
+                data = self._raw.read(size)
+        self._streamed_checksums.update(offset, data)
+        return data
+
+    def open_stream(self, buffer_size: int = DEFAULT_CHUNK_SIZE) -> io.BufferedReader:
+        """Return a new stream over the raw bytes of the file, independent of any other
+        stream or h5py read"""
+        return io.BufferedReader(
+            _PositionalReader(self.read_at, self.size), buffer_size=buffer_size
+        )
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Iterate over the raw bytes of the file in chunks of chunk_size"""
+        for offset in range(0, self.size, chunk_size):
+            yield self.read_at(chunk_size, offset)
+
+    def checksum(self, algorithm: str = "md5") -> str:
+        """Hex digest of the raw file, computed once per algorithm. For
+        STREAMED_CHECKSUMS, only the part of the file not yet read in order (e.g. by an
+        upload) is read."""
+        if algorithm in STREAMED_CHECKSUMS:
+            streamed = self._streamed_checksums
+            for offset in range(streamed.position, self.size, DEFAULT_CHUNK_SIZE):
+                # Hashed by read_at
+                self.read_at(DEFAULT_CHUNK_SIZE, offset)
+            digests = streamed.digests()
+            if digests is None:
+                raise OSError(f"{self.path} was truncated while it was read")
+            self._checksums.update(digests)
+        elif algorithm not in self._checksums:
+            hasher = hashlib.new(algorithm)
+            for chunk in self.iter_chunks():
+                hasher.update(chunk)
+            self._checksums[algorithm] = hasher.hexdigest()
+        return self._checksums[algorithm]
+
+    def close(self) -> None:
+        self._h5.close()
+        if self._raw is not None:
+            self._raw.close()
+
+    def __enter__(self) -> "MrdFile":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+@contextmanager
+def open_mrd_file(mrd_file: Union[Path, MrdFile]) -> Iterator[MrdFile]:
+    """Use an already open MrdFile as is, or open (and afterwards close) a path"""
+    if isinstance(mrd_file, MrdFile):
+        yield mrd_file
+    else:
+        with MrdFile(mrd_file) as opened_file:
+            yield opened_file
@@ -1,73 +1,181 @@
 import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Tuple
+from typing import TYPE_CHECKING, Any, Optional, Tuple, Union
 
-import ismrmrd
-import xnat
+from xnat_mrd.header_cache import cached_mrd_2_xnat
+from xnat_mrd.mrd_2_xnat import xnat_hdr_to_xml
+from xnat_mrd.mrd_file import DEFAULT_CHUNK_SIZE, MrdFile, open_mrd_file
+from xnat_mrd.timing import span
+from xnat_mrd.upload import DEFAULT_MAX_RETRIES, upload_raw_file
 
-import h5py
-from xnat_mrd.fetch_datasets import get_singledata
-from xnat_mrd.mrd_2_xnat import mrd_2_xnat
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),  # Console output
-        logging.FileHandler("xnat_mrd_processing.log"),  # File output
-    ],
-)
+if TYPE_CHECKING:
+    # xnat is slow to import, and not needed by the processes converting headers
+    import xnat
 
 logger = logging.getLogger(__name__)
 
 
-def list_ismrmrd_datasets(mrd_file_path: Path) -> Tuple[list[str], bool]:
-    with h5py.File(mrd_file_path, "r") as f:
-        groups = list(f.keys())
-        if len(groups) > 1:
-            multidata = True
-        else:
-            multidata = False
+_last_time_id = ""
+_time_id_lock = threading.Lock()
 
-        return groups, multidata
 
+def new_time_id() -> str:
+    """Return a millisecond timestamp id, unique within this process even when
+    several uploads create subjects concurrently"""
+    global _last_time_id
+    with _time_id_lock:
+        time_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")[:-3]
+        while time_id <= _last_time_id:
+            time.sleep(0.001)
+            time_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")[:-3]
+        _last_time_id = time_id
+        return time_id
 
-def upload_mrd_data(
-    xnat_session: xnat.XNATSession,
-    mrd_file_path: Path,
-    project_name: str,
-    scan_id: str = "cart_cine_scan",
-    experiment_date: str = "2022-05-04",
-) -> None:
-    xnat_project = verify_project_exists(xnat_session, project_name)
-    xnat_subject, time_id = create_unique_subject(xnat_session, xnat_project)
-    experiment = add_exam(xnat_subject, time_id, experiment_date)
 
-    dataset_names, multidata = list_ismrmrd_datasets(mrd_file_path)
+def list_ismrmrd_datasets(mrd_file: Union[Path, MrdFile]) -> Tuple[list[str], bool]:
+    with open_mrd_file(mrd_file) as opened_file:
+        return opened_file.dataset_names, opened_file.multidata
+
+
+def select_dataset_name(dataset_names: list[str], multidata: bool) -> str:
+    """Pick the dataset to convert from the groups of an mrd file"""
     if multidata and ("dataset_2" in dataset_names):
-        dataset_name = "dataset_2"
+        return "dataset_2"
     elif not multidata:
-        dataset_name = dataset_names[0]
+        return dataset_names[0]
     else:
         raise NameError(
             f"Multiple datasets were present: {dataset_names}, but none called 'dataset_2'. Please provide the required dataset name directly to `read_mrd_header`"
         )
 
-    xnat_hdr = read_mrd_header(mrd_file_path, dataset_name)
-    add_scan(experiment, xnat_hdr, scan_id, mrd_file_path)
+
+def convert_mrd_file(
+    mrd_file: Union[Path, MrdFile], with_acquisition_statistics: bool = False
+) -> dict[str, Any]:
+    """Read the header of the relevant dataset in mrd_file and convert to XNAT format.
+    With with_acquisition_statistics, the statistics of its acquisitions are added (see
+    acquisition_statistics)."""
+    with open_mrd_file(mrd_file) as opened_file:
+        dataset_name = select_dataset_name(
+            opened_file.dataset_names, opened_file.multidata
+        )
+        xnat_hdr = read_mrd_header(opened_file, dataset_name)
+        if with_acquisition_statistics:
+            # numpy is only needed for the statistics
+            from xnat_mrd.acquisition_stats import acquisition_statistics
+
+            # A new dict - the converted header may be shared through the header cache
+            xnat_hdr = {
+                **xnat_hdr,
+                **acquisition_statistics(opened_file, dataset_name),
+            }
+        return xnat_hdr
+
+
+def convert_all_datasets(
+    mrd_file: Union[Path, MrdFile],
+    max_workers: Optional[int] = None,
+    with_acquisition_statistics: bool = False,
+) -> dict[str, dict[str, Any]]:
+    """Read the headers of all datasets in mrd_file and convert them to XNAT format,
+    returning a dict of dataset name -> converted header. The headers are converted in
+    a pool of max_workers processes - with max_workers=1, or only one dataset, they are
+    converted in this process. With with_acquisition_statistics, the statistics of the
+    acquisitions of each dataset are added (see acquisition_statistics)."""
+    with open_mrd_file(mrd_file) as opened_file:
+        headers = {
+            dataset_name: opened_file.read_xml_header(dataset_name)
+            for dataset_name in opened_file.dataset_names
+        }
+        statistics: dict[str, dict[str, Any]] = {
+            dataset_name: {} for dataset_name in headers
+        }
+        if with_acquisition_statistics:
+            # numpy is only needed for the statistics
+            from xnat_mrd.acquisition_stats import acquisition_statistics
+
+            statistics = {
+                dataset_name: acquisition_statistics(opened_file, dataset_name)
+                for dataset_name in headers
+            }
+
+    xml_schema_filepath = Path(__file__).parent / "ismrmrd.xsd"
+    if max_workers == 1 or len(headers) <= 1:
+        converted = [
+            cached_mrd_2_xnat(header, xml_schema_filepath)
+            for header in headers.values()
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            converted = list(
+                pool.map(
+                    cached_mrd_2_xnat,
+                    headers.values(),
+                    [xml_schema_filepath] * len(headers),
+                )
+            )
+    return {
+        dataset_name: {**xnat_hdr, **statistics[dataset_name]}
+        for dataset_name, xnat_hdr in zip(headers, converted)
+    }
 
 
-def read_mrd_header(mrd_file_path: Path, dataset_name: str) -> dict[str, Any]:
+def upload_mrd_data(
+    xnat_session: "xnat.XNATSession",
+    mrd_file: Union[Path, MrdFile],
+    project_name: str,
+    scan_id: str = "cart_cine_scan",
+    experiment_date: str = "2022-05-04",
+    xnat_hdr: Optional[dict[str, Any]] = None,
+    all_datasets: bool = False,
+    xnat_hdrs: Optional[dict[str, dict[str, Any]]] = None,
+    xml_body: bool = False,
+) -> Any:
+    """Upload mrd_file (a path, or an already open MrdFile) to a new subject /
+    experiment in project_name, returning the experiment. If xnat_hdr is given, it is
+    used as the already converted header instead of reading it from the file.
+
+    With all_datasets=True, one scan is created per dataset in the file (with id
+    {scan_id}_{dataset name}) and the raw file is uploaded once, as a resource of the
+    experiment. xnat_hdrs can then give the already converted headers per dataset.
+    xml_body selects how scans are created (see create_scan)."""
+    xnat_project = verify_project_exists(xnat_session, project_name)
+    xnat_subject, time_id = create_unique_subject(xnat_session, xnat_project)
+    experiment = add_exam(xnat_subject, time_id, experiment_date)
+
+    # The file is opened once, for both reading the header and uploading
+    with open_mrd_file(mrd_file) as opened_file:
+        if not all_datasets:
+            if xnat_hdr is None:
+                xnat_hdr = convert_mrd_file(opened_file)
+            add_scan(experiment, xnat_hdr, scan_id, opened_file, xml_body=xml_body)
+            return experiment
+
+        if xnat_hdrs is None:
+            xnat_hdrs = convert_all_datasets(opened_file)
+        for dataset_name, dataset_hdr in xnat_hdrs.items():
+            create_scan(
+                experiment, dataset_hdr, f"{scan_id}_{dataset_name}", xml_body=xml_body
+            )
+        upload_raw_data(experiment, opened_file)
+    return experiment
+
+
+def read_mrd_header(
+    mrd_file: Union[Path, MrdFile], dataset_name: str
+) -> dict[str, Any]:
     """Load MRD header and convert to XNAT format"""
 
-    with ismrmrd.Dataset(mrd_file_path, dataset_name, create_if_needed=False) as dset:
-        header = dset.read_xml_header()
-        return mrd_2_xnat(header, Path(__file__).parent / "ismrmrd.xsd")
+    with open_mrd_file(mrd_file) as opened_file:
+        header = opened_file.read_xml_header(dataset_name)
+        return cached_mrd_2_xnat(header, Path(__file__).parent / "ismrmrd.xsd")
 
 
-def verify_project_exists(session: xnat.XNATSession, project_name: str) -> Any:
+def verify_project_exists(session: "xnat.XNATSession", project_name: str) -> Any:
     """Verify project exist on XNAT server - disconnect if project does not exist"""
     try:
         xnat_project = session.projects[project_name]
@@ -78,18 +186,26 @@ def verify_project_exists(session: xnat.XNATSession, project_name: str) -> Any:
         raise NameError(f"Project {project_name} not available on server.")
 
 
+def xnat_object_exists(session: "xnat.XNATSession", uri: str) -> bool:
+    """Check if the XNAT object at uri (e.g. a subject or experiment addressed by label)
+    exists, with a single HEAD request"""
+    response = session.head(uri, accepted_status=[200, 404])
+    return response.status_code == 200
+
+
+@span("subject_create")
 def create_unique_subject(
-    session: xnat.XNATSession, xnat_project: Any
+    session: "xnat.XNATSession", xnat_project: Any, time_id: Optional[str] = None
 ) -> Tuple[Any, str]:
-    """Create a unique subject that doesn't already exist"""
-    time_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")[:-3]
+    """Create a unique subject that doesn't already exist. Its label is made from
+    time_id, a new one (see new_time_id) unless given."""
+    if time_id is None:
+        time_id = new_time_id()
     subject_id = "Subj-" + time_id
 
-    # Check if subject already exists
-    existing_subjects = list(xnat_project.subjects.values())
-    existing_subject_labels = [subj.label for subj in existing_subjects]
-
-    if subject_id in existing_subject_labels:
+    # Check if subject already exists - with a single request, rather than listing all
+    # subjects of the project
+    if xnat_object_exists(session, f"{xnat_project.uri}/subjects/{subject_id}"):
         logger.error(f"Subject {subject_id} already exists")
         raise NameError(f"Subject {subject_id} already exists.")
 
@@ -102,21 +218,25 @@ def create_unique_subject(
     return xnat_subject, time_id
 
 
+@span("experiment_create")
 def add_exam(xnat_subject: Any, time_id: str, experiment_date: str) -> Any:
     """Add exam/experiment to the XNAT subject"""
     experiment_id = "Exp-" + time_id
 
-    # Check if experiment already exists
-    existing_experiments = list(xnat_subject.experiments.values())
-    existing_experiment_labels = [exp.label for exp in existing_experiments]
+    session = xnat_subject.xnat_session
 
-    if experiment_id in existing_experiment_labels:
+    # Check if experiment already exists - experiment labels are unique within a project,
+    # so a single request is enough
+    experiment_uri = (
+        f"/data/projects/{xnat_subject.project}/subjects/{xnat_subject.label}"
+        f"/experiments/{experiment_id}"
+    )
+    if xnat_object_exists(session, experiment_uri):
         logger.error(f"Exam {experiment_id} already exists")
         raise NameError(f"Exam {experiment_id} already exists.")
 
     # Create experiment using the proper XNAT object creation method
     # session.classes.MrSessionData(parent=subject, label='new_experiment_label')
-    session = xnat_subject.xnat_session
     experiment = session.classes.MrSessionData(parent=xnat_subject, label=experiment_id)
     experiment.date = experiment_date
 
@@ -124,54 +244,118 @@ def add_exam(xnat_subject: Any, time_id: str, experiment_date: str) -> Any:
     return experiment
 
 
-def add_scan(
-    experiment: Any, xnat_hdr: dict, scan_id: str, mrd_file_path: Path
-) -> None:
-    """Add scan to experiment. Create scan with the xnat_hdr info. Add MR_RAW resource
-    to scan with mrd_file data.
+def scan_handle(experiment: Any, scan_id: str, xsi_type: str) -> Any:
+    """Return the xnatpy object of the existing scan scan_id in experiment, built from
+    its known uri. This avoids re-fetching the scan listing of the experiment - with
+    xsi_type known to the session, no request is made at all (the scan's fields are
+    fetched when first accessed), otherwise the type is looked up with a single GET of
+    the scan."""
+    session = experiment.xnat_session
+    scan_uri = f"{experiment.uri}/scans/{scan_id}"
+    if xsi_type in session.XNAT_CLASS_LOOKUP:
+        return session.create_object(
+            scan_uri, type_=xsi_type, id_=scan_id, parent=experiment
+        )
+    return session.create_object(scan_uri, parent=experiment)
+
+
+@span("scan_create")
+def create_scan(
+    experiment: Any, xnat_hdr: dict, scan_id: str, xml_body: bool = False
+) -> Any:
+    """Create scan scan_id in experiment with the xnat_hdr info, returning the scan. By
+    default the header fields are sent as query parameters - with xml_body, they are
+    sent as an mrd:mrdScanData XML document in the request body instead, which keeps
+    the URL short."""
+    session = experiment.xnat_session
+    scan_uri = f"{experiment.uri}/scans/{scan_id}"
 
-    Args:
-        experiment (Any): existing XNAT experiment
-        xnat_hdr (dict): dict containing all the header info to populate in the data type mrd
-        scan_id (str): custom str e.g. cart_cine_scan
-        mrd_file_path (Path): Path of mrd_file containing MR raw data
-    """
     # Check if scan already exists, otherwise create it with all header data
-    if scan_id in experiment.scans:
+    if xnat_object_exists(session, scan_uri):
         logger.error(f"XNAT scan {scan_id} already exists")
         raise NameError(f"XNAT scan {scan_id} already exists")
 
     # Create the scan with all MRD header data at once
     logger.info(f"Creating MRD scan {scan_id} with header data")
 
-    # Use the xnat library's proper method for creating scans with data
-    session = experiment.xnat_session
-    scan_uri = f"{experiment.uri}/scans/{scan_id}"
-
-    # Create the scan using PUT request with all header data as query parameters
-    response = session.put(scan_uri, query=xnat_hdr)
+    if xml_body:
+        # Create the scan using PUT request with all header data as an XML document
+        response = session.put(
+            scan_uri,
+            data=xnat_hdr_to_xml(xnat_hdr, scan_id),
+            headers={"Content-Type": "text/xml"},
+            query={"inbody": "true"},
+        )
+    else:
+        # Create the scan using PUT request with all header data as query parameters
+        response = session.put(scan_uri, query=xnat_hdr)
 
     if response.ok:
         logger.info(f"Successfully created MRD scan: {scan_id}")
-        # Refresh the experiment to see the new scan
-        experiment.clearcache()
-
-        # Get the created scan object
-        scan = experiment.scans[scan_id]
+        scan = scan_handle(
+            experiment, scan_id, xnat_hdr.get("scans", "mrd:mrdScanData")
+        )
 
     else:
         logger.error(f"Failed to create scan: {response.status_code} - {response.text}")
         raise Exception(f"Failed to create MRD scan: {response.status_code}")
 
     logger.info(f"Configured MRD scan: {scan_id}")
+    return scan
 
+
+@span("file_upload")
+def upload_raw_data(
+    xnat_object: Any,
+    mrd_file: Union[Path, MrdFile],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+) -> None:
+    """Add an MR_RAW resource to xnat_object (a scan or experiment) holding the raw
+    mrd_file. See upload_raw_file for the retry and checksum behaviour."""
     # Create resource for MRD files - create the resource first, then upload
-    scan_resource = scan.create_resource("MR_RAW")
-    scan_resource.upload(mrd_file_path, mrd_file_path.name)
+    resource = xnat_object.create_resource("MR_RAW")
+    upload_raw_file(
+        xnat_object.xnat_session,
+        resource.uri,
+        mrd_file,
+        chunk_size=chunk_size,
+        max_retries=max_retries,
+    )
+
+
+def add_scan(
+    experiment: Any,
+    xnat_hdr: dict,
+    scan_id: str,
+    mrd_file: Union[Path, MrdFile],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    xml_body: bool = False,
+) -> None:
+    """Add scan to experiment. Create scan with the xnat_hdr info. Add MR_RAW resource
+    to scan with mrd_file data.
+
+    Args:
+        experiment (Any): existing XNAT experiment
+        xnat_hdr (dict): dict containing all the header info to populate in the data type mrd
+        scan_id (str): custom str e.g. cart_cine_scan
+        mrd_file (Path | MrdFile): Path of (or already open) mrd_file containing MR raw data
+        chunk_size (int): maximum number of bytes of mrd_file held in memory during upload
+        xml_body (bool): send the header as an XML request body (see create_scan)
+    """
+    scan = create_scan(experiment, xnat_hdr, scan_id, xml_body=xml_body)
+    upload_raw_data(scan, mrd_file, chunk_size=chunk_size)
     logger.info(f"Successfully created scan {scan_id} and uploaded MRD file")
 
 
 def main():
+    import xnat
+
+    from xnat_mrd.cli import configure_logging
+    from xnat_mrd.fetch_datasets import get_singledata
+
+    configure_logging(Path("xnat_mrd_processing.log"))
+
     xnat_server_address = "http://localhost"
     user = "admin"
     password = "admin"
@@ -0,0 +1,154 @@
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Iterator, Optional, Union
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+# Refresh the session when it would expire within this many seconds
+DEFAULT_REFRESH_MARGIN_SECONDS = 60.0
+
+
+def configure_connection_pool(xnat_session: "xnat.XNATSession", pool_size: int) -> None:
+    """Let up to pool_size requests of xnat_session run concurrently over kept-alive
+    connections (requests keeps only 10 connections per host by default)"""
+    import requests
+
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    xnat_session.interface.mount("http://", adapter)
+    xnat_session.interface.mount("https://", adapter)
+
+
+@contextmanager
+def connection_pool(xnat_session: "xnat.XNATSession", pool_size: int) -> Iterator[None]:
+    """configure_connection_pool for the duration of the with block only - the
+    previous connection adapters of xnat_session are restored afterwards"""
+    adapters = xnat_session.interface.adapters.copy()
+    configure_connection_pool(xnat_session, pool_size)
+    pool_adapter = xnat_session.interface.adapters["https://"]
+    try:
+        yield
+    finally:
+        xnat_session.interface.adapters = adapters
+        pool_adapter.close()
+
+
+class XnatSessionManager:
+    """A single XNAT session for a whole run, shared by all threads. The session is
+    connected (and authenticated) on first use only, its connection pool keeps up to
+    pool_size connections alive - one per concurrent upload - and it is refreshed before
+    the server expires it, so that no file pays for a new TLS / login handshake.
+
+    Before a session is handed out, its JSESSION is kept alive with a heartbeat if it
+    would expire within refresh_margin_seconds. If the server has already dropped it, a
+    new JSESSION is created for the same session object, so objects and threads holding
+    on to it keep working. connect_kwargs are passed to xnat.connect."""
+
+    def __init__(
+        self,
+        server: str,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        pool_size: int = 4,
+        refresh_margin_seconds: float = DEFAULT_REFRESH_MARGIN_SECONDS,
+        **connect_kwargs: Any,
+    ):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.pool_size = pool_size
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._connect_kwargs = connect_kwargs
+        self._session: Optional["xnat.XNATSession"] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> "xnat.XNATSession":
+        import xnat
+
+        return xnat.connect(
+            self.server, user=self.user, password=self.password, **self._connect_kwargs
+        )
+
+    def get_session(self) -> "xnat.XNATSession":
+        """The shared session, connected on the first call and refreshed if it is about
+        to expire"""
+        with self._lock:
+            session = self._session
+            if session is None:
+                session = self._session = self._connect()
+                configure_connection_pool(session, self.pool_size)
+                logger.info(f"Connected to XNAT server {session.server}")
+            elif self._expires_soon(session):
+                self._refresh(session)
+            return session
+
+    def _expires_soon(self, session: "xnat.XNATSession") -> bool:
+        expiration = session.session_expiration_time
+        if expiration is None:
+            # The server doesn't report it - rely on xnatpy's keepalive heartbeats
+            return False
+        refreshed_at, timeout_seconds = expiration
+        expires_at = refreshed_at + datetime.timedelta(seconds=timeout_seconds)
+        margin = datetime.timedelta(seconds=self.refresh_margin_seconds)
+        return datetime.datetime.now() + margin >= expires_at
+
+    def _refresh(self, session: "xnat.XNATSession") -> None:
+        import requests
+        from xnat.exceptions import XNATResponseError
+
+        try:
+            session.heartbeat()
+        except (requests.RequestException, XNATResponseError) as e:
+            logger.info(f"XNAT session expired ({e}) - logging in again")
+            self._login(session)
+            return
+        if self._expires_soon(session):
+            # The server did not extend the session
+            self._login(session)
+
+    def _login(self, session: "xnat.XNATSession") -> None:
+        """Create a new JSESSION for the existing session, with the user / password or
+        the .netrc entry for the server"""
+        import requests
+
+        auth: Optional[tuple[str, str]]
+        if self.user is not None:
+            auth = (self.user, self.password or "")
+        else:
+            auth = requests.utils.get_netrc_auth(session.server)
+        if auth is None:
+            raise RuntimeError(
+                f"XNAT session on {session.server} expired, and no credentials "
+                "are available to log in again"
+            )
+
+        response = session.interface.post(f"{session.server}/data/JSESSION", auth=auth)
+        response.raise_for_status()
+        logger.info(f"Logged in to XNAT server {session.server} again")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.disconnect()
+                self._session = None
+
+    def __enter__(self) -> "XnatSessionManager":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def resolve_session(
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+) -> "xnat.XNATSession":
+    """The session to use for the next request(s) - from the manager, if given one"""
+    if isinstance(xnat_session, XnatSessionManager):
+        return xnat_session.get_session()
+    return xnat_session
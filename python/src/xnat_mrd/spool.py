@@ -0,0 +1,394 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+from xnat_mrd.populate_datatype_fields import (
+    add_exam,
+    convert_mrd_file,
+    create_scan,
+    create_unique_subject,
+    new_time_id,
+    scan_handle,
+    upload_raw_data,
+    verify_project_exists,
+    xnat_object_exists,
+)
+from xnat_mrd.session import XnatSessionManager, resolve_session
+from xnat_mrd.upload import upload_raw_file
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+# Journaled job states, in order - each records the last completed step of a job
+QUEUED = "queued"
+HEADER_CONVERTED = "header_converted"
+SUBJECT_CREATED = "subject_created"
+EXPERIMENT_CREATED = "experiment_created"
+SCAN_CREATED = "scan_created"
+FILE_UPLOADED = "file_uploaded"
+JOB_STATES = (
+    QUEUED,
+    HEADER_CONVERTED,
+    SUBJECT_CREATED,
+    EXPERIMENT_CREATED,
+    SCAN_CREATED,
+    FILE_UPLOADED,
+)
+# Jobs that ran out of attempts
+FAILED = "failed"
+
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_SECONDS = 30.0
+DEFAULT_MAX_BACKOFF_SECONDS = 3600.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    project TEXT NOT NULL,
+    scan_id TEXT NOT NULL,
+    experiment_date TEXT NOT NULL,
+    state TEXT NOT NULL,
+    xnat_hdr_json TEXT,
+    time_id TEXT,
+    experiment_uri TEXT,
+    attempts INTEGER NOT NULL,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_attempt_at);
+"""
+
+
+@dataclass
+class SpoolJob:
+    """Upload of one mrd file, with what is known after its last completed step"""
+
+    id: int
+    path: str
+    project: str
+    scan_id: str
+    experiment_date: str
+    state: str = QUEUED
+    # The converted header, as journaled - decoded to xnat_hdr
+    xnat_hdr_json: Optional[str] = None
+    # Set before the subject is created, so a retry finds a subject created by an
+    # attempt that died before journaling it
+    time_id: Optional[str] = None
+    experiment_uri: Optional[str] = None
+    attempts: int = 0
+    # Unix time
+    next_attempt_at: float = 0.0
+    last_error: Optional[str] = None
+    created_at: str = ""
+    updated_at: str = ""
+    xnat_hdr: Optional[dict[str, Any]] = field(default=None, init=False)
+
+    def __post_init__(self) -> None:
+        if self.xnat_hdr_json is not None:
+            self.xnat_hdr = json.loads(self.xnat_hdr_json)
+
+    @property
+    def done(self) -> bool:
+        return self.state == FILE_UPLOADED
+
+
+class UploadSpool:
+    """Durable queue of uploads, journaled in a local SQLite file. Every completed step
+    of a job (see JOB_STATES) is committed before the next one starts, so after a crash
+    or a server outage the job resumes from its last completed step rather than
+    creating another subject and experiment. Failed attempts are retried with
+    exponential backoff (backoff_seconds, doubling up to max_backoff_seconds) until a
+    job has failed max_attempts times. Safe to share between threads."""
+
+    def __init__(
+        self,
+        spool_path: Path,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+        max_backoff_seconds: float = DEFAULT_MAX_BACKOFF_SECONDS,
+    ):
+        self.path = Path(spool_path)
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # Each committed step must survive a crash of the machine, not only of
+            # the process
+            self._connection.execute("PRAGMA synchronous=FULL")
+            self._connection.executescript(_SCHEMA)
+
+    def enqueue(
+        self,
+        mrd_file_path: Path,
+        project_name: str,
+        scan_id: str = "cart_cine_scan",
+        experiment_date: str = "2022-05-04",
+    ) -> SpoolJob:
+        """Add the upload of mrd_file_path to project_name, due straight away. If the
+        file is already spooled for project_name (and has not failed), that job is
+        returned instead."""
+        path = str(Path(mrd_file_path).resolve())
+        now = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT id FROM jobs WHERE path = ? AND project = ? AND state != ?",
+                (path, project_name, FAILED),
+            ).fetchone()
+            if row is not None:
+                job_id = row[0]
+            else:
+                cursor = self._connection.execute(
+                    "INSERT INTO jobs (path, project, scan_id, experiment_date, "
+                    "state, attempts, next_attempt_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, 0, 0, ?, ?)",
+                    (path, project_name, scan_id, experiment_date, QUEUED, now, now),
+                )
+                job_id = cursor.lastrowid
+        return self.job(job_id)
+
+    def job(self, job_id: int) -> SpoolJob:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No spool job {job_id}")
+        return SpoolJob(*row)
+
+    def jobs(self, state: Optional[str] = None) -> list[SpoolJob]:
+        """All jobs (in the given state), oldest first"""
+        query = "SELECT * FROM jobs"
+        parameters: tuple = ()
+        if state is not None:
+            query += " WHERE state = ?"
+            parameters = (state,)
+        with self._lock:
+            rows = self._connection.execute(f"{query} ORDER BY id", parameters)
+            return [SpoolJob(*row) for row in rows.fetchall()]
+
+    def next_due(self, now: Optional[float] = None) -> Optional[SpoolJob]:
+        """The unfinished job that has been due the longest, if any is due at now"""
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE state NOT IN (?, ?) AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at, id LIMIT 1",
+                (FILE_UPLOADED, FAILED, now),
+            ).fetchone()
+        return None if row is None else SpoolJob(*row)
+
+    def next_attempt_at(self) -> Optional[float]:
+        """When the next unfinished job is due, or None if all jobs are finished"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MIN(next_attempt_at) FROM jobs WHERE state NOT IN (?, ?)",
+                (FILE_UPLOADED, FAILED),
+            ).fetchone()
+        return row[0]
+
+    def save(self, job: SpoolJob) -> None:
+        """Commit the current state of job"""
+        job.updated_at = datetime.now().isoformat(timespec="seconds")
+        job.xnat_hdr_json = None if job.xnat_hdr is None else json.dumps(job.xnat_hdr)
+        # Every field but the id and the decoded header is a column
+        columns = [
+            job_field.name
+            for job_field in fields(job)
+            if job_field.init and job_field.name != "id"
+        ]
+        values = [getattr(job, column) for column in columns]
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?", (*values, job.id)
+            )
+
+    def record_failure(
+        self, job: SpoolJob, error: Exception, now: Optional[float] = None
+    ) -> None:
+        """Schedule the retry of job after a failed attempt, or mark it failed once it
+        has used up its attempts"""
+        now = time.time() if now is None else now
+        job.attempts += 1
+        job.last_error = str(error)
+        if job.attempts >= self.max_attempts:
+            job.state = FAILED
+            logger.error(
+                f"Spool job {job.id} ({job.path}) failed {job.attempts} times, "
+                f"giving up: {error}"
+            )
+        else:
+            delay = min(
+                self.backoff_seconds * 2 ** (job.attempts - 1), self.max_backoff_seconds
+            )
+            job.next_attempt_at = now + delay
+            logger.warning(
+                f"Spool job {job.id} ({job.path}) failed after step {job.state} "
+                f"({error}) - retrying in {delay:.0f} s"
+            )
+        self.save(job)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "UploadSpool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _corrupt_job(job: SpoolJob, missing: str) -> RuntimeError:
+    return RuntimeError(
+        f"Spool job {job.id} ({job.path}) is {job.state} but has no {missing} - "
+        "its journal entry is corrupt"
+    )
+
+
+def _object_at(session: "xnat.XNATSession", uri: str) -> Any:
+    """The xnatpy object of an existing XNAT object"""
+    return session.create_object(uri)
+
+
+def advance_job(
+    spool: UploadSpool, session: "xnat.XNATSession", job: SpoolJob
+) -> SpoolJob:
+    """Run the remaining steps of job, committing its state to spool after each. Steps
+    that may have completed on the server in an attempt that died before journaling
+    them (creating the subject, experiment or scan) check for the object first."""
+    if job.state == QUEUED:
+        job.xnat_hdr = convert_mrd_file(Path(job.path))
+        job.state = HEADER_CONVERTED
+        spool.save(job)
+
+    xnat_hdr = job.xnat_hdr
+    if xnat_hdr is None:
+        raise _corrupt_job(job, "converted header")
+    if job.state == HEADER_CONVERTED and job.time_id is None:
+        job.time_id = new_time_id()
+        spool.save(job)
+    time_id = job.time_id
+    if time_id is None:
+        raise _corrupt_job(job, "time id")
+
+    project = verify_project_exists(session, job.project)
+    subject_uri = f"/data/projects/{job.project}/subjects/Subj-{time_id}"
+    experiment = None
+
+    if job.state == HEADER_CONVERTED:
+        if not xnat_object_exists(session, subject_uri):
+            create_unique_subject(session, project, time_id=time_id)
+        job.state = SUBJECT_CREATED
+        spool.save(job)
+
+    if job.state == SUBJECT_CREATED:
+        experiment_uri = f"{subject_uri}/experiments/Exp-{time_id}"
+        if xnat_object_exists(session, experiment_uri):
+            experiment = _object_at(session, experiment_uri)
+        else:
+            subject = _object_at(session, subject_uri)
+            experiment = add_exam(subject, time_id, job.experiment_date)
+        job.experiment_uri = experiment.uri
+        job.state = EXPERIMENT_CREATED
+        spool.save(job)
+
+    if experiment is None:
+        if job.experiment_uri is None:
+            raise _corrupt_job(job, "experiment uri")
+        experiment = _object_at(session, job.experiment_uri)
+
+    if job.state == EXPERIMENT_CREATED:
+        if xnat_object_exists(session, f"{experiment.uri}/scans/{job.scan_id}"):
+            scan = scan_handle(
+                experiment, job.scan_id, xnat_hdr.get("scans", "mrd:mrdScanData")
+            )
+        else:
+            scan = create_scan(experiment, xnat_hdr, job.scan_id)
+        job.state = SCAN_CREATED
+        spool.save(job)
+    else:
+        scan = scan_handle(
+            experiment, job.scan_id, xnat_hdr.get("scans", "mrd:mrdScanData")
+        )
+
+    if job.state == SCAN_CREATED:
+        # An attempt that died during the upload may have created the resource.
+        # Uploads overwrite any partial file and verify the checksum, so uploading to
+        # it again is safe
+        resource_uri = f"{scan.uri}/resources/MR_RAW"
+        if xnat_object_exists(session, resource_uri):
+            upload_raw_file(session, resource_uri, Path(job.path))
+        else:
+            upload_raw_data(scan, Path(job.path))
+        job.state = FILE_UPLOADED
+        job.last_error = None
+        spool.save(job)
+
+    return job
+
+
+@dataclass
+class DrainSummary:
+    """Outcome of a drain_spool run"""
+
+    completed: list[int] = field(default_factory=list)
+    # Failed attempts that will be retried
+    retried: list[int] = field(default_factory=list)
+    # Jobs that ran out of attempts
+    failed: list[int] = field(default_factory=list)
+
+
+def drain_spool(
+    spool: UploadSpool,
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+    max_jobs_per_second: Optional[float] = None,
+    stop_when_idle: bool = True,
+    poll_seconds: float = 1.0,
+    stop_event: Optional[threading.Event] = None,
+) -> DrainSummary:
+    """Run due jobs of spool one at a time, starting at most max_jobs_per_second. With
+    stop_when_idle, return once no job is due (retries scheduled for later are left in
+    the spool) - otherwise keep polling every poll_seconds until stop_event is set."""
+    summary = DrainSummary()
+    min_interval = 1 / max_jobs_per_second if max_jobs_per_second else 0.0
+    last_start = -min_interval
+    stop_event = stop_event or threading.Event()
+
+    while not stop_event.is_set():
+        job = spool.next_due()
+        if job is None:
+            if stop_when_idle:
+                break
+            stop_event.wait(poll_seconds)
+            continue
+
+        wait_seconds = last_start + min_interval - time.monotonic()
+        if wait_seconds > 0 and stop_event.wait(wait_seconds):
+            break
+        last_start = time.monotonic()
+
+        try:
+            advance_job(spool, resolve_session(xnat_session), job)
+            summary.completed.append(job.id)
+            logger.info(f"Spool job {job.id} ({job.path}) uploaded")
+        except Exception as e:
+            spool.record_failure(job, e)
+            (summary.failed if job.state == FAILED else summary.retried).append(job.id)
+
+    return summary
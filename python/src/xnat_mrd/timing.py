@@ -0,0 +1,187 @@
+import bisect
+import cProfile
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import ContextDecorator, contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of the histogram buckets, as in Prometheus' defaults
+# extended to the minutes a large upload can take
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    math.inf,
+)
+
+
+class Histogram:
+    """Distribution of the durations of one stage"""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: dict[str, Any]) -> None:
+        """Add the observations of another histogram, given as from to_dict"""
+        for index, count in enumerate(other["bucket_counts"]):
+            self.bucket_counts[index] += count
+        self.count += other["count"]
+        self.sum += other["sum"]
+        if other["count"]:
+            self.min = min(self.min, other["min"])
+            self.max = max(self.max, other["max"])
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "buckets": [
+                "+Inf" if math.isinf(bound) else bound for bound in self.buckets
+            ],
+            "bucket_counts": list(self.bucket_counts),
+        }
+
+
+class TimingRegistry:
+    """Histograms of stage durations, shared between threads"""
+
+    def __init__(self):
+        self._histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """Stage name -> histogram summary (see Histogram.to_dict)"""
+        with self._lock:
+            return {
+                stage: histogram.to_dict()
+                for stage, histogram in sorted(self._histograms.items())
+            }
+
+    def merge(self, snapshot: dict[str, dict[str, Any]]) -> None:
+        """Add the observations of a snapshot, e.g. taken in a worker process"""
+        with self._lock:
+            for stage, other in snapshot.items():
+                histogram = self._histograms.get(stage)
+                if histogram is None:
+                    histogram = self._histograms[stage] = Histogram()
+                histogram.merge(other)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, metric: str = "xnat_mrd_stage_seconds") -> str:
+        """Export as a Prometheus histogram in the text exposition format"""
+        lines = [
+            f"# HELP {metric} Time spent in each stage of converting and uploading mrd files",
+            f"# TYPE {metric} histogram",
+        ]
+        for stage, histogram in self.snapshot().items():
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"], histogram["bucket_counts"]):
+                cumulative += count
+                lines.append(
+                    f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+_registry = TimingRegistry()
+
+
+def get_timing_registry() -> TimingRegistry:
+    """The registry that span records to in this process"""
+    return _registry
+
+
+class span(ContextDecorator):
+    """Record the duration of a block of code (with span("stage"): ...) or of every call
+    of a function (@span("stage")) in the timing registry"""
+
+    def __init__(self, stage: str, registry: Optional[TimingRegistry] = None):
+        self.stage = stage
+        self.registry = registry
+        self._starts = threading.local()
+
+    def __enter__(self) -> "span":
+        # A stack per thread, so the same span object can be entered concurrently and
+        # recursively when used as a decorator
+        starts = getattr(self._starts, "stack", None)
+        if starts is None:
+            starts = self._starts.stack = []
+        starts.append(time.perf_counter())
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self._starts.stack.pop()
+        (self.registry or _registry).observe(self.stage, seconds)
+
+
+@contextmanager
+def profile_to(profile_path: Optional[Path]) -> Iterator[None]:
+    """Run the block under cProfile, writing the stats to profile_path (if not None).
+    Only one profiler can be active at a time, so if another thread is already
+    profiling, the block runs without it."""
+    if profile_path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        logger.debug(f"Not profiling {profile_path}: {e}")
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(profile_path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(profile_path)
@@ -0,0 +1,242 @@
+import logging
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, TypeVar, Union
+
+from xnat_mrd.mrd_file import DEFAULT_CHUNK_SIZE, MrdFile, open_mrd_file
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+T = TypeVar("T")
+
+
+class UploadError(Exception):
+    """Raised when a raw file could not be uploaded, or its checksum on the server does
+    not match the local file"""
+
+
+# Client errors that may go away when the request is repeated: request timeout and
+# too many requests
+RETRIED_CLIENT_ERRORS = (408, 429)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Whether a failed request may succeed if repeated - connection failures, timeouts
+    and server errors, but not other client errors (e.g. 401, 403, 404 or 409)"""
+    import requests
+    from xnat.exceptions import XNATResponseError
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, XNATResponseError):
+        return error.status_code >= 500 or error.status_code in RETRIED_CLIENT_ERRORS
+    return False
+
+
+def _with_retries(
+    operation: Callable[[], T],
+    description: str,
+    max_retries: int,
+    backoff_seconds: float,
+) -> T:
+    """Run operation, retrying requests that failed with a transient error (see
+    _is_transient) up to max_retries times with exponential backoff. Other failed
+    requests raise UploadError straight away."""
+    # Already imported by the session making the requests
+    import requests
+    from xnat.exceptions import XNATResponseError
+
+    for attempt in range(max_retries + 1):
+        try:
+            return operation()
+        except (requests.RequestException, XNATResponseError) as e:
+            if not _is_transient(e):
+                raise UploadError(f"{description} failed: {e}") from e
+            if attempt == max_retries:
+                raise UploadError(
+                    f"{description} failed after {max_retries + 1} attempts: {e}"
+                ) from e
+            delay = backoff_seconds * 2**attempt
+            logger.warning(f"{description} failed ({e}) - retrying in {delay:.1f} s")
+            time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+def acknowledged_offset(session: "xnat.XNATSession", file_uri: str) -> Optional[int]:
+    """Number of bytes of file_uri the server already holds, as reported in the
+    Upload-Offset header of a HEAD request (0 for a new file) by servers supporting
+    resumable uploads. XNAT itself does not support these, and None is returned."""
+    response = session.head(file_uri, accepted_status=[200, 204, 404])
+    offset = response.headers.get("Upload-Offset")
+    return None if offset is None else int(offset)
+
+
+def _upload_chunks(
+    session: "xnat.XNATSession",
+    file_uri: str,
+    mrd_file: MrdFile,
+    offset: int,
+    chunk_size: int,
+    max_retries: int,
+    backoff_seconds: float,
+) -> None:
+    """Upload mrd_file from offset onwards as one request per chunk. Each chunk is
+    retried separately, after asking the server which offset it acknowledged (it may
+    have stored part of a failed request)."""
+    offset_acknowledged = True
+
+    def send_next_chunk() -> None:
+        nonlocal offset, offset_acknowledged
+        if not offset_acknowledged:
+            server_offset = acknowledged_offset(session, file_uri)
+            if server_offset is None:
+                raise UploadError(f"{file_uri} no longer supports resumable uploads")
+            offset = server_offset
+            offset_acknowledged = True
+
+        chunk = mrd_file.read_at(chunk_size, offset)
+        end = offset + len(chunk)
+        offset_acknowledged = False
+        response = session.put(
+            file_uri,
+            data=chunk,
+            headers={
+                "Content-Type": "application/offset+octet-stream",
+                "Content-Range": f"bytes {offset}-{end - 1}/{mrd_file.size}",
+                "Upload-Offset": str(offset),
+            },
+            accepted_status=[200, 201, 204],
+        )
+        offset = int(response.headers.get("Upload-Offset", end))
+        offset_acknowledged = True
+
+    while offset < mrd_file.size:
+        _with_retries(
+            send_next_chunk,
+            f"Upload of {mrd_file.path.name} from byte {offset}",
+            max_retries,
+            backoff_seconds,
+        )
+
+
+def _upload_whole_file(
+    session: "xnat.XNATSession",
+    file_uri: str,
+    mrd_file: MrdFile,
+    chunk_size: int,
+    max_retries: int,
+    backoff_seconds: float,
+) -> None:
+    """Upload mrd_file in a single streamed request, reading chunk_size bytes at a
+    time, and start again from the beginning on failure"""
+
+    def send_file() -> None:
+        session.put(
+            file_uri,
+            data=mrd_file.open_stream(buffer_size=chunk_size),
+            headers={"Content-Type": "application/octet-stream"},
+            query={"overwrite": "true"},
+            accepted_status=[200, 201],
+        )
+
+    _with_retries(
+        send_file, f"Upload of {mrd_file.path.name}", max_retries, backoff_seconds
+    )
+
+
+def remote_file_digest(
+    session: "xnat.XNATSession", resource_uri: str, remote_name: str
+) -> Optional[str]:
+    """MD5 digest XNAT reports for file remote_name of resource_uri"""
+    files = session.get_json(f"{resource_uri}/files")["ResultSet"]["Result"]
+    for file_info in files:
+        if file_info["Name"] == remote_name:
+            return file_info.get("digest")
+    raise UploadError(f"{remote_name} is missing from {resource_uri} after upload")
+
+
+def upload_raw_file(
+    session: "xnat.XNATSession",
+    resource_uri: str,
+    mrd_file: Union[Path, MrdFile],
+    remote_name: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+    resumable: bool = False,
+) -> str:
+    """Upload mrd_file to the XNAT resource at resource_uri, holding at most chunk_size
+    bytes in memory. Failed requests are retried up to max_retries times with
+    exponential backoff, sending the whole file again.
+
+    XNAT does not support resumable uploads. With resumable=True, for servers (e.g. an
+    upload proxy in front of XNAT) that do, every chunk is sent (and retried)
+    separately with an Upload-Offset header, and an interrupted upload continues from
+    the offset the server acknowledged. UploadError is raised if the server does not
+    report an offset.
+
+    The MD5 digest reported by XNAT is compared against the local file, raising
+    UploadError on a mismatch. Returns the digest. The local MD5 and SHA-256 digests
+    are computed from the bytes as they are uploaded (see MrdFile.checksum), so the
+    file is read only once - unless a resumed upload skipped its start."""
+    with open_mrd_file(mrd_file) as opened_file:
+        remote_name = remote_name or opened_file.path.name
+        file_uri = f"{resource_uri}/files/{remote_name}"
+
+        if not resumable:
+            _upload_whole_file(
+                session,
+                file_uri,
+                opened_file,
+                chunk_size,
+                max_retries,
+                backoff_seconds,
+            )
+        else:
+            offset = _with_retries(
+                lambda: acknowledged_offset(session, file_uri),
+                f"Checking upload state of {remote_name}",
+                max_retries,
+                backoff_seconds,
+            )
+            if offset is None:
+                raise UploadError(f"{file_uri} does not support resumable uploads")
+            if offset > 0:
+                logger.info(f"Resuming upload of {remote_name} from byte {offset}")
+            _upload_chunks(
+                session,
+                file_uri,
+                opened_file,
+                offset,
+                chunk_size,
+                max_retries,
+                backoff_seconds,
+            )
+
+        local_digest = opened_file.checksum("md5")
+        content_sha256 = opened_file.checksum("sha256")
+        remote_digest = _with_retries(
+            lambda: remote_file_digest(session, resource_uri, remote_name),
+            f"Fetching the digest of {remote_name}",
+            max_retries,
+            backoff_seconds,
+        )
+
+    if remote_digest is None:
+        logger.warning(f"XNAT reported no digest for {remote_name} - not verified")
+    elif remote_digest != local_digest:
+        raise UploadError(
+            f"Checksum mismatch for {remote_name}: local {local_digest}, "
+            f"XNAT {remote_digest}"
+        )
+    else:
+        logger.info(
+            f"Uploaded {remote_name} (md5 {local_digest}, sha256 {content_sha256})"
+        )
+    return local_digest
@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional
+
+from xnat_mrd.ingest import IngestResult, IngestSummary, conversion_pool
+from xnat_mrd.populate_datatype_fields import convert_mrd_file, upload_mrd_data
+from xnat_mrd.session import connection_pool
+
+if TYPE_CHECKING:
+    # xnat is slow to import, and not needed by the processes converting headers
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+
+async def upload_mrd_data_async(
+    xnat_session: "xnat.XNATSession",
+    mrd_file_path: Path,
+    project_name: str,
+    scan_id: str = "cart_cine_scan",
+    experiment_date: str = "2022-05-04",
+    xnat_hdr: Optional[dict[str, Any]] = None,
+    limiter: Optional[asyncio.Semaphore] = None,
+    convert_executor: Optional[Executor] = None,
+    upload_executor: Optional[Executor] = None,
+) -> None:
+    """Async version of upload_mrd_data. The header is converted in convert_executor
+    (default: the event loop's default executor) and the blocking XNAT requests run in
+    upload_executor, so the event loop stays free to convert and upload other files in
+    the meantime. At most limiter's value of uploads run at once."""
+    loop = asyncio.get_running_loop()
+    if xnat_hdr is None:
+        xnat_hdr = await loop.run_in_executor(
+            convert_executor, convert_mrd_file, mrd_file_path
+        )
+
+    async with limiter or contextlib.nullcontext():
+        await loop.run_in_executor(
+            upload_executor,
+            upload_mrd_data,
+            xnat_session,
+            mrd_file_path,
+            project_name,
+            scan_id,
+            experiment_date,
+            xnat_hdr,
+        )
+
+
+async def _ingest_one(
+    xnat_session: "xnat.XNATSession",
+    result: IngestResult,
+    project_name: str,
+    experiment_date: str,
+    limiter: asyncio.Semaphore,
+    convert_executor: Executor,
+    upload_executor: Executor,
+) -> None:
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        xnat_hdr = await loop.run_in_executor(
+            convert_executor, convert_mrd_file, result.path
+        )
+    except Exception as e:
+        result.error = f"header conversion failed: {e}"
+        return
+    result.convert_seconds = time.perf_counter() - start
+
+    async with limiter:
+        start = time.perf_counter()
+        try:
+            await upload_mrd_data_async(
+                xnat_session,
+                result.path,
+                project_name,
+                experiment_date=experiment_date,
+                xnat_hdr=xnat_hdr,
+                upload_executor=upload_executor,
+            )
+            result.ok = True
+        except Exception as e:
+            result.error = f"upload failed: {e}"
+        result.upload_seconds = time.perf_counter() - start
+
+
+async def ingest_async(
+    xnat_session: "xnat.XNATSession",
+    mrd_file_paths: list[Path],
+    project_name: str,
+    max_concurrency: int = 8,
+    convert_workers: Optional[int] = None,
+    experiment_date: str = "2022-05-04",
+) -> IngestSummary:
+    """Convert and upload many mrd files from an event loop. Headers are converted in
+    a pool of convert_workers processes and at most max_concurrency uploads share
+    xnat_session (whose connection pool is sized to match while they run) at any
+    time. Conversion of
+    later files overlaps with the upload of earlier ones."""
+    summary = IngestSummary(
+        results=[
+            IngestResult(path=path, size_bytes=path.stat().st_size)
+            for path in mrd_file_paths
+        ]
+    )
+    limiter = asyncio.Semaphore(max_concurrency)
+
+    start = time.perf_counter()
+    with (
+        connection_pool(xnat_session, max_concurrency),
+        conversion_pool(convert_workers) as convert_executor,
+        ThreadPoolExecutor(max_workers=max_concurrency) as upload_executor,
+    ):
+        await asyncio.gather(
+            *(
+                _ingest_one(
+                    xnat_session,
+                    result,
+                    project_name,
+                    experiment_date,
+                    limiter,
+                    convert_executor,
+                    upload_executor,
+                )
+                for result in summary.results
+            )
+        )
+    summary.wall_seconds = time.perf_counter() - start
+    return summary
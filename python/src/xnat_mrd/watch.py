@@ -0,0 +1,354 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional, Union
+
+from xnat_mrd.ingest import (
+    MRD_FILE_SUFFIXES,
+    IngestResult,
+    IngestSummary,
+    timed_upload,
+)
+from xnat_mrd.manifest import UploadManifest
+from xnat_mrd.mrd_2_xnat import get_xml_schema
+from xnat_mrd.mrd_file import MrdFile
+from xnat_mrd.populate_datatype_fields import convert_mrd_file
+from xnat_mrd.session import XnatSessionManager, resolve_session
+
+if TYPE_CHECKING:
+    import xnat
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks (see inotify(7))
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _is_mrd_candidate(path: Path) -> bool:
+    return path.suffix.lower() in MRD_FILE_SUFFIXES
+
+
+def _iter_tree(directory: Path) -> Iterator[os.DirEntry]:
+    """All files and directories below directory"""
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return
+    for entry in entries:
+        yield entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from _iter_tree(Path(entry.path))
+
+
+class _PollingWatcher:
+    """Finds new and changed mrd files by rescanning the directory tree"""
+
+    def __init__(self, directory: Path, poll_seconds: float):
+        self.directory = directory
+        self.poll_seconds = poll_seconds
+        self._seen: dict[Path, tuple[int, int]] = {}
+        self._scan()
+
+    def _scan(self) -> set[Path]:
+        changed = set()
+        seen = {}
+        for entry in _iter_tree(self.directory):
+            path = Path(entry.path)
+            if not _is_mrd_candidate(path) or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            seen[path] = (stat.st_size, stat.st_mtime_ns)
+            if self._seen.get(path) != seen[path]:
+                changed.add(path)
+        self._seen = seen
+        return changed
+
+    def existing_files(self) -> set[Path]:
+        return set(self._seen)
+
+    def changed_files(self, timeout: float) -> set[Path]:
+        time.sleep(min(timeout, self.poll_seconds))
+        return self._scan()
+
+    def close(self) -> None:
+        pass
+
+
+class _InotifyWatcher:
+    """Finds new and changed mrd files from inotify events (Linux only), watching every
+    directory of the tree"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+        self._directories: dict[int, Path] = {}
+        self._existing = self._watch_tree(directory)
+
+    def _watch(self, directory: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            logger.warning(f"Cannot watch {directory}: {os.strerror(error)}")
+            return
+        self._directories[wd] = directory
+
+    def _watch_tree(self, directory: Path) -> set[Path]:
+        """Watch directory and its subdirectories, returning the mrd files already in
+        them"""
+        self._watch(directory)
+        files = set()
+        for entry in _iter_tree(directory):
+            path = Path(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                self._watch(path)
+            elif _is_mrd_candidate(path):
+                files.add(path)
+        return files
+
+    def existing_files(self) -> set[Path]:
+        return self._existing
+
+    def changed_files(self, timeout: float) -> set[Path]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset : offset + name_length].rstrip(b"\0")
+            offset += name_length
+
+            if mask & _IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed - rescanning")
+                changed |= self._watch_tree(self.directory)
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = directory / os.fsdecode(name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    # Files may have been added before the directory was watched
+                    changed |= self._watch_tree(path)
+            elif _is_mrd_candidate(path):
+                changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _open_watcher(
+    directory: Path, use_inotify: Optional[bool], poll_seconds: float
+) -> Union[_InotifyWatcher, _PollingWatcher]:
+    """An inotify watcher where available (or if use_inotify), else a polling one"""
+    if use_inotify is None:
+        use_inotify = sys.platform.startswith("linux")
+    if use_inotify:
+        try:
+            return _InotifyWatcher(directory)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable ({e}) - polling {directory} instead")
+    return _PollingWatcher(directory, poll_seconds)
+
+
+def open_complete_mrd_file(mrd_file_path: Path) -> Optional[MrdFile]:
+    """mrd_file_path opened, if it is a complete HDF5 file with at least one dataset"""
+    import h5py
+
+    try:
+        if not h5py.is_hdf5(mrd_file_path):
+            return None
+        mrd_file = MrdFile(mrd_file_path)
+    except Exception:
+        return None
+    if not mrd_file.dataset_names:
+        mrd_file.close()
+        return None
+    return mrd_file
+
+
+class _PendingFiles:
+    """Files that changed recently, with when each last changed. A file is ready once
+    its size and modification time have been stable for stable_seconds."""
+
+    def __init__(self, stable_seconds: float):
+        self.stable_seconds = stable_seconds
+        self._files: dict[Path, tuple[tuple[int, int], float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def add(self, path: Path, now: float) -> None:
+        self._files.setdefault(path, ((-1, -1), now))
+
+    def pop_ready(self, now: float) -> list[tuple[Path, tuple[int, int]]]:
+        """Remove and return the files that are ready, with their (size, mtime)"""
+        ready = []
+        for path, (last_stat, changed_at) in list(self._files.items()):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                del self._files[path]
+                continue
+            current_stat = (stat.st_size, stat.st_mtime_ns)
+            if current_stat != last_stat:
+                self._files[path] = (current_stat, now)
+            elif now - changed_at >= self.stable_seconds:
+                del self._files[path]
+                ready.append((path, current_stat))
+        return ready
+
+
+def watch_folder(
+    xnat_session: Union["xnat.XNATSession", XnatSessionManager],
+    directory: Path,
+    project_name: str,
+    experiment_date: str = "2022-05-04",
+    upload_workers: int = 2,
+    stable_seconds: float = 0.5,
+    poll_seconds: float = 1.0,
+    use_inotify: Optional[bool] = None,
+    process_existing: bool = True,
+    manifest: Optional[UploadManifest] = None,
+    stop_event: Optional[threading.Event] = None,
+    on_result: Optional[Callable[[IngestResult], Any]] = None,
+) -> IngestSummary:
+    """Upload every mrd file that is written to directory (or its subdirectories) until
+    stop_event is set, returning the results. New files are found from inotify events
+    (with use_inotify=None, wherever available) or else by rescanning every
+    poll_seconds. A file is converted and uploaded as soon as it is complete - its
+    size unchanged for stable_seconds and readable as an mrd file - by a pool of
+    upload_workers threads, each file a new subject / experiment (see
+    upload_mrd_data). The compiled schema and XNAT session are reused between files.
+
+    With process_existing, files already in directory are uploaded too - with a
+    manifest, those (and any file) already uploaded are skipped. on_result is called
+    with the result of each file as it completes."""
+    directory = Path(directory)
+    stop_event = stop_event or threading.Event()
+    summary = IngestSummary()
+    summary_lock = threading.Lock()
+    # (size, mtime) of files uploaded or being uploaded, so repeated events for an
+    # unchanged file are ignored - until its upload is in the manifest, which then
+    # skips it
+    handled: dict[Path, tuple[int, int]] = {}
+
+    # Warm up before the first file arrives
+    get_xml_schema(Path(__file__).parent / "ismrmrd.xsd")
+    server = resolve_session(xnat_session).server
+
+    def process(path: Path, stat: tuple[int, int], ready_at: float) -> None:
+        # The file is opened once, for converting and uploading it
+        mrd_file = open_complete_mrd_file(path)
+        if mrd_file is None:
+            # Picked up again when it next changes
+            logger.warning(f"{path} is not a complete mrd file - skipping")
+            return
+        result = IngestResult(path=path, size_bytes=mrd_file.size)
+        try:
+            content_sha256 = ""
+            if manifest is not None:
+                # Hashed from the open file, which keeps the checksums for the upload
+                cached_sha256 = manifest.cached_content_hash(path)
+                content_sha256 = cached_sha256 or mrd_file.checksum("sha256")
+                if cached_sha256 is None:
+                    manifest.remember_content_hash(path, content_sha256)
+                uploaded = manifest.find(server, project_name, content_sha256)
+                if uploaded is not None:
+                    result.ok = result.skipped = True
+                    result.uploaded_to = uploaded.experiment_uri
+                    return
+            start = time.perf_counter()
+            try:
+                xnat_hdr = convert_mrd_file(mrd_file)
+            except Exception as e:
+                result.error = f"header conversion failed: {e}"
+                return
+            result.convert_seconds = time.perf_counter() - start
+            timed_upload(
+                xnat_session,
+                result,
+                xnat_hdr,
+                project_name,
+                experiment_date,
+                False,
+                manifest,
+                content_sha256,
+                mrd_file=mrd_file,
+            )
+            if result.ok:
+                logger.info(
+                    f"{path}: uploaded {time.monotonic() - ready_at:.2f} s after it "
+                    "was complete"
+                )
+        finally:
+            mrd_file.close()
+            if result.error is not None:
+                logger.error(f"{path}: {result.error}")
+            with summary_lock:
+                summary.results.append(result)
+                if manifest is not None and result.ok and handled.get(path) == stat:
+                    del handled[path]
+            if on_result is not None:
+                on_result(result)
+
+    start = time.perf_counter()
+    watcher = _open_watcher(directory, use_inotify, poll_seconds)
+    logger.info(f"Watching {directory} ({type(watcher).__name__})")
+    pending = _PendingFiles(stable_seconds)
+    if process_existing:
+        now = time.monotonic()
+        for path in watcher.existing_files():
+            pending.add(path, now)
+
+    try:
+        with ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+            while not stop_event.is_set():
+                # Wake up often enough to notice when pending files become stable
+                timeout = min(stable_seconds / 2, poll_seconds) if pending else 0.5
+                now = time.monotonic()
+                for path in watcher.changed_files(timeout):
+                    pending.add(path, now)
+
+                now = time.monotonic()
+                for path, stat in pending.pop_ready(now):
+                    with summary_lock:
+                        if handled.get(path) == stat:
+                            continue
+                        handled[path] = stat
+                    upload_pool.submit(process, path, stat, now)
+    finally:
+        watcher.close()
+
+    summary.wall_seconds = time.perf_counter() - start
+    return summary
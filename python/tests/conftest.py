@@ -3,10 +3,13 @@ import re
 import subprocess
 from pathlib import Path
 
+import ismrmrd
 import pytest
 import xnat4tests
+import xnat_mrd
 from xnat_mrd.fetch_datasets import get_singledata, get_multidata
 
+from tests.stand_in_server import StandInXnat
 from tests.utils import delete_data, XnatConnection
 
 
@@ -28,6 +31,46 @@ def mrd_file_multidata_path():
     return mrd_data
 
 
+@pytest.fixture
+def mrd_header():
+    """Provides the bytes of a small ismrmrd header covering the special-cased fields"""
+
+    return (Path(__file__).parent / "data" / "ismrmrd_header.xml").read_bytes()
+
+
+@pytest.fixture
+def synthetic_mrd_file_path(tmp_path, mrd_header):
+    """Provides a small mrd file with two datasets ('dataset' and 'dataset_2') that both
+    hold the mrd_header"""
+
+    mrd_file_path = tmp_path / "synthetic.h5"
+    for dataset_name in ("dataset", "dataset_2"):
+        with ismrmrd.Dataset(
+            mrd_file_path, dataset_name, create_if_needed=True
+        ) as dset:
+            dset.write_xml_header(mrd_header)
+
+    return mrd_file_path
+
+
+@pytest.fixture(params=[False, True], ids=["whole-file", "resumable"])
+def stand_in_xnat(request):
+    """Provides a local stand-in XNAT server, both without and with support for
+    resumable uploads"""
+
+    stand_in = StandInXnat(resumable=request.param)
+    stand_in.start()
+    yield stand_in
+    stand_in.stop()
+
+
+@pytest.fixture
+def xml_schema_path():
+    """Provides the path of the ismrmrd header schema shipped with xnat_mrd"""
+
+    return Path(xnat_mrd.__file__).parent / "ismrmrd.xsd"
+
+
 @pytest.fixture(scope="session")
 def xnat_version():
     try:
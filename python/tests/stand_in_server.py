@@ -0,0 +1,314 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import xnat
+
+from xnat_mrd.mrd_2_xnat import MRD_PLUGIN_SCHEMA_PATH
+
+# Schemas served to xnatpy for building its data model: a minimal subset of the core
+# XNAT schema, and the plugin's data type schema
+SCHEMAS = {
+    "xnat": Path(__file__).parent / "data" / "xnat.xsd",
+    "mrd": MRD_PLUGIN_SCHEMA_PATH,
+}
+
+# Type of the objects of each collection, unless given when the object is created
+_COLLECTION_TYPES = {
+    "projects": "xnat:projectData",
+    "subjects": "xnat:subjectData",
+    "experiments": "xnat:mrSessionData",
+    "scans": "xnat:imageScanData",
+    "resources": "xnat:resourceCatalog",
+}
+
+
+class StandInXnat:
+    """Minimal local HTTP stand-in for the parts of the XNAT REST API used when
+    uploading files to resources. Stored files are kept in memory, keyed by their uri,
+    and other objects (e.g. subjects) that exist on the server are listed in objects.
+    Objects can be created with a PUT (keeping the fields given as query parameters in
+    object_fields), fetched, listed (with their insert date from insert_dates, if any)
+    and deleted.
+
+    With resumable=True, the server also speaks the resumable upload protocol used by
+    xnat_mrd.upload with resumable=True (Upload-Offset headers), which XNAT itself
+    does not. Failures can be injected with fail_next_puts (respond fail_status, 503
+    by default, to the next puts) and partial_next_puts (store only the first half of the next chunks, then
+    respond 500). Each file upload takes at least file_put_seconds, and the largest
+    number of file uploads in progress at once is kept in max_concurrent_file_puts.
+
+    With session_timeout set (in seconds), JSESSION requests report the expiration time
+    of the session in a SESSION_EXPIRATION_TIME cookie, as XNAT does. While expired is
+    set, heartbeats (GET /data/JSESSION) fail until a new JSESSION is created with a
+    POST."""
+
+    def __init__(self, resumable: bool = False):
+        self.resumable = resumable
+        self.files: dict[str, bytearray] = {}
+        self.objects: set[str] = set()
+        self.insert_dates: dict[str, str] = {}
+        self.object_fields: dict[str, dict[str, str]] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.fail_next_puts = 0
+        self.fail_status = 503
+        self.partial_next_puts = 0
+        self.corrupt_digests = False
+        self.file_put_seconds = 0.0
+        self.max_concurrent_file_puts = 0
+        self._file_puts = 0
+        self.session_timeout: Optional[float] = None
+        self.expired = False
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def session(self, with_model: bool = False) -> xnat.XNATSession:
+        """An xnatpy session talking to this server (without the login and schema
+        discovery of xnat.connect). With with_model, the xnatpy data model is built from
+        SCHEMAS, so that subjects, experiments and scans can be created with it."""
+        session = xnat.XNATSession(
+            server=self.url,
+            logger=_XnatLogger(logging.getLogger("stand_in_xnat"), {}),
+            interface=requests.Session(),
+            keepalive=False,
+        )
+        if with_model:
+            xnat.build_model(
+                session, extension_types=True, connection_id=uuid.uuid4().hex
+            )
+        return session
+
+    def _object_json(self, uri: str) -> dict[str, Any]:
+        """The object at uri, as XNAT returns it for GET {uri}?format=json"""
+        query = dict(self.object_fields.get(uri, {}))
+        query.pop("req_format", None)
+        parts = uri.split("/")
+        xsi_type = (
+            query.pop("xsiType", None)
+            or query.pop("scans", None)
+            or _COLLECTION_TYPES[parts[-2]]
+        )
+        fields = {"ID": parts[-1], "label": parts[-1], "project": parts[3]}
+        if "subjects" in parts[:-2]:
+            fields["subject_ID"] = parts[parts.index("subjects") + 1]
+        fields.update((key.rpartition("/")[2], value) for key, value in query.items())
+        return {
+            "items": [
+                {
+                    "data_fields": fields,
+                    "meta": {"xsi:type": xsi_type, "isHistory": False},
+                    "children": [],
+                }
+            ]
+        }
+
+    def _handler_class(self) -> type:
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"", headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _path(self) -> str:
+                # Objects are the same with or without /archive in their uri
+                path = urlsplit(self.path).path
+                return path.replace("/data/archive/", "/data/", 1)
+
+            def _send_json(self, data: Any):
+                body = json.dumps(data).encode()
+                self._send(200, body, {"Content-Type": "application/json"})
+
+            def _session_cookies(self) -> dict[str, str]:
+                if stand_in.session_timeout is None:
+                    return {}
+                expiration = f'"{int(time.time() * 1000)},{int(stand_in.session_timeout * 1000)}"'
+                return {"Set-Cookie": f"SESSION_EXPIRATION_TIME={expiration}; Path=/"}
+
+            def do_HEAD(self):
+                path = self._path()
+                stand_in.requests.append(("HEAD", path))
+                with stand_in._lock:
+                    stored = stand_in.files.get(path)
+                if path in stand_in.objects:
+                    self._send(200)
+                elif stand_in.resumable and "/files/" in path:
+                    size = 0 if stored is None else len(stored)
+                    self._send(200, headers={"Upload-Offset": str(size)})
+                elif stored is None:
+                    self._send(404)
+                else:
+                    self._send(200)
+
+            def do_PUT(self):
+                path = self._path()
+                stand_in.requests.append(("PUT", path))
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "/files/" in path:
+                    # A slow transfer, overlapping with other uploads
+                    with stand_in._lock:
+                        stand_in._file_puts += 1
+                        stand_in.max_concurrent_file_puts = max(
+                            stand_in.max_concurrent_file_puts, stand_in._file_puts
+                        )
+                    time.sleep(stand_in.file_put_seconds)
+                    with stand_in._lock:
+                        stand_in._file_puts -= 1
+
+                with stand_in._lock:
+                    if stand_in.fail_next_puts:
+                        stand_in.fail_next_puts -= 1
+                        self._send(stand_in.fail_status)
+                        return
+
+                    if "/files/" not in path:
+                        query = parse_qs(urlsplit(self.path).query)
+                        stand_in.objects.add(path)
+                        stand_in.object_fields.setdefault(path, {}).update(
+                            (key, values[-1]) for key, values in query.items()
+                        )
+                        self._send(200, path.rpartition("/")[2].encode())
+                        return
+
+                    offset = self.headers.get("Upload-Offset")
+                    if offset is None:
+                        stand_in.files[path] = bytearray(body)
+                        self._send(201)
+                        return
+
+                    stored = stand_in.files.setdefault(path, bytearray())
+                    if int(offset) != len(stored):
+                        self._send(409, headers={"Upload-Offset": str(len(stored))})
+                        return
+                    if stand_in.partial_next_puts:
+                        stand_in.partial_next_puts -= 1
+                        stored.extend(body[: len(body) // 2])
+                        self._send(500)
+                        return
+                    stored.extend(body)
+                    self._send(204, headers={"Upload-Offset": str(len(stored))})
+
+            def do_GET(self):
+                path = self._path()
+                stand_in.requests.append(("GET", path))
+                if path == "/data/version":
+                    self._send(200, b"1.8.10")
+                    return
+                if path == "/xapi/schemas":
+                    self._send_json(list(SCHEMAS))
+                    return
+                if path.removeprefix("/xapi/schemas/") in SCHEMAS:
+                    schema_path = SCHEMAS[path.removeprefix("/xapi/schemas/")]
+                    self._send(200, schema_path.read_bytes())
+                    return
+                if path == "/data/search/elements":
+                    self._send_json({"ResultSet": {"Result": []}})
+                    return
+                if path == "/data/JSESSION":
+                    if stand_in.expired:
+                        self._send(401)
+                    else:
+                        self._send(200, b"stand-in-session-id", self._session_cookies())
+                    return
+                with stand_in._lock:
+                    if path in stand_in.objects:
+                        self._send_json(stand_in._object_json(path))
+                        return
+                    object_uris = sorted(
+                        uri
+                        for uri in stand_in.objects
+                        if uri.rpartition("/")[0] == path
+                    )
+                if path.rpartition("/")[2] in _COLLECTION_TYPES:
+                    results = [
+                        {
+                            "ID": uri.rpartition("/")[2],
+                            "name": uri.rpartition("/")[2],
+                            "label": uri.rpartition("/")[2],
+                            "insert_date": stand_in.insert_dates.get(uri, ""),
+                            "URI": uri,
+                        }
+                        for uri in object_uris
+                    ]
+                    self._send_json({"ResultSet": {"Result": results}})
+                    return
+                if not path.endswith("/files"):
+                    self._send(404)
+                    return
+
+                results = []
+                with stand_in._lock:
+                    for file_path, data in stand_in.files.items():
+                        parent, _, name = file_path.rpartition("/")
+                        if parent != path:
+                            continue
+                        digest = hashlib.md5(data).hexdigest()
+                        if stand_in.corrupt_digests:
+                            digest = hashlib.md5(data + b"corrupt").hexdigest()
+                        results.append(
+                            {
+                                "Name": name,
+                                "Size": str(len(data)),
+                                "URI": file_path,
+                                "digest": digest,
+                            }
+                        )
+                self._send_json({"ResultSet": {"Result": results}})
+
+            def do_POST(self):
+                path = self._path()
+                stand_in.requests.append(("POST", path))
+                if path != "/data/JSESSION" or "Authorization" not in self.headers:
+                    self._send(401)
+                    return
+                stand_in.expired = False
+                self._send(200, b"new-stand-in-session-id", self._session_cookies())
+
+            def do_DELETE(self):
+                path = self._path()
+                stand_in.requests.append(("DELETE", path))
+                with stand_in._lock:
+                    stand_in.objects.discard(path)
+                self._send(200)
+
+        return Handler
+
+
+class _XnatLogger(logging.LoggerAdapter):
+    """Logger with the extra verbose level xnatpy expects (normally added by
+    xnat.connect)"""
+
+    def verbose(self, message, *args, **kwargs):
+        self.debug(message, *args, **kwargs)
@@ -0,0 +1,65 @@
+import ismrmrd
+import numpy as np
+import pytest
+
+from xnat_mrd.acquisition_stats import acquisition_statistics
+from xnat_mrd.mrd_2_xnat import plugin_field_names
+from xnat_mrd.populate_datatype_fields import convert_mrd_file
+
+PREFIX = "mrd:mrdScanData/acquisitionStatistics"
+
+
+@pytest.fixture
+def acquisitions_mrd_file_path(tmp_path, mrd_header):
+    """Provides an mrd file with a noise scan, 4 calibration scans and every other one of
+    the 256 k-space lines of its header, acquired 10 ticks apart"""
+    mrd_file_path = tmp_path / "acquisitions.h5"
+    with ismrmrd.Dataset(mrd_file_path, "dataset", create_if_needed=True) as dset:
+        dset.write_xml_header(mrd_header)
+        flags = [ismrmrd.ACQ_IS_NOISE_MEASUREMENT] + [
+            ismrmrd.ACQ_IS_PARALLEL_CALIBRATION
+        ] * 4
+        lines = [0] + list(range(124, 128)) + list(range(0, 256, 2))
+        for index, line in enumerate(lines):
+            acquisition = ismrmrd.Acquisition.from_array(
+                np.zeros((2, 32), dtype=np.complex64)
+            )
+            acquisition.idx.kspace_encode_step_1 = line
+            acquisition.acquisition_time_stamp = 1000 + 10 * index
+            if index < len(flags):
+                acquisition.set_flag(flags[index])
+            dset.append_acquisition(acquisition)
+    return mrd_file_path
+
+
+def test_acquisition_statistics(acquisitions_mrd_file_path):
+    # Small chunks, so that statistics are combined across chunks
+    statistics = acquisition_statistics(
+        acquisitions_mrd_file_path, "dataset", acquisitions_per_chunk=7
+    )
+
+    assert statistics[f"{PREFIX}/numberOfAcquisitions"] == 133
+    assert statistics[f"{PREFIX}/numberOfNoiseScans"] == 1
+    assert statistics[f"{PREFIX}/numberOfCalibrationScans"] == 4
+    assert statistics[f"{PREFIX}/scanDuration_s"] == pytest.approx(132 * 10 * 2.5e-3)
+    # Calibration lines are not imaging lines of the first encoding
+    assert statistics[f"{PREFIX}/kspaceLineCoverage"].split(", ")[0] == "0.5000"
+    assert set(statistics) <= plugin_field_names()
+
+
+def test_acquisition_statistics_without_acquisitions(synthetic_mrd_file_path):
+    assert acquisition_statistics(synthetic_mrd_file_path, "dataset") == {}
+
+
+def test_convert_mrd_file_with_acquisition_statistics(acquisitions_mrd_file_path):
+    xnat_hdr = convert_mrd_file(acquisitions_mrd_file_path)
+    with_statistics = convert_mrd_file(
+        acquisitions_mrd_file_path, with_acquisition_statistics=True
+    )
+
+    assert with_statistics == {
+        **xnat_hdr,
+        **acquisition_statistics(acquisitions_mrd_file_path, "dataset"),
+    }
+    # The cached header conversion is left as it was
+    assert convert_mrd_file(acquisitions_mrd_file_path) == xnat_hdr
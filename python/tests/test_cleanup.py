@@ -0,0 +1,69 @@
+import datetime
+
+import pytest
+
+from xnat_mrd.cleanup import delete_subjects
+
+SUBJECTS_URI = "/data/projects/mrd/subjects"
+
+
+@pytest.fixture
+def stand_in_subjects(stand_in_xnat):
+    """Provides the stand-in server with 200 test subjects inserted on 2024-01-01 and
+    2024-02-01, and one other subject"""
+
+    for index in range(200):
+        uri = f"{SUBJECTS_URI}/Subj-{index:03d}"
+        stand_in_xnat.objects.add(uri)
+        stand_in_xnat.insert_dates[uri] = f"2024-0{1 + index % 2}-01 12:00:00.0"
+    stand_in_xnat.objects.add(f"{SUBJECTS_URI}/Patient-1")
+    return stand_in_xnat
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_delete_subjects_in_parallel(stand_in_subjects):
+    progress = []
+
+    summary = delete_subjects(
+        stand_in_subjects.session(),
+        "mrd",
+        label_prefix="Subj-",
+        max_workers=8,
+        progress=lambda done, total: progress.append((done, total)),
+    )
+
+    assert summary.n_deleted == 200
+    assert summary.n_failed == 0
+    assert summary.subjects_per_second > 0
+    assert stand_in_subjects.objects == {f"{SUBJECTS_URI}/Patient-1"}
+    assert progress[-1] == (200, 200)
+    assert len(progress) == 200
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_delete_subjects_by_date(stand_in_subjects):
+    summary = delete_subjects(
+        stand_in_subjects.session(),
+        "mrd",
+        inserted_after=datetime.datetime(2024, 1, 15),
+        inserted_before=datetime.datetime(2024, 3, 1),
+        dry_run=True,
+    )
+
+    # Odd subjects were inserted in February - the other subject has no insert date
+    assert sorted(summary.deleted) == [
+        f"Subj-{index:03d}" for index in range(1, 200, 2)
+    ]
+    assert len(stand_in_subjects.objects) == 201
+    assert not any(method == "DELETE" for method, _ in stand_in_subjects.requests)
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_delete_subjects_restores_connection_pool(stand_in_subjects):
+    session = stand_in_subjects.session()
+    adapters = dict(session.interface.adapters)
+
+    delete_subjects(session, "mrd", label_prefix="Subj-", max_workers=32)
+
+    # The session passed in keeps its own connection adapters
+    assert session.interface.adapters == adapters
@@ -0,0 +1,67 @@
+import json
+
+import pooch
+import pytest
+
+from xnat_mrd import fetch_datasets
+from xnat_mrd.fetch_datasets import ZenodoFile, fetch, get_zenodo, prefetch
+
+DOI = "doi:10.5281/zenodo.0000000"
+
+
+@pytest.fixture
+def test_data_dir(tmp_path, monkeypatch):
+    """Points the dataset cache at an empty directory, and makes any request to Zenodo
+    fail"""
+    monkeypatch.setattr(fetch_datasets, "TEST_DATA_DIR", tmp_path)
+    monkeypatch.setattr(fetch_datasets, "REGISTRY_CACHE_DIR", tmp_path / "registries")
+    monkeypatch.setattr(fetch_datasets, "_zenodo_pooches", {})
+
+    def no_network(self):
+        raise AssertionError("Zenodo was contacted")
+
+    monkeypatch.setattr(pooch.Pooch, "load_registry_from_doi", no_network)
+    return tmp_path
+
+
+def test_get_zenodo_uses_cached_registry(test_data_dir, monkeypatch):
+    registry_path = fetch_datasets._registry_path(DOI)
+    registry_path.parent.mkdir()
+    registry_path.write_text(
+        json.dumps({"registry": {"scan.mrd": "md5:0123"}, "urls": {}})
+    )
+
+    zenodo = get_zenodo(DOI)
+
+    assert zenodo.registry == {"scan.mrd": "md5:0123"}
+    assert get_zenodo(DOI) is zenodo
+
+    monkeypatch.setenv(fetch_datasets.OFFLINE_ENV_VAR, "1")
+    with pytest.raises(FileNotFoundError, match="No cached registry"):
+        get_zenodo("doi:10.5281/zenodo.1111111")
+
+
+def test_prefetch_cached_files_offline(test_data_dir, monkeypatch):
+    monkeypatch.setenv(fetch_datasets.OFFLINE_ENV_VAR, "1")
+    files = [
+        ZenodoFile(DOI, "scan.mrd"),
+        ZenodoFile(DOI, "scans.zip", zip_member="scans/scan.h5"),
+    ]
+    for zenodo_file in files:
+        zenodo_file.local_path.parent.mkdir(parents=True, exist_ok=True)
+        zenodo_file.local_path.write_bytes(b"")
+    progress = []
+
+    paths = prefetch(files, progress=lambda *args: progress.append(args))
+
+    assert paths == {
+        files[0]: test_data_dir / "scan.mrd",
+        files[1]: test_data_dir / "scans.zip.unzip" / "scans" / "scan.h5",
+    }
+    assert sorted(n_done for n_done, _, _ in progress) == [1, 2]
+
+    missing = ZenodoFile(DOI, "missing.mrd")
+    with pytest.raises(FileNotFoundError, match="is not cached"):
+        fetch(missing)
+    with pytest.raises(FileNotFoundError):
+        prefetch([missing, *files])
@@ -0,0 +1,74 @@
+import os
+import shutil
+
+from xnat_mrd import header_cache
+from xnat_mrd.header_cache import HeaderCache, cached_mrd_2_xnat, header_cache_key
+from xnat_mrd.mrd_2_xnat import mrd_2_xnat
+
+
+def counting_mrd_2_xnat(monkeypatch):
+    calls = []
+
+    def wrapped(ismrmrd_header, xml_schema_filepath):
+        calls.append(ismrmrd_header)
+        return mrd_2_xnat(ismrmrd_header, xml_schema_filepath)
+
+    monkeypatch.setattr(header_cache, "mrd_2_xnat", wrapped)
+    return calls
+
+
+def test_repeated_header_converted_once(monkeypatch, mrd_header, xml_schema_path):
+    calls = counting_mrd_2_xnat(monkeypatch)
+    cache = HeaderCache()
+
+    first = cached_mrd_2_xnat(mrd_header, xml_schema_path, cache)
+    first["scans"] = "modified by caller"
+    second = cached_mrd_2_xnat(mrd_header, xml_schema_path, cache)
+
+    assert len(calls) == 1
+    assert second == mrd_2_xnat(mrd_header, xml_schema_path)
+    assert cache.info()["hits"] == 1
+    assert cache.info()["misses"] == 1
+
+
+def test_disk_cache_shared(monkeypatch, tmp_path, mrd_header, xml_schema_path):
+    calls = counting_mrd_2_xnat(monkeypatch)
+
+    expected = cached_mrd_2_xnat(mrd_header, xml_schema_path, HeaderCache(tmp_path))
+    # e.g. another process, with an empty memory tier
+    cache = HeaderCache(tmp_path)
+    assert cached_mrd_2_xnat(mrd_header, xml_schema_path, cache) == expected
+
+    assert len(calls) == 1
+    assert cache.info()["disk_hits"] == 1
+
+
+def test_key_depends_on_schema(tmp_path, mrd_header, xml_schema_path):
+    schema_copy = tmp_path / "ismrmrd.xsd"
+    shutil.copy(xml_schema_path, schema_copy)
+    key = header_cache_key(mrd_header, schema_copy)
+
+    assert header_cache_key(mrd_header, xml_schema_path) == key
+    assert header_cache_key(mrd_header + b"\n", schema_copy) != key
+
+    schema_copy.write_text(schema_copy.read_text() + "<!-- edited -->\n")
+    assert header_cache_key(mrd_header, schema_copy) != key
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    entry = {"field": "x" * 1000}
+    cache = HeaderCache(tmp_path, memory_entries=1, max_disk_bytes=3500)
+
+    for i, key in enumerate(["a1", "b2", "c3"]):
+        cache.put(key, entry)
+        os.utime(cache._path(key), ns=(i * 10**9, i * 10**9))
+
+    # Reading "a1" from disk marks it as recently used
+    assert cache.get("a1") == entry
+    cache.put("d4", entry)
+
+    assert cache.get("b2") is None
+    assert cache.get("a1") == entry
+    assert cache.get("d4") == entry
+    assert cache.info()["evictions"] >= 1
+    assert cache.info()["disk_bytes"] <= 3500
@@ -0,0 +1,45 @@
+import re
+import subprocess
+import sys
+
+# Generous compared to the ~0.2 s measured locally, so that only a regression (e.g.
+# importing xnat again, which alone takes ~0.5 s) fails on a slow runner
+IMPORT_TIME_BUDGET_SECONDS = 0.5
+
+# Modules only needed when talking to XNAT, downloading test data or opening mrd files
+LAZY_MODULES = ["xnat", "requests", "pooch", "ismrmrd", "xmlschema", "h5py", "numpy"]
+
+
+def run_python(code, cwd):
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_has_no_side_effects(tmp_path):
+    process = run_python(
+        "import sys, xnat_mrd.populate_datatype_fields, xnat_mrd.ingest, "
+        "xnat_mrd.upload_async, xnat_mrd.watch, xnat_mrd.cli; "
+        f"print([name for name in {LAZY_MODULES!r} if name in sys.modules])",
+        tmp_path,
+    )
+
+    assert process.stdout.strip() == "[]"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_import_time_budget(tmp_path):
+    process = run_python("import xnat_mrd.populate_datatype_fields", tmp_path)
+
+    # Lines of -X importtime are "import time: self [us] | cumulative | module"
+    cumulative_us = re.search(
+        r"\|\s*(\d+) \| xnat_mrd\.populate_datatype_fields$",
+        process.stderr,
+        re.MULTILINE,
+    )
+    assert cumulative_us is not None
+    assert int(cumulative_us.group(1)) / 1e6 < IMPORT_TIME_BUDGET_SECONDS
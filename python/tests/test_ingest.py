@@ -0,0 +1,30 @@
+import h5py
+
+from xnat_mrd.ingest import discover_mrd_files, ingest
+
+
+def test_discover_mrd_files(tmp_path):
+    nested = tmp_path / "nested"
+    nested.mkdir()
+    for path in [tmp_path / "a.mrd", nested / "b.h5"]:
+        with h5py.File(path, "w") as f:
+            f.create_group("dataset")
+    (tmp_path / "notes.txt").write_text("not mrd")
+    (tmp_path / "fake.h5").write_text("not hdf5 either")
+
+    assert discover_mrd_files([str(tmp_path)]) == [tmp_path / "a.mrd", nested / "b.h5"]
+    assert discover_mrd_files([str(tmp_path / "**" / "*.h5")]) == [nested / "b.h5"]
+
+
+def test_ingest_reports_conversion_failures(tmp_path):
+    mrd_file_path = tmp_path / "empty.mrd"
+    with h5py.File(mrd_file_path, "w") as f:
+        f.create_group("dataset")
+
+    # Conversion fails before any upload is attempted, so no session is needed
+    summary = ingest(None, [mrd_file_path], "mrd", convert_workers=1)
+
+    assert summary.n_failed == 1
+    assert summary.n_succeeded == 0
+    assert summary.results[0].error.startswith("header conversion failed")
+    assert summary.files_per_second == 0
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import shutil
+
+import h5py
+import pytest
+
+from xnat_mrd.ingest import ingest
+from xnat_mrd.manifest import ManifestEntry, UploadManifest, header_digest
+
+
+def make_entry(content_sha256: str, header_sha256: str = "h") -> ManifestEntry:
+    return ManifestEntry(
+        server="http://xnat",
+        project="mrd",
+        content_sha256=content_sha256,
+        header_sha256=header_sha256,
+        path="/data/file.h5",
+        size_bytes=10,
+        experiment="Exp-1",
+        experiment_uri="/data/experiments/XNAT_E00001",
+    )
+
+
+def test_manifest_records_uploads(tmp_path):
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        manifest.record(make_entry("abc", header_digest({"a": 1, "b": 2})))
+        manifest.record(make_entry("def", header_digest({"b": 2, "a": 1})))
+
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        entry = manifest.find("http://xnat", "mrd", "abc")
+        assert entry.experiment == "Exp-1"
+        assert entry.uploaded_at
+        assert manifest.find("http://xnat", "other_project", "abc") is None
+        assert manifest.find("http://xnat", "mrd", "xyz") is None
+        assert {
+            entry.content_sha256
+            for entry in manifest.find_by_header(
+                "http://xnat", "mrd", header_digest({"a": 1, "b": 2})
+            )
+        } == {"abc", "def"}
+
+
+def test_manifest_content_hash(tmp_path, synthetic_mrd_file_path):
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        content_sha256 = manifest.content_hash(synthetic_mrd_file_path)
+        assert (
+            content_sha256
+            == hashlib.sha256(synthetic_mrd_file_path.read_bytes()).hexdigest()
+        )
+
+        # Unchanged files (same size and modification time) are not read again
+        stat = synthetic_mrd_file_path.stat()
+        synthetic_mrd_file_path.write_bytes(b"x" * stat.st_size)
+        os.utime(synthetic_mrd_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert manifest.content_hash(synthetic_mrd_file_path) == content_sha256
+
+        os.utime(synthetic_mrd_file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert manifest.content_hash(synthetic_mrd_file_path) != content_sha256
+
+
+def test_ingest_skips_uploaded_files(tmp_path, stand_in_xnat, synthetic_mrd_file_path):
+    session = stand_in_xnat.session()
+    uploaded_copy = tmp_path / "copy.h5"
+    shutil.copy(synthetic_mrd_file_path, uploaded_copy)
+    new_file = tmp_path / "new.h5"
+    with h5py.File(new_file, "w") as f:
+        f.create_group("dataset")
+    new_file_copy = tmp_path / "new_copy.h5"
+    shutil.copy(new_file, new_file_copy)
+
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        entry = make_entry(manifest.content_hash(synthetic_mrd_file_path))
+        entry.server = session.server
+        manifest.record(entry)
+
+        summary = ingest(
+            session,
+            [synthetic_mrd_file_path, uploaded_copy, new_file, new_file_copy],
+            "mrd",
+            convert_workers=1,
+            manifest=manifest,
+        )
+
+    assert [result.uploaded_to for result in summary.results] == [
+        entry.experiment_uri,
+        entry.experiment_uri,
+        None,
+        None,
+    ]
+    assert summary.n_skipped == 2
+    # The new file fails header conversion, and so does its copy, so nothing reaches
+    # the server
+    assert summary.n_failed == 2
+    assert summary.results[3].error == summary.results[2].error
+    assert not any(method == "PUT" for method, _ in stand_in_xnat.requests)
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+@pytest.mark.parametrize("fail_first_upload", [False, True])
+def test_ingest_skips_copies_once_uploaded(
+    tmp_path, stand_in_xnat, synthetic_mrd_file_path, fail_first_upload
+):
+    stand_in_xnat.objects.add("/data/projects/mrd")
+    session = stand_in_xnat.session(with_model=True)
+    mrd_file_copy = tmp_path / "copy.h5"
+    shutil.copy(synthetic_mrd_file_path, mrd_file_copy)
+    # Makes the first object created while uploading fail
+    stand_in_xnat.fail_next_puts = int(fail_first_upload)
+
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        summary = ingest(
+            session,
+            [synthetic_mrd_file_path, mrd_file_copy],
+            "mrd",
+            convert_workers=1,
+            manifest=manifest,
+        )
+        content_sha256 = manifest.content_hash(synthetic_mrd_file_path)
+        entry = manifest.find(session.server, "mrd", content_sha256)
+
+    # Files are hashed in parallel, so either of them can be the one uploaded
+    (uploaded,) = [
+        result for result in summary.results if result.ok and not result.skipped
+    ]
+    (other,) = [result for result in summary.results if result is not uploaded]
+    if fail_first_upload:
+        # The other file was uploaded first, and failed
+        assert other.error.startswith("upload failed")
+    else:
+        assert other.skipped
+        assert other.uploaded_to == str(uploaded.path)
+    assert entry.path == str(uploaded.path)
+    # Only one of the files reached the server
+    assert len(stand_in_xnat.files) == 1
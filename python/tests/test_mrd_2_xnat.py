@@ -0,0 +1,228 @@
+import sys
+from pathlib import Path
+from xml.etree import ElementTree
+
+import pytest
+
+from xnat_mrd import mrd_2_xnat
+
+
+def test_schema_compiled_once(xml_schema_path, mrd_header):
+    mrd_2_xnat.clear_schema_cache()
+
+    first = mrd_2_xnat.mrd_2_xnat(mrd_header, xml_schema_path)
+    second = mrd_2_xnat.mrd_2_xnat(mrd_header, xml_schema_path)
+
+    assert first == second
+    info = mrd_2_xnat.schema_cache_info()
+    assert info["misses"] == 1
+    assert info["hits"] == 1
+    assert info["currsize"] == 1
+
+
+def test_schema_recompiled_when_file_changes(tmp_path, xml_schema_path):
+    mrd_2_xnat.clear_schema_cache()
+    schema_copy = tmp_path / "ismrmrd.xsd"
+    schema_copy.write_bytes(xml_schema_path.read_bytes())
+
+    first = mrd_2_xnat.get_xml_schema(schema_copy)
+    schema_copy.write_bytes(xml_schema_path.read_bytes() + b"\n")
+    second = mrd_2_xnat.get_xml_schema(schema_copy)
+
+    assert first is not second
+    assert mrd_2_xnat.schema_cache_info()["misses"] == 2
+
+
+def test_schema_disk_cache(tmp_path, xml_schema_path, mrd_header):
+    mrd_2_xnat.clear_schema_cache()
+    mrd_2_xnat.get_xml_schema(xml_schema_path, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.pickle"))) == 1
+
+    # A fresh process only has the on-disk copy available
+    mrd_2_xnat.clear_schema_cache()
+    xml_schema = mrd_2_xnat.get_xml_schema(xml_schema_path, cache_dir=tmp_path)
+
+    assert mrd_2_xnat.schema_cache_info()["disk_hits"] == 1
+    assert xml_schema.is_valid(mrd_header)
+
+
+def test_invalid_header_rejected(xml_schema_path, mrd_header):
+    invalid_header = mrd_header.replace(
+        b"<patientPosition>HFS", b"<patientPosition>XYZ"
+    )
+
+    with pytest.raises(Exception, match="not a valid ismrmrd file"):
+        mrd_2_xnat.check_header_valid_convert_to_dict(xml_schema_path, invalid_header)
+
+
+def test_trusted_header_skips_validation(xml_schema_path, mrd_header, monkeypatch):
+    validated = mrd_2_xnat.check_header_valid_convert_to_dict(
+        xml_schema_path, mrd_header
+    )
+
+    xml_schema = mrd_2_xnat.get_xml_schema(xml_schema_path)
+    validation_modes = []
+
+    class RecordingSchema:
+        url = xml_schema.url
+
+        def to_dict(self, source, validation="strict", **kwargs):
+            validation_modes.append(validation)
+            return xml_schema.to_dict(source, validation=validation, **kwargs)
+
+    monkeypatch.setattr(
+        mrd_2_xnat, "get_xml_schema", lambda *args, **kwargs: RecordingSchema()
+    )
+    trusted = mrd_2_xnat.check_header_valid_convert_to_dict(
+        xml_schema_path, mrd_header, trusted=True
+    )
+
+    assert trusted == validated
+    assert validation_modes == ["skip"]
+
+
+def test_mrd_2_xnat_special_cases(xml_schema_path, mrd_header):
+    xnat_hdr = mrd_2_xnat.mrd_2_xnat(mrd_header, xml_schema_path)
+
+    assert xnat_hdr["scans"] == "mrd:mrdScanData"
+    assert (
+        xnat_hdr["mrd:mrdScanData/acquisitionSystemInformation/coilLabelList"]
+        == "Body_18:1:B11 Body_18:1:B12 Body_18:1:B13 Body_18:1:B14 "
+    )
+    assert xnat_hdr["mrd:mrdScanData/acquisitionSystemInformation/systemModel"] == (
+        "Skyra"
+    )
+    assert xnat_hdr["mrd:mrdScanData/waveformInformationList"] == "ecg respiratory "
+
+    # only the first encoding / first entry of repeated sequence parameters is kept
+    assert xnat_hdr["mrd:mrdScanData/encoding/encodedSpace/matrixSize/x"] == 512
+    assert xnat_hdr["mrd:mrdScanData/encoding/trajectory"] == "cartesian"
+    assert xnat_hdr["mrd:mrdScanData/sequenceParameters/TR"] == 4.2
+    assert xnat_hdr["mrd:mrdScanData/sequenceParameters/TE"] == 2.1
+    assert (
+        xnat_hdr[
+            "mrd:mrdScanData/measurementInformation/measurementDependency/dependencyType"
+        ]
+        == "SenMap"
+    )
+    assert (
+        xnat_hdr[
+            "mrd:mrdScanData/encoding/parallelImaging/accelerationFactor/kspace_enc_step_1"
+        ]
+        == 2
+    )
+
+    dropped = [
+        "/coilLabel/",
+        "/waveformName",
+        "/trajectoryDescription",
+        "/spacing",
+        "/diffusion/",
+        "userParameter",
+        "@",
+    ]
+    for key, value in xnat_hdr.items():
+        assert not any(part in key for part in dropped)
+        assert not isinstance(value, (dict, list))
+
+
+def test_flatten_header_custom_rules():
+    rule_trie = mrd_2_xnat.compile_header_rules(
+        [
+            mrd_2_xnat.HeaderRule(("a", "b"), mrd_2_xnat.RuleAction.DROP),
+            mrd_2_xnat.HeaderRule(("a", "c"), mrd_2_xnat.RuleAction.RENAME, "d"),
+            mrd_2_xnat.HeaderRule(("e",), mrd_2_xnat.RuleAction.JOIN, "eList"),
+        ]
+    )
+    ismrmrd_dict = {"@xmlns": "ns", "a": {"b": 1, "c": [2, 3]}, "e": ["x", "y"]}
+
+    assert mrd_2_xnat.flatten_header(ismrmrd_dict, rule_trie) == {
+        "scans": "mrd:mrdScanData",
+        "mrd:mrdScanData/eList": "x y ",
+        "mrd:mrdScanData/a/d": 3,
+    }
+
+
+def test_conflicting_rules_rejected():
+    with pytest.raises(ValueError, match="More than one rule"):
+        mrd_2_xnat.compile_header_rules(
+            [
+                mrd_2_xnat.HeaderRule(("a",), mrd_2_xnat.RuleAction.DROP),
+                mrd_2_xnat.HeaderRule(("a",), mrd_2_xnat.RuleAction.FIRST),
+            ]
+        )
+
+
+def test_flatten_header_unlimited_depth():
+    depth = 3 * sys.getrecursionlimit()
+    value = {"leaf": 1}
+    for level in range(depth):
+        value = {f"group{level}": [value] if level % 2 else value}
+
+    xnat_hdr = mrd_2_xnat.flatten_header(value)
+
+    leaf_keys = [key for key in xnat_hdr if key.endswith("/leaf")]
+    assert len(leaf_keys) == 1
+    assert leaf_keys[0].count("/") == depth + 1
+    assert xnat_hdr[leaf_keys[0]] == 1
+
+
+def test_streaming_matches_mrd_2_xnat(xml_schema_path, mrd_header):
+    xnat_hdr = mrd_2_xnat.mrd_2_xnat(mrd_header, xml_schema_path)
+
+    assert dict(mrd_2_xnat.iter_mrd_2_xnat(mrd_header, xml_schema_path)) == xnat_hdr
+
+
+def test_streaming_only_decodes_requested_fields(xml_schema_path, mrd_header):
+    field_names = [
+        "mrd:mrdScanData/encoding/encodedSpace/matrixSize/x",
+        "mrd:mrdScanData/acquisitionSystemInformation/coilLabelList",
+    ]
+
+    xnat_hdr = dict(
+        mrd_2_xnat.iter_mrd_2_xnat(mrd_header, xml_schema_path, field_names=field_names)
+    )
+
+    assert xnat_hdr == {
+        "scans": "mrd:mrdScanData",
+        "mrd:mrdScanData/encoding/encodedSpace/matrixSize/x": 512,
+        "mrd:mrdScanData/acquisitionSystemInformation/coilLabelList": (
+            "Body_18:1:B11 Body_18:1:B12 Body_18:1:B13 Body_18:1:B14 "
+        ),
+    }
+
+
+def test_xnat_hdr_to_xml(xml_schema_path, mrd_header):
+    xnat_hdr = mrd_2_xnat.mrd_2_xnat(mrd_header, xml_schema_path)
+
+    root = ElementTree.fromstring(mrd_2_xnat.xnat_hdr_to_xml(xnat_hdr, "scan_1"))
+
+    assert root.tag == "{http://ptb.de/mrd}mrdScanData"
+    assert root.get("ID") == "scan_1"
+    namespace = {"mrd": "http://ptb.de/mrd"}
+    for key, value in xnat_hdr.items():
+        if key.startswith("mrd:mrdScanData/") and value != "":
+            path = "mrd:" + key.removeprefix("mrd:mrdScanData/").replace("/", "/mrd:")
+            assert root.findtext(path, namespaces=namespace) == str(value)
+
+    # Elements follow the order of the plugin schema, not of the header
+    system_information = [
+        element.tag.removeprefix("{http://ptb.de/mrd}")
+        for element in root.find("mrd:acquisitionSystemInformation", namespace)
+    ]
+    assert system_information.index("coilLabelList") > system_information.index(
+        "receiverChannels"
+    )
+
+
+def test_packaged_plugin_schema_matches_plugin():
+    # The package ships a copy of the plugin's data type schema, for installs without
+    # a source checkout
+    plugin_schema_path = (
+        Path(__file__).parents[2] / "src/main/resources/schemas/mrd/mrd.xsd"
+    )
+
+    assert (
+        mrd_2_xnat.MRD_PLUGIN_SCHEMA_PATH.read_bytes()
+        == plugin_schema_path.read_bytes()
+    )
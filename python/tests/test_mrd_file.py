@@ -0,0 +1,92 @@
+import hashlib
+import os
+import sys
+
+import pytest
+
+from xnat_mrd.mrd_file import MrdFile, open_mrd_file
+from xnat_mrd.mrd_2_xnat import mrd_2_xnat
+from xnat_mrd.populate_datatype_fields import (
+    convert_all_datasets,
+    convert_mrd_file,
+    list_ismrmrd_datasets,
+)
+
+
+def test_mrd_file_lists_datasets_and_reads_headers(synthetic_mrd_file_path, mrd_header):
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        assert mrd_file.dataset_names == ["dataset", "dataset_2"]
+        assert mrd_file.multidata
+        for dataset_name in mrd_file.dataset_names:
+            assert mrd_file.read_xml_header(dataset_name) == mrd_header
+
+
+def test_mrd_file_raw_bytes(synthetic_mrd_file_path):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        assert mrd_file.size == len(raw_bytes)
+        assert mrd_file.checksum() == hashlib.md5(raw_bytes).hexdigest()
+        assert mrd_file.checksum("sha256") == hashlib.sha256(raw_bytes).hexdigest()
+
+        # Streams are independent of each other and of h5py reads
+        stream = mrd_file.open_stream()
+        first_part = stream.read(100)
+        mrd_file.read_xml_header("dataset")
+        assert mrd_file.open_stream().read() == raw_bytes
+        assert first_part + stream.read() == raw_bytes
+
+        stream.seek(0)
+        assert stream.read() == raw_bytes
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="open files listed in /proc"
+)
+def test_mrd_file_opens_file_once(synthetic_mrd_file_path):
+    n_open_files = len(os.listdir("/proc/self/fd"))
+
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        # Raw reads share the file descriptor of h5py
+        mrd_file.checksum()
+        assert len(os.listdir("/proc/self/fd")) == n_open_files + 1
+
+    assert len(os.listdir("/proc/self/fd")) == n_open_files
+
+
+def test_mrd_file_checksums_from_partial_reads(synthetic_mrd_file_path):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        # Out of order and overlapping reads, as from a resumed or retried upload
+        mrd_file.read_at(100, 1000)
+        mrd_file.read_at(600, 0)
+        mrd_file.read_at(1000, 500)
+
+        assert mrd_file.checksum("md5") == hashlib.md5(raw_bytes).hexdigest()
+        assert mrd_file.checksum("sha256") == hashlib.sha256(raw_bytes).hexdigest()
+        assert mrd_file.checksum("sha1") == hashlib.sha1(raw_bytes).hexdigest()
+
+
+def test_open_mrd_file_reuses_open_file(synthetic_mrd_file_path):
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        with open_mrd_file(mrd_file) as opened_file:
+            assert opened_file is mrd_file
+        # Still open after being passed on
+        assert list_ismrmrd_datasets(mrd_file) == (["dataset", "dataset_2"], True)
+
+
+def test_convert_mrd_file(synthetic_mrd_file_path, mrd_header, xml_schema_path):
+    expected = mrd_2_xnat(mrd_header, xml_schema_path)
+
+    assert convert_mrd_file(synthetic_mrd_file_path) == expected
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        assert convert_mrd_file(mrd_file) == expected
+
+
+def test_convert_all_datasets(synthetic_mrd_file_path, mrd_header, xml_schema_path):
+    expected = mrd_2_xnat(mrd_header, xml_schema_path)
+
+    serial = convert_all_datasets(synthetic_mrd_file_path, max_workers=1)
+    assert serial == {"dataset": expected, "dataset_2": expected}
+    assert convert_all_datasets(synthetic_mrd_file_path, max_workers=2) == serial
@@ -0,0 +1,48 @@
+import pytest
+
+from xnat_mrd.populate_datatype_fields import scan_handle, xnat_object_exists
+
+
+def test_xnat_object_exists_single_request(stand_in_xnat):
+    subjects_uri = "/data/projects/mrd/subjects"
+    stand_in_xnat.objects.update(f"{subjects_uri}/Subj-{i}" for i in range(1000))
+    session = stand_in_xnat.session()
+    stand_in_xnat.requests.clear()
+
+    assert xnat_object_exists(session, f"{subjects_uri}/Subj-999")
+    assert not xnat_object_exists(session, f"{subjects_uri}/Subj-1000")
+
+    # One HEAD per check, however many subjects the project has
+    assert stand_in_xnat.requests == [
+        ("HEAD", f"{subjects_uri}/Subj-999"),
+        ("HEAD", f"{subjects_uri}/Subj-1000"),
+    ]
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_scan_handle(stand_in_xnat):
+    experiment_uri = "/data/projects/mrd/subjects/Subj-1/experiments/Exp-1"
+    stand_in_xnat.objects.add(experiment_uri)
+    stand_in_xnat.objects.add(f"{experiment_uri}/scans/scan_2")
+    stand_in_xnat.object_fields[f"{experiment_uri}/scans/scan_2"] = {
+        "xsiType": "mrd:mrdScanData"
+    }
+    session = stand_in_xnat.session(with_model=True)
+    experiment = session.create_object(experiment_uri)
+    stand_in_xnat.requests.clear()
+
+    # With a type known to the session, the scan is built without any request
+    scan = scan_handle(experiment, "scan_1", "mrd:mrdScanData")
+
+    assert scan.uri == f"{experiment_uri}/scans/scan_1"
+    assert scan.__xsi_type__ == "mrd:mrdScanData"
+    assert scan.parent is experiment
+    assert stand_in_xnat.requests == []
+
+    # Otherwise, the type is looked up with a single request
+    scan = scan_handle(experiment, "scan_2", "xnat:otherScanData")
+
+    assert scan.uri == f"{experiment_uri}/scans/scan_2"
+    assert scan.__xsi_type__ == "mrd:mrdScanData"
+    assert scan.parent is experiment
+    assert stand_in_xnat.requests == [("GET", f"{experiment_uri}/scans/scan_2")]
@@ -5,7 +5,12 @@ import xmlschema
 import xnat
 import subprocess
 
-from xnat_mrd.populate_datatype_fields import upload_mrd_data, read_mrd_header
+from xnat_mrd.ingest import ingest
+from xnat_mrd.populate_datatype_fields import (
+    list_ismrmrd_datasets,
+    read_mrd_header,
+    upload_mrd_data,
+)
 
 
 @pytest.fixture
@@ -106,6 +111,18 @@ def test_mrd_data_upload(xnat_connection, mrd_file_path):
     verify_headers_match(mrd_file_path, subject.experiments[0].scans[0])
 
 
+@pytest.mark.usefixtures("ensure_mrd_project", "remove_test_data")
+def test_mrd_data_upload_xml_body(xnat_connection, mrd_file_path):
+    project_id = "mrd"
+    xnat_session = xnat_connection.session
+    project = xnat_session.projects[project_id]
+    upload_mrd_data(xnat_session, mrd_file_path, project_id, xml_body=True)
+    assert len(project.subjects) == 1
+
+    subject = project.subjects[0]
+    verify_headers_match(mrd_file_path, subject.experiments[0].scans[0])
+
+
 @pytest.mark.usefixtures("ensure_mrd_project", "remove_test_data")
 def test_mrd_multidata_upload(xnat_connection, mrd_file_multidata_path):
     project_id = "mrd"
@@ -119,6 +136,47 @@ def test_mrd_multidata_upload(xnat_connection, mrd_file_multidata_path):
     )
 
 
+@pytest.mark.usefixtures("ensure_mrd_project", "remove_test_data")
+def test_mrd_multidata_upload_all_datasets(xnat_connection, mrd_file_multidata_path):
+    project_id = "mrd"
+    xnat_session = xnat_connection.session
+    project = xnat_session.projects[project_id]
+    upload_mrd_data(
+        xnat_session, mrd_file_multidata_path, project_id, all_datasets=True
+    )
+    assert len(project.subjects) == 1
+
+    experiment = project.subjects[0].experiments[0]
+    dataset_names, _ = list_ismrmrd_datasets(mrd_file_multidata_path)
+    assert len(experiment.scans) == len(dataset_names)
+    for dataset_name in dataset_names:
+        scan = experiment.scans[f"cart_cine_scan_{dataset_name}"]
+        verify_headers_match(mrd_file_multidata_path, scan, dataset_name)
+        assert len(scan.resources) == 0
+
+    # The raw file is uploaded once, to the experiment
+    assert len(experiment.resources["MR_RAW"].files) == 1
+
+
+@pytest.mark.usefixtures("ensure_mrd_project", "remove_test_data")
+def test_mrd_ingest(xnat_connection, mrd_file_path, mrd_file_multidata_path):
+    project_id = "mrd"
+    xnat_session = xnat_connection.session
+    project = xnat_session.projects[project_id]
+    summary = ingest(
+        xnat_session,
+        [mrd_file_path, mrd_file_multidata_path],
+        project_id,
+        convert_workers=2,
+        upload_workers=2,
+    )
+
+    assert summary.n_succeeded == 2
+    assert summary.mb_per_second > 0
+    project.subjects.clearcache()
+    assert len(project.subjects) == 2
+
+
 @pytest.mark.usefixtures("ensure_mrd_project", "remove_test_data")
 def test_mrd_data_modification(xnat_connection, mrd_file_path):
     project_id = "mrd"
@@ -0,0 +1,81 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from xnat_mrd.session import XnatSessionManager
+
+
+@pytest.fixture
+def session_manager(stand_in_xnat):
+    """A session manager for the stand-in server, counting how often it connects"""
+
+    class StandInSessionManager(XnatSessionManager):
+        connects = 0
+
+        def _connect(self):
+            self.connects += 1
+            return stand_in_xnat.session()
+
+    stand_in_xnat.session_timeout = 900
+    manager = StandInSessionManager(
+        stand_in_xnat.url, "user", "password", pool_size=8, refresh_margin_seconds=60
+    )
+    yield manager
+    manager.close()
+
+
+def expire_soon(xnat_session):
+    """Make the session look like it was last refreshed almost 15 minutes ago"""
+    xnat_session.heartbeat()
+    refreshed_at = datetime.datetime.now() - datetime.timedelta(seconds=880)
+    for cookie in xnat_session.interface.cookies:
+        if cookie.name == "SESSION_EXPIRATION_TIME":
+            cookie.value = f'"{int(refreshed_at.timestamp() * 1000)},900000"'
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_session_shared_between_threads(session_manager):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        sessions = list(pool.map(lambda _: session_manager.get_session(), range(32)))
+
+    assert session_manager.connects == 1
+    assert all(session is sessions[0] for session in sessions)
+    adapter = sessions[0].interface.get_adapter(session_manager.server)
+    assert adapter._pool_maxsize == 8
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_session_kept_alive_before_expiry(stand_in_xnat, session_manager):
+    xnat_session = session_manager.get_session()
+    stand_in_xnat.requests.clear()
+
+    # Not close to expiring - no requests needed
+    xnat_session.heartbeat()
+    stand_in_xnat.requests.clear()
+    assert session_manager.get_session() is xnat_session
+    assert stand_in_xnat.requests == []
+
+    expire_soon(xnat_session)
+    stand_in_xnat.requests.clear()
+    assert session_manager.get_session() is xnat_session
+    assert stand_in_xnat.requests == [("GET", "/data/JSESSION")]
+    assert session_manager.get_session() is xnat_session
+    assert len(stand_in_xnat.requests) == 1
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_expired_session_logs_in_again(stand_in_xnat, session_manager):
+    xnat_session = session_manager.get_session()
+    expire_soon(xnat_session)
+    stand_in_xnat.expired = True
+    stand_in_xnat.requests.clear()
+
+    assert session_manager.get_session() is xnat_session
+
+    assert stand_in_xnat.requests == [
+        ("GET", "/data/JSESSION"),
+        ("POST", "/data/JSESSION"),
+    ]
+    assert not stand_in_xnat.expired
+    assert session_manager.connects == 1
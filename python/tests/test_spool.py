@@ -0,0 +1,221 @@
+import shutil
+import time
+from types import SimpleNamespace
+
+from xnat_mrd import spool as spool_module
+from xnat_mrd.spool import (
+    EXPERIMENT_CREATED,
+    FAILED,
+    FILE_UPLOADED,
+    HEADER_CONVERTED,
+    SCAN_CREATED,
+    UploadSpool,
+    drain_spool,
+)
+
+
+class FakeXnat:
+    """Records the XNAT objects created by the steps of spool jobs, in place of the
+    functions of populate_datatype_fields that need a full XNAT server"""
+
+    def __init__(self, monkeypatch):
+        self.objects: set[str] = set()
+        self.calls: list[str] = []
+        self.fail_next_scans = 0
+        self.fail_next_files = 0
+        for name in [
+            "verify_project_exists",
+            "xnat_object_exists",
+            "create_unique_subject",
+            "add_exam",
+            "create_scan",
+            "scan_handle",
+            "upload_raw_data",
+            "upload_raw_file",
+            "_object_at",
+        ]:
+            monkeypatch.setattr(spool_module, name, getattr(self, name))
+
+    def verify_project_exists(self, session, project_name):
+        return SimpleNamespace(uri=f"/data/projects/{project_name}")
+
+    def xnat_object_exists(self, session, uri):
+        return uri in self.objects
+
+    def _object_at(self, session, uri):
+        return SimpleNamespace(uri=uri)
+
+    def create_unique_subject(self, session, project, time_id):
+        self.calls.append("subject")
+        uri = f"{project.uri}/subjects/Subj-{time_id}"
+        self.objects.add(uri)
+        return SimpleNamespace(uri=uri), time_id
+
+    def add_exam(self, subject, time_id, experiment_date):
+        self.calls.append("experiment")
+        uri = f"{subject.uri}/experiments/Exp-{time_id}"
+        self.objects.add(uri)
+        return SimpleNamespace(uri=uri)
+
+    def create_scan(self, experiment, xnat_hdr, scan_id):
+        self.calls.append("scan")
+        if self.fail_next_scans:
+            self.fail_next_scans -= 1
+            raise ConnectionError("server unavailable")
+        uri = f"{experiment.uri}/scans/{scan_id}"
+        self.objects.add(uri)
+        return SimpleNamespace(uri=uri)
+
+    def scan_handle(self, experiment, scan_id, xsi_type):
+        return SimpleNamespace(uri=f"{experiment.uri}/scans/{scan_id}")
+
+    def upload_raw_data(self, scan, mrd_file_path):
+        self.calls.append("resource")
+        resource_uri = f"{scan.uri}/resources/MR_RAW"
+        self.objects.add(resource_uri)
+        self.upload_raw_file(None, resource_uri, mrd_file_path)
+
+    def upload_raw_file(self, session, resource_uri, mrd_file_path):
+        self.calls.append("file")
+        if self.fail_next_files:
+            self.fail_next_files -= 1
+            raise ConnectionError("server unavailable")
+
+
+def test_job_resumes_from_last_step(tmp_path, monkeypatch, synthetic_mrd_file_path):
+    fake_xnat = FakeXnat(monkeypatch)
+    fake_xnat.fail_next_scans = 1
+    spool_path = tmp_path / "spool.sqlite"
+
+    with UploadSpool(spool_path, backoff_seconds=60) as spool:
+        job = spool.enqueue(synthetic_mrd_file_path, "mrd")
+        summary = drain_spool(spool, None)
+
+    assert summary.retried == [job.id]
+    assert fake_xnat.calls == ["subject", "experiment", "scan"]
+
+    # The journal survives reopening the spool, e.g. after a crash
+    with UploadSpool(spool_path, backoff_seconds=60) as spool:
+        assert spool.enqueue(synthetic_mrd_file_path, "mrd").id == job.id
+        job = spool.job(job.id)
+        assert job.state == EXPERIMENT_CREATED
+        assert job.attempts == 1
+        assert job.next_attempt_at > time.time() + 50
+        assert job.xnat_hdr["mrd:mrdScanData/measurementInformation/protocolName"]
+        assert drain_spool(spool, None).completed == []
+
+        job.next_attempt_at = 0
+        spool.save(job)
+        summary = drain_spool(spool, None)
+        assert summary.completed == [job.id]
+        assert spool.job(job.id).state == FILE_UPLOADED
+        assert spool.next_attempt_at() is None
+
+    # The subject and experiment were not created again
+    assert fake_xnat.calls == [
+        "subject",
+        "experiment",
+        "scan",
+        "scan",
+        "resource",
+        "file",
+    ]
+
+
+def test_subject_created_before_crash_is_reused(
+    tmp_path, monkeypatch, synthetic_mrd_file_path
+):
+    fake_xnat = FakeXnat(monkeypatch)
+
+    with UploadSpool(tmp_path / "spool.sqlite") as spool:
+        job = spool.enqueue(synthetic_mrd_file_path, "mrd")
+        # Journaled the subject's id, then died after creating it
+        job.state = HEADER_CONVERTED
+        job.xnat_hdr = {"scans": "mrd:mrdScanData"}
+        job.time_id = "2024-01-01-00-00-00-000"
+        spool.save(job)
+        fake_xnat.objects.add(f"/data/projects/mrd/subjects/Subj-{job.time_id}")
+
+        assert drain_spool(spool, None).completed == [job.id]
+
+    assert fake_xnat.calls == ["experiment", "scan", "resource", "file"]
+
+
+def test_resource_created_before_failed_upload_is_reused(
+    tmp_path, monkeypatch, synthetic_mrd_file_path
+):
+    fake_xnat = FakeXnat(monkeypatch)
+    fake_xnat.fail_next_files = 1
+
+    with UploadSpool(tmp_path / "spool.sqlite") as spool:
+        job = spool.enqueue(synthetic_mrd_file_path, "mrd")
+        assert drain_spool(spool, None).retried == [job.id]
+        job = spool.job(job.id)
+        assert job.state == SCAN_CREATED
+
+        job.next_attempt_at = 0
+        spool.save(job)
+        assert drain_spool(spool, None).completed == [job.id]
+
+    # The retry uploads to the resource created by the failed attempt
+    assert fake_xnat.calls == [
+        "subject",
+        "experiment",
+        "scan",
+        "resource",
+        "file",
+        "file",
+    ]
+
+
+def test_corrupt_job_is_not_advanced(tmp_path, monkeypatch, synthetic_mrd_file_path):
+    fake_xnat = FakeXnat(monkeypatch)
+
+    with UploadSpool(tmp_path / "spool.sqlite") as spool:
+        job = spool.enqueue(synthetic_mrd_file_path, "mrd")
+        # The experiment was created, but its uri is missing from the journal
+        job.state = EXPERIMENT_CREATED
+        job.xnat_hdr = {"scans": "mrd:mrdScanData"}
+        job.time_id = "2024-01-01-00-00-00-000"
+        spool.save(job)
+
+        assert drain_spool(spool, None).retried == [job.id]
+        assert "no experiment uri" in spool.job(job.id).last_error
+
+    assert fake_xnat.calls == []
+
+
+def test_backoff_until_failed(tmp_path):
+    with UploadSpool(
+        tmp_path / "spool.sqlite",
+        max_attempts=4,
+        backoff_seconds=10,
+        max_backoff_seconds=15,
+    ) as spool:
+        job = spool.enqueue(tmp_path / "missing.mrd", "mrd")
+        delays = []
+        for _ in range(3):
+            spool.record_failure(job, OSError("unavailable"), now=1000)
+            delays.append(job.next_attempt_at - 1000)
+        spool.record_failure(job, OSError("unavailable"), now=1000)
+
+        assert delays == [10, 15, 15]
+        assert spool.job(job.id).state == FAILED
+        assert spool.jobs(FAILED)[0].last_error == "unavailable"
+        assert spool.next_due() is None
+
+
+def test_drain_rate(tmp_path, monkeypatch, synthetic_mrd_file_path):
+    FakeXnat(monkeypatch)
+    max_jobs_per_second = 20
+
+    with UploadSpool(tmp_path / "spool.sqlite") as spool:
+        for index in range(4):
+            mrd_file_path = tmp_path / f"{index}.h5"
+            shutil.copy(synthetic_mrd_file_path, mrd_file_path)
+            spool.enqueue(mrd_file_path, "mrd")
+        start = time.monotonic()
+        summary = drain_spool(spool, None, max_jobs_per_second=max_jobs_per_second)
+
+    assert len(summary.completed) == 4
+    assert time.monotonic() - start >= 3 / max_jobs_per_second
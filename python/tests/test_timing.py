@@ -0,0 +1,92 @@
+import json
+import pstats
+
+from xnat_mrd.ingest import ingest
+from xnat_mrd.timing import (
+    Histogram,
+    TimingRegistry,
+    get_timing_registry,
+    profile_to,
+    span,
+)
+
+
+def test_span_records_blocks_and_calls():
+    registry = TimingRegistry()
+
+    with span("block", registry):
+        pass
+
+    @span("call", registry)
+    def call(n):
+        return call(n - 1) if n else 0
+
+    call(2)
+
+    snapshot = registry.snapshot()
+    assert snapshot["block"]["count"] == 1
+    assert snapshot["call"]["count"] == 3
+    assert snapshot["call"]["max"] >= snapshot["call"]["min"] >= 0
+
+
+def test_histogram_buckets_and_merge():
+    histogram = Histogram(buckets=(0.1, 1.0, float("inf")))
+    for seconds in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(seconds)
+    assert histogram.bucket_counts == [2, 1, 1]
+
+    other = Histogram(buckets=(0.1, 1.0, float("inf")))
+    other.observe(0.01)
+    histogram.merge(other.to_dict())
+
+    summary = histogram.to_dict()
+    assert summary["bucket_counts"] == [3, 1, 1]
+    assert summary["count"] == 5
+    assert summary["min"] == 0.01
+    assert summary["max"] == 2.0
+    assert json.loads(json.dumps(summary))["buckets"][-1] == "+Inf"
+
+
+def test_to_prometheus():
+    registry = TimingRegistry()
+    registry.observe("upload", 0.2)
+    registry.observe("upload", 20)
+
+    lines = registry.to_prometheus().splitlines()
+
+    assert "# TYPE xnat_mrd_stage_seconds histogram" in lines
+    assert 'xnat_mrd_stage_seconds_bucket{stage="upload",le="0.25"} 1' in lines
+    assert 'xnat_mrd_stage_seconds_bucket{stage="upload",le="+Inf"} 2' in lines
+    assert 'xnat_mrd_stage_seconds_count{stage="upload"} 2' in lines
+
+
+def test_profile_to(tmp_path):
+    profile_path = tmp_path / "profiles" / "sum.prof"
+
+    with profile_to(profile_path):
+        sum(range(1000))
+
+    assert pstats.Stats(str(profile_path)).total_calls > 0
+
+
+def test_ingest_collects_worker_timings(synthetic_mrd_file_path, tmp_path):
+    registry = get_timing_registry()
+    registry.reset()
+
+    # Without a session the upload fails, after the header has been converted
+    summary = ingest(
+        None,
+        [synthetic_mrd_file_path],
+        "mrd",
+        convert_workers=1,
+        profile_dir=tmp_path,
+    )
+
+    assert summary.results[0].error.startswith("upload failed")
+    snapshot = registry.snapshot()
+    for stage in ["convert", "hdf5_open", "header_read", "header_convert", "upload"]:
+        assert snapshot[stage]["count"] >= 1
+    assert sorted(path.name for path in tmp_path.glob("*.prof")) == [
+        f"00000-{synthetic_mrd_file_path.name}.convert.prof",
+        f"00000-{synthetic_mrd_file_path.name}.upload.prof",
+    ]
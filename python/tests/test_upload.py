@@ -0,0 +1,168 @@
+import hashlib
+import time
+
+import pytest
+
+from xnat_mrd.mrd_file import MrdFile
+from xnat_mrd.upload import DEFAULT_BACKOFF_SECONDS, UploadError, upload_raw_file
+
+from tests.stand_in_server import StandInXnat
+
+RESOURCE_URI = "/data/experiments/Exp-1/scans/scan/resources/MR_RAW"
+
+
+def test_upload_raw_file(stand_in_xnat, synthetic_mrd_file_path):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+    session = stand_in_xnat.session()
+
+    digest = upload_raw_file(
+        session,
+        RESOURCE_URI,
+        synthetic_mrd_file_path,
+        chunk_size=1024,
+        resumable=stand_in_xnat.resumable,
+    )
+
+    assert digest == hashlib.md5(raw_bytes).hexdigest()
+    stored = stand_in_xnat.files[f"{RESOURCE_URI}/files/{synthetic_mrd_file_path.name}"]
+    assert stored == raw_bytes
+
+    n_puts = sum(method == "PUT" for method, _ in stand_in_xnat.requests)
+    if stand_in_xnat.resumable:
+        assert n_puts == -(-len(raw_bytes) // 1024)
+    else:
+        assert n_puts == 1
+
+
+def test_upload_raw_file_reads_file_once(
+    stand_in_xnat, synthetic_mrd_file_path, monkeypatch
+):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+    stand_in_xnat.fail_next_puts = 1
+
+    with MrdFile(synthetic_mrd_file_path) as mrd_file:
+        bytes_read = []
+        read_at = mrd_file.read_at
+
+        def counting_read_at(size, offset):
+            data = read_at(size, offset)
+            bytes_read.append(len(data))
+            return data
+
+        monkeypatch.setattr(mrd_file, "read_at", counting_read_at)
+        upload_raw_file(
+            stand_in_xnat.session(),
+            RESOURCE_URI,
+            mrd_file,
+            chunk_size=1024,
+            backoff_seconds=0,
+            resumable=stand_in_xnat.resumable,
+        )
+        n_bytes_read = sum(bytes_read)
+
+        # Checksums come from the upload, including the retried part, with no extra read
+        assert mrd_file.checksum("sha256") == hashlib.sha256(raw_bytes).hexdigest()
+        assert sum(bytes_read) == n_bytes_read
+
+    # The failed request is read again, but nothing else is
+    assert n_bytes_read < 2 * len(raw_bytes) + 2 * 1024
+
+
+def test_upload_raw_file_retries(stand_in_xnat, synthetic_mrd_file_path):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+    session = stand_in_xnat.session()
+    stand_in_xnat.fail_next_puts = 2
+    if stand_in_xnat.resumable:
+        stand_in_xnat.partial_next_puts = 1
+
+    upload_raw_file(
+        session,
+        RESOURCE_URI,
+        synthetic_mrd_file_path,
+        chunk_size=1024,
+        backoff_seconds=0,
+        resumable=stand_in_xnat.resumable,
+    )
+
+    stored = stand_in_xnat.files[f"{RESOURCE_URI}/files/{synthetic_mrd_file_path.name}"]
+    assert stored == raw_bytes
+
+
+def test_upload_raw_file_resumes(synthetic_mrd_file_path):
+    raw_bytes = synthetic_mrd_file_path.read_bytes()
+    stand_in = StandInXnat(resumable=True)
+    stand_in.start()
+    try:
+        # An earlier, interrupted upload left the first 3000 bytes on the server
+        file_uri = f"{RESOURCE_URI}/files/{synthetic_mrd_file_path.name}"
+        stand_in.files[file_uri] = bytearray(raw_bytes[:3000])
+
+        upload_raw_file(
+            stand_in.session(),
+            RESOURCE_URI,
+            synthetic_mrd_file_path,
+            chunk_size=1024,
+            resumable=True,
+        )
+
+        assert stand_in.files[file_uri] == raw_bytes
+        n_puts = sum(method == "PUT" for method, _ in stand_in.requests)
+        assert n_puts == -(-(len(raw_bytes) - 3000) // 1024)
+    finally:
+        stand_in.stop()
+
+
+def test_upload_raw_file_gives_up(stand_in_xnat, synthetic_mrd_file_path):
+    stand_in_xnat.fail_next_puts = 3
+
+    with pytest.raises(UploadError, match="after 3 attempts"):
+        upload_raw_file(
+            stand_in_xnat.session(),
+            RESOURCE_URI,
+            synthetic_mrd_file_path,
+            max_retries=2,
+            backoff_seconds=0,
+            resumable=stand_in_xnat.resumable,
+        )
+
+
+def test_upload_raw_file_fails_on_client_errors(stand_in_xnat, synthetic_mrd_file_path):
+    stand_in_xnat.fail_next_puts = 1
+    stand_in_xnat.fail_status = 403
+    start = time.perf_counter()
+
+    with pytest.raises(UploadError, match="status 403"):
+        upload_raw_file(
+            stand_in_xnat.session(),
+            RESOURCE_URI,
+            synthetic_mrd_file_path,
+            resumable=stand_in_xnat.resumable,
+        )
+
+    # Not retried, so no time is spent backing off
+    assert time.perf_counter() - start < DEFAULT_BACKOFF_SECONDS
+    assert [method for method, _ in stand_in_xnat.requests].count("PUT") == 1
+
+
+def test_upload_raw_file_checksum_mismatch(stand_in_xnat, synthetic_mrd_file_path):
+    stand_in_xnat.corrupt_digests = True
+
+    with pytest.raises(UploadError, match="Checksum mismatch"):
+        upload_raw_file(stand_in_xnat.session(), RESOURCE_URI, synthetic_mrd_file_path)
+
+
+def test_resumable_upload_needs_server_support(synthetic_mrd_file_path):
+    # Like XNAT itself, this server does not report an Upload-Offset
+    stand_in = StandInXnat()
+    stand_in.start()
+    try:
+        with pytest.raises(UploadError, match="does not support resumable uploads"):
+            upload_raw_file(
+                stand_in.session(),
+                RESOURCE_URI,
+                synthetic_mrd_file_path,
+                resumable=True,
+            )
+        assert not any(method == "PUT" for method, _ in stand_in.requests)
+    finally:
+        stand_in.stop()
@@ -0,0 +1,77 @@
+import asyncio
+import shutil
+
+import h5py
+import pytest
+
+from xnat_mrd.upload_async import ingest_async
+
+PROJECT_URI = "/data/projects/mrd"
+
+
+@pytest.fixture
+def stand_in_project(stand_in_xnat):
+    """Provides the stand-in server (without resumable uploads) with project 'mrd'"""
+    stand_in_xnat.objects.add(PROJECT_URI)
+    return stand_in_xnat
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_ingest_async_reports_conversion_failures(tmp_path, stand_in_project):
+    mrd_file_path = tmp_path / "empty.mrd"
+    with h5py.File(mrd_file_path, "w") as f:
+        f.create_group("dataset")
+
+    summary = asyncio.run(
+        ingest_async(
+            stand_in_project.session(with_model=True),
+            [mrd_file_path],
+            "mrd",
+            convert_workers=1,
+        )
+    )
+
+    assert summary.n_failed == 1
+    assert summary.results[0].error.startswith("header conversion failed")
+    # Conversion fails before any upload is attempted
+    assert not any(method == "PUT" for method, _ in stand_in_project.requests)
+
+
+@pytest.mark.parametrize("stand_in_xnat", [False], indirect=True)
+def test_ingest_async_limits_concurrent_uploads(
+    tmp_path, stand_in_project, synthetic_mrd_file_path
+):
+    mrd_file_paths = []
+    for i in range(6):
+        mrd_file_paths.append(tmp_path / f"file_{i}.h5")
+        shutil.copy(synthetic_mrd_file_path, mrd_file_paths[-1])
+    stand_in_project.file_put_seconds = 0.1
+    session = stand_in_project.session(with_model=True)
+    adapters = dict(session.interface.adapters)
+
+    summary = asyncio.run(
+        ingest_async(
+            session,
+            mrd_file_paths,
+            "mrd",
+            max_concurrency=2,
+            convert_workers=2,
+        )
+    )
+
+    assert summary.n_succeeded == 6
+    assert stand_in_project.max_concurrent_file_puts == 2
+    # Every file was uploaded to a scan created with the header converted in the
+    # process pool
+    uploaded = sorted(uri.rpartition("/")[2] for uri in stand_in_project.files)
+    assert uploaded == [path.name for path in mrd_file_paths]
+    scan_uris = [
+        uri for uri in stand_in_project.objects if uri.endswith("/scans/cart_cine_scan")
+    ]
+    assert len(scan_uris) == 6
+    assert all(
+        stand_in_project.object_fields[uri]["scans"] == "mrd:mrdScanData"
+        for uri in scan_uris
+    )
+    # The session passed in keeps its own connection adapters
+    assert session.interface.adapters == adapters
@@ -0,0 +1,200 @@
+import hashlib
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from xnat_mrd import ingest as ingest_module
+from xnat_mrd.manifest import UploadManifest
+from xnat_mrd.mrd_file import MrdFile
+from xnat_mrd.watch import open_complete_mrd_file, watch_folder
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+@pytest.fixture
+def recorded_uploads(monkeypatch):
+    """Records the paths uploaded by watch_folder, in place of upload_mrd_data"""
+    uploaded = []
+
+    def upload_mrd_data(session, mrd_file, project_name, **kwargs):
+        uploaded.append(mrd_file.path)
+        return SimpleNamespace(label="Exp", uri=f"/experiments/{len(uploaded)}")
+
+    monkeypatch.setattr(ingest_module, "upload_mrd_data", upload_mrd_data)
+    return uploaded
+
+
+@pytest.mark.parametrize("use_inotify", [True, False], ids=["inotify", "polling"])
+def test_watch_folder_uploads_completed_files_once(
+    tmp_path, synthetic_mrd_file_path, recorded_uploads, use_inotify
+):
+    if use_inotify and not sys.platform.startswith("linux"):
+        pytest.skip("inotify is only available on Linux")
+    drop_zone = tmp_path / "drop_zone"
+    (drop_zone / "scanner").mkdir(parents=True)
+    contents = synthetic_mrd_file_path.read_bytes()
+
+    stop_event = threading.Event()
+    results = []
+    watcher = threading.Thread(
+        target=lambda: results.append(
+            watch_folder(
+                SimpleNamespace(server="http://stand-in"),
+                drop_zone,
+                "mrd",
+                stable_seconds=0.2,
+                poll_seconds=0.05,
+                use_inotify=use_inotify,
+                stop_event=stop_event,
+            )
+        )
+    )
+    watcher.start()
+    try:
+        time.sleep(0.2)
+        # A file written in two parts, as if still being copied off the scanner
+        mrd_file_path = drop_zone / "scanner" / "scan.h5"
+        with open(mrd_file_path, "wb") as f:
+            f.write(contents[: len(contents) // 2])
+            f.flush()
+            time.sleep(0.5)
+            assert recorded_uploads == []
+            f.write(contents[len(contents) // 2 :])
+
+        assert wait_for(lambda: recorded_uploads)
+        # Further events for the unchanged file upload nothing
+        open(mrd_file_path, "ab").close()
+        time.sleep(0.5)
+    finally:
+        stop_event.set()
+        watcher.join()
+
+    assert recorded_uploads == [mrd_file_path]
+    assert results[0].n_succeeded == 1
+
+
+def test_open_complete_mrd_file(tmp_path, synthetic_mrd_file_path):
+    truncated_path = tmp_path / "truncated.h5"
+    truncated_path.write_bytes(synthetic_mrd_file_path.read_bytes()[:1024])
+
+    with open_complete_mrd_file(synthetic_mrd_file_path) as mrd_file:
+        assert mrd_file.dataset_names
+    assert open_complete_mrd_file(truncated_path) is None
+    assert open_complete_mrd_file(tmp_path / "missing.h5") is None
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is only available on Linux"
+)
+def test_watch_folder_leaves_uploaded_files_to_manifest(
+    tmp_path, synthetic_mrd_file_path, recorded_uploads
+):
+    drop_zone = tmp_path / "drop_zone"
+    drop_zone.mkdir()
+    stop_event = threading.Event()
+    results = []
+
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        watcher = threading.Thread(
+            target=lambda: watch_folder(
+                SimpleNamespace(server="http://stand-in"),
+                drop_zone,
+                "mrd",
+                stable_seconds=0.1,
+                use_inotify=True,
+                manifest=manifest,
+                stop_event=stop_event,
+                on_result=results.append,
+            )
+        )
+        watcher.start()
+        try:
+            time.sleep(0.2)
+            mrd_file_path = drop_zone / "scan.h5"
+            mrd_file_path.write_bytes(synthetic_mrd_file_path.read_bytes())
+            assert wait_for(lambda: results)
+            # Once recorded in the manifest, further events for the file are checked
+            # against it
+            open(mrd_file_path, "ab").close()
+            assert wait_for(lambda: len(results) == 2)
+        finally:
+            stop_event.set()
+            watcher.join()
+
+    assert recorded_uploads == [mrd_file_path]
+    assert results[1].skipped
+    assert results[1].uploaded_to == "/experiments/1"
+
+
+def test_watch_folder_reads_new_files_once(
+    tmp_path, synthetic_mrd_file_path, monkeypatch
+):
+    drop_zone = tmp_path / "drop_zone"
+    drop_zone.mkdir()
+    mrd_file_path = drop_zone / "scan.h5"
+    mrd_file_path.write_bytes(synthetic_mrd_file_path.read_bytes())
+    opened = []
+    builtin_open = open
+    bytes_read = []
+    read_at = MrdFile.read_at
+
+    def counting_open(file, *args, **kwargs):
+        opened.append(file)
+        return builtin_open(file, *args, **kwargs)
+
+    def counting_read_at(self, size, offset):
+        data = read_at(self, size, offset)
+        bytes_read.append(len(data))
+        return data
+
+    def upload_mrd_data(session, mrd_file, project_name, **kwargs):
+        # Like upload_raw_file: stream the file, then compare its MD5 digest
+        for _ in mrd_file.iter_chunks():
+            pass
+        mrd_file.checksum("md5")
+        return SimpleNamespace(label="Exp", uri="/experiments/1")
+
+    monkeypatch.setattr(ingest_module, "upload_mrd_data", upload_mrd_data)
+    monkeypatch.setattr("builtins.open", counting_open)
+    monkeypatch.setattr(MrdFile, "read_at", counting_read_at)
+    stop_event = threading.Event()
+    results = []
+
+    with UploadManifest(tmp_path / "manifest.sqlite") as manifest:
+        watcher = threading.Thread(
+            target=lambda: watch_folder(
+                SimpleNamespace(server="http://stand-in"),
+                drop_zone,
+                "mrd",
+                stable_seconds=0.1,
+                use_inotify=False,
+                manifest=manifest,
+                stop_event=stop_event,
+                on_result=results.append,
+            )
+        )
+        watcher.start()
+        try:
+            assert wait_for(lambda: results)
+        finally:
+            stop_event.set()
+            watcher.join()
+
+        content_sha256 = hashlib.sha256(mrd_file_path.read_bytes()).hexdigest()
+        assert manifest.find("http://stand-in", "mrd", content_sha256)
+
+    assert results[0].ok
+    # The file is only opened by h5py, and read once for its content hash (and MD5
+    # digest) and once by the upload
+    assert mrd_file_path not in opened
+    assert sum(bytes_read) == 2 * mrd_file_path.stat().st_size
@@ -3,6 +3,8 @@ import xnat
 import requests
 import time
 
+from xnat_mrd.cleanup import delete_subjects
+
 
 class XnatConnection:
     """Handle connection to the xnat4tests xnat.
@@ -48,9 +50,7 @@ class XnatConnection:
 
 def delete_data(session: xnat.XNATSession) -> None:
     for project in session.projects:
-        for subject in project.subjects.values():
-            session.delete(
-                path=f"/data/projects/{project.id}/subjects/{subject.label}",
-                query={"removeFiles": "True"},
-            )
+        summary = delete_subjects(session, project.id)
+        if summary.n_failed:
+            raise RuntimeError(f"Could not delete subjects: {summary.failed}")
         project.subjects.clearcache()